@@ -0,0 +1,86 @@
+"""Compares 1 year total returns calculated from the Yahoo data against the
+values published by Vanguard.
+
+Three methods are compared over the Oct 31 to Oct 31 style window which the
+notebook found lines up best with Vanguard:
+    tr_index: ratio of the total return index (dividends reinvested on the
+        ex-date), as maintained by v3/tr_index.py
+    legacy: end_close / (start_close - dividends) - 1, as used by the v3
+        email before it read from the index. Still timed by
+        v3/benchmarks/bench_pipeline.py
+    adj_close: change in Yahoo's adjusted close
+
+Run from this folder: python accuracy_report.py
+"""
+import os
+import sys
+import pandas as pd
+# tr_index lives in the v3 folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'v3'))
+import tr_index
+
+
+def load_data(folder):
+    """Reads the Yahoo and Vanguard files
+
+    Args:
+        folder (str): the folder holding the files
+
+    Returns:
+        tuple: the daily prices, the dividends and the Vanguard returns
+    """
+    values = pd.read_csv(os.path.join(folder, 'VCN.TO.csv'),
+                         parse_dates=['Date'])
+    dividends = pd.read_csv(os.path.join(folder, 'dividends.csv'),
+                            parse_dates=['Date'])
+    reference = pd.read_csv(os.path.join(folder,
+                                         'vcn_monthly_total_returns.csv'))
+    reference['Month'] = pd.PeriodIndex(reference['Month'], freq='M')
+    return values, dividends, reference.set_index('Month')['Monthly_Return']
+
+
+def report(values, dividends, reference, ticker='VCN.TO'):
+    """Calculates the 1 year returns each way next to the Vanguard values
+
+    Args:
+        values (df): daily prices in the format downloaded from Yahoo
+        dividends (df): dividends with Date and Amount columns
+        reference (Series): the Vanguard returns in percent by month
+        ticker (str): the ticker the data is for
+
+    Returns:
+        df: one row per month with each method's return and its error
+    """
+    prices = pd.DataFrame({'ticker': ticker, 'snap_date': values['Date'],
+                           'close': values['Close']})
+    divs = pd.DataFrame({'ticker': ticker, 'snap_date': dividends['Date'],
+                         'amount': dividends['Amount']})
+    index_me = tr_index.month_end_index(tr_index.build_index(prices, divs))
+    months = prices['snap_date'].dt.to_period('M')
+    close_me = values.groupby(months)['Close'].last()
+    adj_me = values.groupby(months)['Adj Close'].last()
+    div_months = divs['snap_date'].dt.to_period('M')
+    div_me = divs.groupby(div_months)['amount'].sum()
+    div_me = div_me.reindex(close_me.index, fill_value=0).rolling(12).sum()
+    results = pd.DataFrame({
+        'vanguard': reference,
+        'tr_index': tr_index.trailing_index_returns(index_me)[ticker],
+        'legacy': (close_me / (close_me.shift(12) - div_me) - 1) * 100,
+        'adj_close': (adj_me / adj_me.shift(12) - 1) * 100,
+    }).loc[reference.index].sort_index()
+    for method in ['tr_index', 'legacy', 'adj_close']:
+        results[method+'_err'] = results[method] - results['vanguard']
+    return results
+
+
+if __name__ == '__main__':
+    folder = os.path.dirname(os.path.abspath(__file__))
+    results = report(*load_data(folder))
+    print(results.round(2).to_string())
+    print()
+    print('{:>10} {:>8} {:>8}'.format('method', 'mae', 'max'))
+    for method in ['tr_index', 'legacy', 'adj_close']:
+        errors = results[method+'_err'].abs()
+        print('{:>10} {:>8.3f} {:>8.3f}'.format(method, errors.mean(),
+                                                errors.max()))
@@ -1,6 +1,8 @@
 """Code used to track 1-year total returns to help enable a hot potato strategy.
 """
 import os
+import time
+import random
 import urllib.request as urllib2
 import datetime
 import json
@@ -10,6 +12,66 @@ from google.cloud import bigquery
 from mailjet_rest import Client
 
 
+# clients are created once and reused by later calls and warm invocations
+CLIENTS = {}
+# HTTP statuses which mean Mailjet didn't send the email so it can be retried
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def request_timeout():
+    """Returns the seconds to wait on each request, set by REQUEST_TIMEOUT
+
+    Returns:
+        float: the timeout in seconds. Defaults to 60.
+    """
+    return float(os.environ.get('REQUEST_TIMEOUT', 60))
+
+
+def request_backoff():
+    """Returns the seconds to wait before the first retry, set by
+       REQUEST_BACKOFF. The wait doubles with each retry.
+
+    Returns:
+        float: the backoff in seconds. Defaults to 1.
+    """
+    return float(os.environ.get('REQUEST_BACKOFF', 1))
+
+
+def bq_retry():
+    """Returns the retry policy used for BQ calls. BQ's own policy is used,
+       which knows which errors are safe to retry, with our backoff.
+
+    Returns:
+        Retry: the retry policy
+    """
+    return bigquery.DEFAULT_RETRY.with_delay(initial=request_backoff(),
+                                             multiplier=2)
+
+
+def get_bq_client():
+    """Returns the BQ client shared by every call, creating it if needed
+
+    Returns:
+        client: client to connect to BQ.
+    """
+    if 'bigquery' not in CLIENTS:
+        CLIENTS['bigquery'] = bigquery.Client()
+    return CLIENTS['bigquery']
+
+
+def get_mailjet_client():
+    """Returns the Mailjet client shared by every call, creating it if needed
+
+    Returns:
+        Client: client to connect to Mailjet.
+    """
+    if 'mailjet' not in CLIENTS:
+        api_key = os.environ['api_key']
+        api_secret = os.environ['api_secret']
+        CLIENTS['mailjet'] = Client(auth=(api_key, api_secret), version='v3.1')
+    return CLIENTS['mailjet']
+
+
 def get_bq_data():
     """Queries BQ for the most recent entry for each ETF
 
@@ -22,8 +84,9 @@ def get_bq_data():
     with open('query_monthly_data.sql') as sql_file:
         query = sql_file.read()
     query = query.format('`'+project_id+'.'+dataset+'.'+tablename+'`')
-    client = bigquery.Client()
-    return client.query(query).result().to_dataframe()
+    client = get_bq_client()
+    job = client.query(query, retry=bq_retry(), timeout=request_timeout())
+    return job.result(retry=bq_retry(), timeout=request_timeout()).to_dataframe()
 
 
 def prep_data(stocks_df):
@@ -53,14 +116,16 @@ def write_to_gbq(stocks_df):
     dataset = os.environ['DATASET']
     tablename = os.environ['TABLENAME']
     # set up connection details
-    client = bigquery.Client()
+    client = get_bq_client()
     dataset_ref = client.dataset(dataset)
     table_ref = bigquery.TableReference(dataset_ref, tablename)
-    table = client.get_table(table_ref)
+    table = client.get_table(table_ref, retry=bq_retry(),
+                             timeout=request_timeout())
     # convert to list of lists
     rows_to_insert = stocks_df.values.tolist()
-    # write data
-    errors = client.insert_rows(table, rows_to_insert)
+    # write data. each row gets an insert id so BQ drops retried duplicates
+    errors = client.insert_rows(table, rows_to_insert, retry=bq_retry(),
+                                timeout=request_timeout())
     assert errors == []
 
 
@@ -104,7 +169,7 @@ def get_yearly_return(ticker):
         float: the total 1-year return for the ticker
     """
     url = get_url(ticker)
-    content = urllib2.urlopen(url).read().decode('utf-8')
+    content = urllib2.urlopen(url, timeout=request_timeout()).read().decode('utf-8')
     starting = content.find('trailingReturns')+17
     end = content.find("}}", starting)+2
     tree = content[starting:end]
@@ -188,16 +253,46 @@ def compose_summary_email(pct, name_mapping):
     return data
 
 
+def response_status(error):
+    """Returns the HTTP status mailjet answered with for an error raised by
+       its client, looking through the errors it wraps
+
+    Args:
+        error (Exception): the error raised by the client
+
+    Returns:
+        int: the status, or None if mailjet didn't answer, e.g. a timeout
+    """
+    while error is not None:
+        response = getattr(error, 'response', None)
+        if response is not None:
+            return response.status_code
+        error = error.__cause__
+    return None
+
+
 def send_email(email):
-    """Takes in a composed email and sends it using the mailjet api
+    """Takes in a composed email and sends it using the mailjet api. Sends
+       which mailjet answers with a 429 or 5xx are retried with backoff, up to
+       REQUEST_RETRIES times. Timeouts aren't retried as the email may have
+       been sent before the answer was lost.
 
     Args:
         email (dict): dict containing all relevant fields needed by the mailjet API
     """
-    api_key = os.environ['api_key']
-    api_secret = os.environ['api_secret']
-    mailjet = Client(auth=(api_key, api_secret), version='v3.1')
-    result = mailjet.send.create(data=email)
+    mailjet = get_mailjet_client()
+    retries = int(os.environ.get('REQUEST_RETRIES', 3))
+    for attempt in range(retries + 1):
+        try:
+            result = mailjet.send.create(data=email, timeout=request_timeout())
+        except Exception as error:
+            # newer clients raise on error statuses rather than returning them
+            if attempt == retries or response_status(error) not in RETRY_STATUS:
+                raise
+        else:
+            if attempt == retries or result.status_code not in RETRY_STATUS:
+                break
+        time.sleep(request_backoff() * 2 ** attempt * random.uniform(0.5, 1))
     print(result)
 
 
@@ -0,0 +1,193 @@
+"""Code used to backtest the hot potato strategy over the full price history.
+
+Trailing total returns are calculated for every ticker at every month end in
+one pass over a months x tickers matrix. Each month end we rotate into the
+ticker with the highest trailing return and hold it for the following month.
+Tickers drop out of the ranking after their last bar and the month in
+progress isn't simulated.
+
+Run from the v3 folder to print a summary: python backtest.py
+"""
+import os
+import numpy as np
+import pandas as pd
+import storage
+
+
+def load_history(backend, price_table_name, div_table_name):
+    """Pulls the full price and dividend history
+
+    Args:
+        backend (storage backend): open backend to use for querying
+        price_table_name (str): the table to pull stock data from
+        div_table_name (str): the table to pull dividend data from
+
+    Returns:
+        tuple: the price data (ticker, snap_date, close) and the dividend data
+            (ticker, snap_date, amount)
+    """
+    prices = backend.run('history_prices.sql', [price_table_name])
+    divs = backend.run('history_divs.sql', [div_table_name])
+    return prices, divs
+
+
+def month_end_matrices(prices, divs, as_of=None):
+    """Builds months x tickers matrices of month end closes and cumulative
+       dividends. The month end close is the last close on or before the end
+       of the month, matching the dates used by returns.sql. Closes aren't
+       carried past a ticker's last bar, so a delisted ticker has no close
+       for the months after it. Months which haven't ended by as_of are left
+       out, as they would be simulated as if complete.
+
+    Args:
+        prices (df): price data with ticker, snap_date and close columns
+        divs (df): dividend data with ticker, snap_date and amount columns
+        as_of (datetime): the date the backtest is run on. Defaults to today.
+
+    Returns:
+        tuple: the month end closes, the dividends paid to date and whether
+            each ticker had a bar on or after the last date of each month
+    """
+    close = prices.pivot_table(index='snap_date', columns='ticker',
+                               values='close', aggfunc='last')
+    div = divs.pivot_table(index='snap_date', columns='ticker',
+                           values='amount', aggfunc='sum')
+    index = close.index.union(div.index)
+    close = close.reindex(index)
+    # a ticker is listed up to its last bar
+    listed = close.bfill().notna()
+    close = close.ffill().where(listed)
+    cum_div = div.reindex(index=index, columns=close.columns).fillna(0).cumsum()
+    months = index.to_period('M')
+    ended = pd.Period(pd.Timestamp.today() if as_of is None else as_of, 'M')
+    close_me = close.groupby(months).last()
+    close_me = close_me.loc[close_me.index < ended]
+    return (close_me, cum_div.groupby(months).last().loc[close_me.index],
+            listed.groupby(months).last().loc[close_me.index])
+
+
+def trailing_returns(close_me, cum_div_me, lookback=12):
+    """Calculates the trailing total return for every ticker at every month
+       end as end_close / (start_close - dividends) - 1, the formula the
+       daily run used before the total return index.
+
+    Args:
+        close_me (df): month end closes
+        cum_div_me (df): dividends paid to date at each month end
+        lookback (int): the number of months to look back
+
+    Returns:
+        df: the trailing total returns in percent. NaN where there isn't
+            enough history.
+    """
+    divs = cum_div_me - cum_div_me.shift(lookback)
+    return (close_me / (close_me.shift(lookback) - divs) - 1) * 100
+
+
+def monthly_returns(close_me, cum_div_me):
+    """Calculates each ticker's total return over each month, with dividends
+       reinvested at the month end.
+
+    Args:
+        close_me (df): month end closes
+        cum_div_me (df): dividends paid to date at each month end
+
+    Returns:
+        df: the monthly total returns as fractions
+    """
+    divs = cum_div_me - cum_div_me.shift(1)
+    return (close_me + divs) / close_me.shift(1) - 1
+
+
+def simulate(trailing, monthly):
+    """Simulates rotating into the ticker with the highest trailing return
+       at each month end.
+
+    Args:
+        trailing (df): trailing total returns used to pick the leader
+        monthly (df): total returns earned over each month
+
+    Returns:
+        df: one row per month with the leader picked at the month end, the
+            ticker held during the month, the return earned, the equity
+            curve, the drawdown and the turnover (1 when the holding changed)
+    """
+    values = trailing.to_numpy(dtype=float)
+    has_leader = ~np.isnan(values).all(axis=1)
+    leader_idx = np.where(
+        has_leader,
+        np.argmax(np.where(np.isnan(values), -np.inf, values), axis=1), -1)
+    # the leader picked at the end of one month is held over the next
+    held_idx = np.concatenate([[-1], leader_idx[:-1]])
+    monthly_values = monthly.to_numpy(dtype=float)
+    held_returns = np.take_along_axis(
+        monthly_values, np.maximum(held_idx, 0)[:, None], axis=1)[:, 0]
+    held_returns = np.where(held_idx >= 0, np.nan_to_num(held_returns), 0.0)
+    tickers = np.append(trailing.columns.to_numpy(dtype=object), None)
+    results = pd.DataFrame({
+        'leader': tickers[leader_idx],
+        'held': tickers[held_idx],
+        'return': held_returns,
+    }, index=trailing.index)
+    # start from the first month something is held
+    results = results.loc[results['held'].notna().cummax()].copy()
+    results['equity'] = (1 + results['return']).cumprod()
+    results['drawdown'] = results['equity'] / results['equity'].cummax() - 1
+    previous = results['held'].shift(1)
+    results['turnover'] = ((results['held'] != previous) &
+                           previous.notna()).astype(float)
+    return results
+
+
+def summarize(results):
+    """Summarizes a backtest
+
+    Args:
+        results (df): the output of simulate
+
+    Returns:
+        dict: the months simulated, total return, annualized return, maximum
+            drawdown and switches per year
+    """
+    months = len(results)
+    if months == 0:
+        return {'months': 0}
+    final = results['equity'].iloc[-1]
+    return {
+        'months': months,
+        'total_return': float(final - 1),
+        'annualized_return': float(final ** (12 / months) - 1),
+        'max_drawdown': float(results['drawdown'].min()),
+        'switches_per_year': float(results['turnover'].sum() / (months / 12)),
+    }
+
+
+def run_backtest(prices, divs, lookback=12, as_of=None):
+    """Backtests the strategy over the passed history. Tickers without bars
+       after a month end can't be picked as the leader at it.
+
+    Args:
+        prices (df): price data with ticker, snap_date and close columns
+        divs (df): dividend data with ticker, snap_date and amount columns
+        lookback (int): the number of months used to pick the leader
+        as_of (datetime): the date the backtest is run on. Only months which
+            ended before it are simulated. Defaults to today.
+
+    Returns:
+        df: the output of simulate
+    """
+    close_me, cum_div_me, listed_me = month_end_matrices(prices, divs, as_of)
+    trailing = trailing_returns(close_me, cum_div_me, lookback)
+    return simulate(trailing.where(listed_me),
+                    monthly_returns(close_me, cum_div_me))
+
+
+if __name__ == '__main__':
+    price_table_name = os.environ['PRICE_TABLENAME']
+    div_table_name = os.environ['DIVIDEND_TABLENAME']
+    backend = storage.get_backend(price_table_name, div_table_name)
+    prices, divs = load_history(backend, price_table_name, div_table_name)
+    results = run_backtest(prices, divs)
+    print(results.tail(12))
+    for key, value in summarize(results).items():
+        print('{}: {}'.format(key, value))
@@ -0,0 +1 @@
+CREATE TABLE {0} AS SELECT * FROM {1};
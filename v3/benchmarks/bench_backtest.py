@@ -0,0 +1,53 @@
+"""Benchmark of the backtest engine on synthetic universes.
+
+Run from the v3 folder: python benchmarks/bench_backtest.py
+"""
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+# backtest lives in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import backtest
+
+
+def synthetic_universe(n_tickers, years, seed=0):
+    """Builds random daily price and quarterly dividend data shaped like the
+       price and dividend tables
+
+    Args:
+        n_tickers (int): the number of tickers
+        years (int): the number of years of business days
+        seed (int): seed for the random number generator
+
+    Returns:
+        tuple: the price data and the dividend data
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(end='2021-12-31', periods=years * 252)
+    tickers = ['T{}.TO'.format(i) for i in range(n_tickers)]
+    steps = rng.normal(0.0003, 0.01, (len(dates), n_tickers))
+    close = 30 * np.exp(np.cumsum(steps, axis=0))
+    prices = pd.DataFrame({
+        'ticker': np.tile(tickers, len(dates)),
+        'snap_date': np.repeat(dates, n_tickers),
+        'close': close.ravel().round(2)})
+    div_dates = dates[::63]
+    divs = pd.DataFrame({
+        'ticker': np.tile(tickers, len(div_dates)),
+        'snap_date': np.repeat(div_dates, n_tickers),
+        'amount': 0.2})
+    return prices, divs
+
+
+if __name__ == '__main__':
+    print('{:>8} {:>6} {:>10} {:>10}'.format('tickers', 'years', 'rows',
+                                             'seconds'))
+    for n_tickers, years in [(10, 20), (100, 20), (500, 20)]:
+        prices, divs = synthetic_universe(n_tickers, years)
+        start = time.perf_counter()
+        backtest.run_backtest(prices, divs)
+        elapsed = time.perf_counter() - start
+        print('{:>8} {:>6} {:>10} {:>10.2f}'.format(n_tickers, years,
+                                                    len(prices), elapsed))
@@ -0,0 +1,96 @@
+"""Benchmark of sending the monthly report to many subscribers through the
+Mailjet client against a local stand-in of Mailjet's send API (FakeMailjet in
+standins.py), which answers each call after a fixed latency.
+
+Sending one message per call is compared against packing messages into
+batches, with one or several calls in flight. A run with every tenth call
+answered with a 429 shows the cost of retries.
+
+Run from the v3 folder: python benchmarks/bench_dispatch.py
+"""
+import os
+import sys
+import time
+import logging
+import pandas as pd
+# dispatch lives in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import clients
+import dispatch
+import run_stats
+from standins import FakeMailjet
+
+
+SUBSCRIBERS = 1000
+# seconds Mailjet takes to answer each call
+LATENCY = 0.02
+# batch size, workers and how often a call is answered with a 429
+SETTINGS = [(1, 1, 0), (1, 4, 0), (50, 1, 0), (50, 4, 0), (50, 4, 10)]
+
+
+def build_messages(n_subscribers):
+    """Composes a report for each subscriber, split across two portfolios
+
+    Args:
+        n_subscribers (int): the number of subscribers
+
+    Returns:
+        list: the messages in the MJ format
+    """
+    ranked = pd.DataFrame({'portfolio': ['all', 'all', 'us'],
+                           'lookback': [12, 12, 12],
+                           'ticker': ['VCN.TO', 'VFV.TO', 'VFV.TO'],
+                           'total_return': [12.5, 20.1, 20.1],
+                           'rank': [2, 1, 1]})
+    subscribers = [{'email': 'sub{}@example.com'.format(i), 'name': str(i),
+                    'portfolios': ['all'] if i % 2 else ['all', 'us']}
+                   for i in range(n_subscribers)]
+    return dispatch.compose_messages(ranked, {'VCN': 'Canada Stocks',
+                                              'VFV': 'S&P 500 Index'},
+                                     subscribers, 'bench@example.com',
+                                     'bench')
+
+
+def bench(messages, batch_size, workers, fail_every):
+    """Sends the messages to a new FakeMailjet
+
+    Args:
+        messages (list): the messages to send
+        batch_size (int): the most messages per call
+        workers (int): the number of calls in flight at once
+        fail_every (int): answer every nth call with a 429. Zero never fails.
+
+    Returns:
+        tuple: the seconds taken, calls received and messages delivered
+    """
+    fake = FakeMailjet(LATENCY, fail_every)
+    os.environ.update(MAILJET_API_URL=fake.url,
+                      MAILJET_BATCH_SIZE=str(batch_size),
+                      MAILJET_WORKERS=str(workers))
+    # a new client picks up the stand-in's url
+    clients._clients.pop('mailjet', None)
+    start = time.perf_counter()
+    try:
+        dispatch.dispatch(messages)
+    finally:
+        seconds = time.perf_counter() - start
+        fake.close()
+    return seconds, fake.calls, fake.messages
+
+
+if __name__ == '__main__':
+    # retries are logged as warnings
+    logging.getLogger().setLevel(logging.ERROR)
+    run_stats.logger.setLevel(logging.WARNING)
+    os.environ.update(api_key='bench', api_secret='bench',
+                      MAILJET_REQUESTS_PER_SECOND='0', REQUEST_BACKOFF='0.01')
+    messages = build_messages(SUBSCRIBERS)
+    print('{:>6} {:>8} {:>11} {:>9} {:>7} {:>9} {:>11}'.format(
+        'batch', 'workers', 'fail every', 'seconds', 'calls', 'messages',
+        'messages/s'))
+    for batch_size, workers, fail_every in SETTINGS:
+        seconds, calls, delivered = bench(messages, batch_size, workers,
+                                          fail_every)
+        print('{:>6} {:>8} {:>11} {:>9.2f} {:>7} {:>9} {:>11.0f}'.format(
+            batch_size, workers, fail_every or '-', seconds, calls, delivered,
+            delivered / seconds))
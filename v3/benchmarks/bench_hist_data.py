@@ -0,0 +1,84 @@
+"""Micro-benchmark comparing the per-cell rounding previously used to shape
+Yahoo data against the vectorized shape_hist_data.
+
+Run from the v3 folder: python benchmarks/bench_hist_data.py
+"""
+import os
+import sys
+import timeit
+import numpy as np
+import pandas as pd
+# main lives in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+
+def synthetic_history(years, seed=0, end='2021-12-31'):
+    """Builds a random daily history shaped like Yahoo's output
+
+    Args:
+        years (int): the number of years of business days to build
+        seed (int): seed for the random number generator
+        end (str): the last date in the history
+
+    Returns:
+        df: the history indexed by date
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(end=end, periods=years * 252, name='Date')
+    close = 30 * np.exp(np.cumsum(rng.normal(0, 0.01, len(dates))))
+    divs = np.where(np.arange(len(dates)) % 63 == 0, 0.25, 0.0)
+    return pd.DataFrame({'Open': close, 'High': close * 1.01,
+                         'Low': close * 0.99, 'Close': close,
+                         'Adj Close': close * 0.95,
+                         'Volume': rng.integers(1e4, 1e6, len(dates)),
+                         'Dividends': divs, 'Stock Splits': 0.0},
+                        index=dates)
+
+
+def legacy_shape_hist_data(stock_data, ticker, start_dt):
+    """The previous implementation, kept for comparison
+    """
+    stock_data = stock_data.loc[stock_data.index >= start_dt]
+    stock_data = stock_data.reset_index()
+    df_price_cols = ['Date', 'Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
+    df_price = stock_data[df_price_cols].copy()
+    df_price.insert(0, 'Ticker', ticker)
+    price_float_cols = df_price.columns.drop(['Ticker', 'Date', 'Volume'])
+    for col in price_float_cols:
+        df_price.loc[:, col] = df_price.loc[:, col].apply(lambda x: round(x, 2))
+    df_div_cols = ['Date', 'Dividends']
+    df_div = stock_data.loc[stock_data.Dividends > 0, df_div_cols].copy()
+    df_div.insert(0, 'Ticker', ticker)
+    df_div.loc[:, 'Dividends'] = df_div.loc[:, 'Dividends'].apply(lambda x: round(x, 2))
+    return (df_price, df_div)
+
+
+def bench(years, number=5):
+    """Times both implementations on a history of the passed length
+
+    Args:
+        years (int): the number of years of history to shape
+        number (int): the number of runs to average over
+
+    Returns:
+        tuple: the mean seconds per run for the legacy and new versions
+    """
+    stock_data = synthetic_history(years)
+    start_dt = stock_data.index[0].strftime('%Y-%m-%d')
+    legacy = timeit.timeit(
+        lambda: legacy_shape_hist_data(stock_data, 'VCN.TO', start_dt),
+        number=number) / number
+    new = timeit.timeit(
+        lambda: main.shape_hist_data(stock_data, 'VCN.TO', start_dt),
+        number=number) / number
+    return legacy, new
+
+
+if __name__ == '__main__':
+    print('{:>6} {:>12} {:>12} {:>8}'.format('years', 'legacy (ms)',
+                                             'new (ms)', 'speedup'))
+    for years in [1, 5, 20, 30]:
+        legacy, new = bench(years)
+        print('{:>6} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+            years, legacy * 1000, new * 1000, legacy / new))
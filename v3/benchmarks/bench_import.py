@@ -0,0 +1,67 @@
+"""Benchmark of the time taken to import main, which is paid on every cold
+start of the Cloud Function.
+
+Each measurement runs a new Python process so nothing is already imported.
+Importing main is compared against importing every dependency it used to
+import up front. The heavy dependencies main loads on import are also listed;
+the rest are imported the first time they are used.
+
+Run from the v3 folder: python benchmarks/bench_import.py
+"""
+import os
+import sys
+import time
+import statistics
+import subprocess
+
+
+V3_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# dependencies which take a noticeable time to import
+HEAVY_MODULES = ['pandas', 'yaml', 'yfinance', 'google.cloud.bigquery',
+                 'pyarrow', 'mailjet_rest']
+# what main imported on load before imports were made lazy
+EAGER_IMPORTS = 'import main, ' + ', '.join(HEAVY_MODULES)
+
+
+def time_import(statement, runs=5):
+    """Times a statement in new Python processes
+
+    Args:
+        statement (str): the Python to run
+        runs (int): the number of processes to run
+
+    Returns:
+        float: the median seconds per process
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], cwd=V3_DIR,
+                       check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def loaded_modules(statement):
+    """Lists the heavy dependencies loaded by a statement
+
+    Args:
+        statement (str): the Python to run
+
+    Returns:
+        list: the HEAVY_MODULES in sys.modules after running the statement
+    """
+    check = '{}; import sys; print(",".join(m for m in {} if m in sys.modules))'
+    result = subprocess.run(
+        [sys.executable, '-c', check.format(statement, HEAVY_MODULES)],
+        cwd=V3_DIR, check=True, capture_output=True, text=True)
+    return [name for name in result.stdout.strip().split(',') if name]
+
+
+if __name__ == '__main__':
+    print('{:<36} {:>10} {}'.format('statement', 'seconds', 'heavy modules'))
+    for statement in ['pass', EAGER_IMPORTS, 'import main']:
+        seconds = time_import(statement)
+        label = statement if len(statement) <= 36 else statement[:33]+'...'
+        print('{:<36} {:>10.3f} {}'.format(
+            label, seconds, ', '.join(loaded_modules(statement))))
@@ -0,0 +1,57 @@
+"""Benchmark of the partitioned and clustered table layout on the local
+SQLite backend, which stands in for it with an index on snap_date.
+
+A synthetic universe is loaded into an in memory SQLite backend, migrated with
+table_layout.migrate_table and the queries in table_layout.SCAN_QUERIES are
+measured against the backup tables and the migrated ones. SQLite reports
+steps rather than bytes, so compare the share saved.
+
+Run from the v3 folder: python benchmarks/bench_layout.py
+Pass tickers:years to pick the universe, e.g.
+python benchmarks/bench_layout.py 1000:10
+"""
+import os
+import sys
+import pandas as pd
+# table_layout lives in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+import storage
+import table_layout
+from standins import synthetic_histories
+
+
+PRICE_TABLE_NAME = 'prices'
+DIV_TABLE_NAME = 'divs'
+
+
+def seed_backend(n_tickers, years):
+    """Loads a synthetic universe into a new in memory backend
+
+    Args:
+        n_tickers (int): the number of tickers
+        years (int): the years of history of each ticker
+
+    Returns:
+        SQLiteBackend: the backend holding the price and dividend tables
+    """
+    backend = storage.SQLiteBackend(':memory:')
+    backend.create_tables(PRICE_TABLE_NAME, DIV_TABLE_NAME)
+    shaped = [main.shape_hist_data(data, ticker, data.index[0])
+              for ticker, data in synthetic_histories(n_tickers,
+                                                      years).items()]
+    backend.write(pd.concat([price for price, _ in shaped]), PRICE_TABLE_NAME)
+    backend.write(pd.concat([div for _, div in shaped]), DIV_TABLE_NAME)
+    return backend
+
+
+if __name__ == '__main__':
+    n_tickers, years = [int(value) for value in
+                        (sys.argv[1] if len(sys.argv) > 1 else '100:10')
+                        .split(':')]
+    backend = seed_backend(n_tickers, years)
+    for table_name in [PRICE_TABLE_NAME, DIV_TABLE_NAME]:
+        table_layout.migrate_table(backend, table_name)
+    print('{} tickers, {} years'.format(n_tickers, years))
+    print(table_layout.scan_report(backend, PRICE_TABLE_NAME, DIV_TABLE_NAME)
+          .to_string(index=False))
@@ -0,0 +1,350 @@
+"""Benchmark of each stage of the daily pipeline using local stand-ins for
+Yahoo, BigQuery and Mailjet (see standins.py).
+
+Each universe is loaded into an in memory SQLite backend up to ten business
+days before the end of its history, as if the last run was two weeks ago.
+The stages then pull and report on the rest. Every stage is run twice: once
+to time it and count the queries and Yahoo requests it makes, and once under
+tracemalloc to find its peak memory.
+
+Run from the v3 folder: python benchmarks/bench_pipeline.py
+Universes are passed as tickers:years, e.g.
+python benchmarks/bench_pipeline.py --universe 10:2 --universe 1000:30
+Pass --json to also write the results to a file so runs can be compared.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import datetime as dt
+import pandas as pd
+import yaml
+# main lives in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+import storage
+import tr_index
+import run_stats
+import validation
+from throttle import RateLimiter
+from standins import (recorded_histories, synthetic_histories, FixtureSource,
+                      CountingBackend, Outbox)
+
+
+PRICE_TABLE_NAME = 'prices'
+DIV_TABLE_NAME = 'divs'
+# universes run when none are passed, as (tickers, years)
+DEFAULT_UNIVERSES = [(10, 2), (10, 30), (100, 5), (1000, 2)]
+# number of tickers the one ticker at a time ticker_return is run for
+LEGACY_TICKERS = 10
+
+
+def ticker_return(new_max_dt, ticker, price_table_name, backend,
+                  div_table_name):
+    """Takes in a ticker and calculates the 1 year return with five queries,
+       as the daily run did before returns were calculated for every ticker
+       at once
+
+    Args:
+        new_max_dt (datetime): the min max date in the database
+        ticker (str): the ticker to pull data from
+        price_table_name (str): the table to pull stock data from
+        backend (storage backend): open backend to use for querying
+        div_table_name (str): the table to pull dividend data from
+
+    Returns:
+        float: the 1 year total return
+    """
+    logging.info(ticker)
+    end_dt = new_max_dt.replace(day=1)
+    start_dt = end_dt.replace(year=end_dt.year-1)
+    end_dt = backend.run('max_date_where.sql', [price_table_name],
+                         {'snap_date': end_dt, 'ticker': ticker})
+    end_dt = end_dt['max_dt'].iloc[0]
+    start_dt = backend.run('max_date_where.sql', [price_table_name],
+                           {'snap_date': start_dt, 'ticker': ticker})
+    start_dt = start_dt['max_dt'].iloc[0]
+    # get the closing values on the start and end dates
+    end_close = backend.run('close_value.sql', [price_table_name],
+                            {'ticker': ticker, 'snap_date': end_dt})
+    end_close = end_close['close'].iloc[0]
+    start_close = backend.run('close_value.sql', [price_table_name],
+                              {'ticker': ticker, 'snap_date': start_dt})
+    start_close = start_close['close'].iloc[0]
+    # get total dividends paid out during the year
+    divs = backend.run('divs.sql', [div_table_name],
+                       {'ticker': ticker, 'start_dt': start_dt,
+                        'end_dt': end_dt})
+    divs = divs['TOT_AMT'].iloc[0]
+    # calculate the return
+    total_return = (end_close / (start_close - divs) - 1) * 100
+    return total_return
+
+
+def compute_returns(new_max_dt, tickers, price_table_name, backend,
+                    div_table_name):
+    """Calculates the 1 year total return for every ticker in a single query,
+       as the daily run did before returns were read from the total return
+       index
+
+    Args:
+        new_max_dt (datetime): the min max date in the database
+        tickers (list): the tickers to return results for
+        price_table_name (str): the table to pull stock data from
+        backend (storage backend): open backend to use for querying
+        div_table_name (str): the table to pull dividend data from
+
+    Returns:
+        Series: maps between stock tickers and 1-year total returns
+    """
+    end_dt = new_max_dt.replace(day=1)
+    start_dt = end_dt.replace(year=end_dt.year-1)
+    rows = backend.run('returns.sql', [price_table_name, div_table_name],
+                       {'start_dt': start_dt, 'end_dt': end_dt})
+    rows = rows.set_index('ticker').reindex(tickers)
+    return (rows['end_close'] / (rows['start_close'] - rows['tot_amt']) -
+            1) * 100
+
+
+def seed_backend(histories, cutoff):
+    """Loads histories up to a date into a new backend, along with the
+       total return index
+
+    Args:
+        histories (dict): maps between tickers and their histories
+        cutoff (Timestamp): the last date to load
+
+    Returns:
+        CountingBackend: the backend with its counts reset
+    """
+    backend = CountingBackend()
+    backend.create_tables(PRICE_TABLE_NAME, DIV_TABLE_NAME)
+    shaped = [main.shape_hist_data(data.loc[data.index <= cutoff], ticker,
+                                   data.index[0])
+              for ticker, data in histories.items()]
+    backend.write(pd.concat([price for price, _ in shaped]), PRICE_TABLE_NAME)
+    backend.write(pd.concat([div for _, div in shaped]), DIV_TABLE_NAME)
+    tr_index.rebuild_tr_index(backend, PRICE_TABLE_NAME, DIV_TABLE_NAME)
+    backend.queries = 0
+    backend.rows_written = 0
+    return backend
+
+
+class Universe:
+    """A set of histories and everything needed to run the stages on them
+
+    Args:
+        name (str): the name reported for the universe
+        histories (dict): maps between tickers and their histories
+    """
+
+    def __init__(self, name, histories):
+        self.name = name
+        self.histories = histories
+        self.tickers = list(histories)
+        last_dates = sorted(data.index[-1] for data in histories.values())
+        self.end = last_dates[-1]
+        self.cutoff = pd.bdate_range(end=self.end, periods=11)[0]
+        self.pull_dt = self.cutoff - dt.timedelta(days=7)
+        self.name_mapping = {ticker[:-3]: ticker for ticker in self.tickers}
+        self.backend = seed_backend(histories, self.cutoff)
+        self.hist_data = {ticker: main.shape_hist_data(data, ticker,
+                                                       self.pull_dt)
+                          for ticker, data in histories.items()}
+
+    def context(self, fresh=False):
+        """Patches the stand-ins into main and returns them
+
+        Args:
+            fresh (bool): if True, seed a new backend rather than reusing the
+                shared one. Needed by stages which write.
+
+        Returns:
+            dict: the backend, source and outbox used by the stage
+        """
+        backend = seed_backend(self.histories, self.cutoff) if fresh \
+            else self.backend
+        backend.results.clear()
+        backend.queries = 0
+        backend.rows_written = 0
+        source = FixtureSource(self.histories)
+        outbox = Outbox()
+        main.yf = source
+        main.eh.send_email = outbox.send_email
+        storage.get_backend = lambda price, div: backend
+        return {'backend': backend, 'source': source, 'outbox': outbox}
+
+
+def stage_get_hist_data(universe, ctx):
+    """Pulls each ticker on its own, as done for tickers missing from a batch
+    """
+    for ticker in universe.tickers:
+        main.get_hist_data(universe.pull_dt, ticker)
+
+
+def stage_get_batch_hist_data(universe, ctx):
+    """Pulls the tickers in batches, as done at the start of each run
+    """
+    pull_dts = dict.fromkeys(universe.tickers, universe.pull_dt)
+    main.get_batch_hist_data(pull_dts, 100, RateLimiter(0))
+
+
+def stage_validate(universe, ctx):
+    """Checks the data pulled for every ticker at once, as done before
+       each bulk merge
+    """
+    validation.validate(universe.hist_data, 0.3, 0.5)
+
+
+def stage_ticker_return(universe, ctx):
+    """Calculates returns one ticker at a time for LEGACY_TICKERS tickers
+    """
+    for ticker in universe.tickers[:LEGACY_TICKERS]:
+        ticker_return(universe.end, ticker, PRICE_TABLE_NAME,
+                      ctx['backend'], DIV_TABLE_NAME)
+
+
+def stage_compute_returns(universe, ctx):
+    """Calculates returns for every ticker in one query
+    """
+    compute_returns(universe.end, universe.tickers, PRICE_TABLE_NAME,
+                    ctx['backend'], DIV_TABLE_NAME)
+
+
+def stage_compose_summary_email(universe, ctx):
+    """Builds the monthly email from returns calculated up front
+    """
+    main.compose_summary_email(universe.pct, universe.name_mapping)
+
+
+def stage_main_kickoff(universe, ctx):
+    """Runs the whole pipeline from a stocks.yaml listing the universe
+    """
+    with tempfile.TemporaryDirectory() as run_dir:
+        with open(os.path.join(run_dir, 'stocks.yaml'), 'w') as yaml_file:
+            yaml.dump({'tickers': universe.tickers,
+                       'mapping': universe.name_mapping}, yaml_file)
+        cwd = os.getcwd()
+        os.chdir(run_dir)
+        try:
+            main.main_kickoff()
+        finally:
+            os.chdir(cwd)
+    if not ctx['outbox'].sent:
+        raise RuntimeError('main_kickoff did not send the monthly email')
+
+
+# stages in the order they are run, with whether they need a fresh backend
+STAGES = [
+    ('get_hist_data', stage_get_hist_data, False),
+    ('get_batch_hist_data', stage_get_batch_hist_data, False),
+    ('validate', stage_validate, False),
+    ('ticker_return', stage_ticker_return, False),
+    ('compute_returns', stage_compute_returns, False),
+    ('compose_summary_email', stage_compose_summary_email, False),
+    ('main_kickoff', stage_main_kickoff, True),
+]
+
+
+def measure(universe, stage, fresh):
+    """Runs a stage once to time it and once to find its peak memory
+
+    Args:
+        universe (Universe): the universe to run the stage on
+        stage (function): the stage, taking the universe and the context
+        fresh (bool): if True, each run gets a newly seeded backend
+
+    Returns:
+        dict: the seconds taken, peak memory in MB, queries run, rows written,
+            Yahoo requests made and emails sent
+    """
+    ctx = universe.context(fresh)
+    start = time.perf_counter()
+    stage(universe, ctx)
+    seconds = time.perf_counter() - start
+    result = {'seconds': seconds,
+              'queries': ctx['backend'].queries,
+              'rows_written': ctx['backend'].rows_written,
+              'requests': ctx['source'].requests,
+              'emails': len(ctx['outbox'].sent)}
+    ctx = universe.context(fresh)
+    tracemalloc.start()
+    stage(universe, ctx)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result['peak_mb'] = peak / 2**20
+    return result
+
+
+def bench_universe(universe):
+    """Runs every stage on a universe
+
+    Args:
+        universe (Universe): the universe to benchmark
+
+    Returns:
+        list: one dict per stage with the universe, stage and measurements
+    """
+    universe.pct = compute_returns(universe.end, universe.tickers,
+                                   PRICE_TABLE_NAME, universe.backend,
+                                   DIV_TABLE_NAME)
+    results = []
+    for name, stage, fresh in STAGES:
+        result = {'universe': universe.name, 'stage': name}
+        result.update(measure(universe, stage, fresh))
+        results.append(result)
+    return results
+
+
+def parse_universe(text):
+    """Parses a universe passed as tickers:years
+
+    Args:
+        text (str): the universe, e.g. 100:5
+
+    Returns:
+        tuple: the number of tickers and years
+    """
+    n_tickers, years = text.split(':')
+    # ticker_return needs a close from before the start of its 1 year window
+    if int(years) < 2:
+        raise argparse.ArgumentTypeError('universes need at least 2 years')
+    return int(n_tickers), int(years)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--universe', action='append', type=parse_universe,
+                        help='tickers:years of a synthetic universe to run')
+    parser.add_argument('--json', help='file to write the results to')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    run_stats.logger.setLevel(logging.WARNING)
+    os.environ.update(PRICE_TABLENAME=PRICE_TABLE_NAME,
+                      DIVIDEND_TABLENAME=DIV_TABLE_NAME,
+                      YF_REQUESTS_PER_SECOND='0',
+                      contact_email='bench@example.com',
+                      contact_name='bench')
+    os.environ.pop('PRICE_CACHE_DIR', None)
+    universes = [('VCN.TO recorded', recorded_histories)]
+    universes += [('{}x{}y'.format(n_tickers, years),
+                   lambda n=n_tickers, y=years: synthetic_histories(n, y))
+                  for n_tickers, years in args.universe or DEFAULT_UNIVERSES]
+    results = []
+    print('{:<16} {:<22} {:>9} {:>9} {:>8} {:>9} {:>8}'.format(
+        'universe', 'stage', 'seconds', 'peak MB', 'queries', 'rows',
+        'requests'))
+    for name, build in universes:
+        for result in bench_universe(Universe(name, build())):
+            print('{:<16} {:<22} {:>9.3f} {:>9.1f} {:>8} {:>9} {:>8}'.format(
+                result['universe'], result['stage'], result['seconds'],
+                result['peak_mb'], result['queries'], result['rows_written'],
+                result['requests']))
+            results.append(result)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
@@ -0,0 +1,86 @@
+"""Micro-benchmark comparing the summary email previously built with pandas
+against report.render_summary, which only ranks and renders the top and
+bottom REPORT_TOP_K tickers.
+
+Run from the v3 folder: python benchmarks/bench_report.py
+"""
+import os
+import sys
+import timeit
+import numpy as np
+import pandas as pd
+# report lives in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import report
+
+
+def synthetic_returns(n_tickers, seed=0):
+    """Builds random returns and names for a universe of tickers
+
+    Args:
+        n_tickers (int): the number of tickers
+        seed (int): seed for the random number generator
+
+    Returns:
+        tuple: the returns as a Series and the mapping of names
+    """
+    rng = np.random.default_rng(seed)
+    tickers = ['T{:05d}.TO'.format(i) for i in range(n_tickers)]
+    pct = pd.Series(rng.normal(8, 15, n_tickers), index=tickers)
+    name_mapping = {ticker[:-3]: 'Fund {}'.format(ticker[1:-3])
+                    for ticker in tickers}
+    return pct, name_mapping
+
+
+def legacy_compose_summary_email(pct, name_mapping):
+    """The previous implementation, kept for comparison
+    """
+    pct_nice_name = {}
+    for key in pct.keys():
+        pct_nice_name[key[:-3]] = pct[key]
+    highest_return_ticker = max(pct_nice_name, key=pct_nice_name.get)
+    highest_return = pct_nice_name[highest_return_ticker]
+    df_pct = pd.DataFrame(data=pct_nice_name, index=['YTD'])
+    df_pct = df_pct.round(2)
+    df_name = pd.DataFrame(data=name_mapping, index=['Desc'])
+    df_tot = df_pct.transpose().merge(right=df_name.transpose(),
+                                      left_index=True, right_index=True)
+    df_tot = df_tot.sort_values(by='YTD', ascending=False).transpose()
+    summary_table = df_tot.to_html()
+    subject = "{} has the highest returns".format(highest_return_ticker)
+    body = "<h3>Today's leader is {} at {}.</h3><br />Summary:<br />{}".format(highest_return_ticker, highest_return.round(2), summary_table)
+    return subject, body
+
+
+def bench(n_tickers, number=5):
+    """Times both implementations on a universe of the passed size
+
+    Args:
+        n_tickers (int): the number of tickers to report on
+        number (int): the number of runs to average over
+
+    Returns:
+        tuple: the mean seconds per run and body size in KB for the legacy
+            and new versions
+    """
+    pct, name_mapping = synthetic_returns(n_tickers)
+    legacy = timeit.timeit(
+        lambda: legacy_compose_summary_email(pct, name_mapping),
+        number=number) / number
+    new = timeit.timeit(
+        lambda: report.render_summary(pct, name_mapping, 10),
+        number=number) / number
+    legacy_kb = len(legacy_compose_summary_email(pct, name_mapping)[1]) / 1024
+    new_kb = len(report.render_summary(pct, name_mapping, 10)[1]) / 1024
+    return legacy, new, legacy_kb, new_kb
+
+
+if __name__ == '__main__':
+    print('{:>8} {:>12} {:>12} {:>8} {:>10} {:>10}'.format(
+        'tickers', 'legacy (ms)', 'new (ms)', 'speedup', 'legacy KB',
+        'new KB'))
+    for n_tickers in [10, 1000, 10000]:
+        legacy, new, legacy_kb, new_kb = bench(n_tickers)
+        print('{:>8} {:>12.2f} {:>12.2f} {:>7.1f}x {:>10.1f} {:>10.1f}'.format(
+            n_tickers, legacy * 1000, new * 1000, legacy / new, legacy_kb,
+            new_kb))
@@ -0,0 +1,253 @@
+"""Local stand-ins for Yahoo, BigQuery and Mailjet used to benchmark the
+pipeline without calling any of them, plus the fixtures they serve.
+
+    FixtureSource: replaces the yfinance module, serving recorded or
+        synthetic histories and counting requests
+    CountingBackend: an in memory SQLite backend which counts the queries
+        run and rows written
+    Outbox: replaces send_email, keeping the emails instead of sending them
+    FakeMailjet: a local HTTP server answering like Mailjet's send API, for
+        timing real sends through the Mailjet client
+"""
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+# storage lives in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import storage
+from bench_hist_data import synthetic_history
+
+
+# folder holding the files recorded from Yahoo
+RECORDED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', '..', 'return_investigation')
+
+
+def recorded_histories(folder=RECORDED_DIR):
+    """Builds the VCN.TO history from the files recorded from Yahoo
+
+    Args:
+        folder (str): the folder holding VCN.TO.csv and dividends.csv
+
+    Returns:
+        dict: maps between the ticker and its history indexed by date
+    """
+    values = pd.read_csv(os.path.join(folder, 'VCN.TO.csv'),
+                         parse_dates=['Date'], index_col='Date')
+    dividends = pd.read_csv(os.path.join(folder, 'dividends.csv'),
+                            parse_dates=['Date'], index_col='Date')
+    values['Dividends'] = dividends['Amount'].reindex(values.index,
+                                                      fill_value=0.0)
+    values['Stock Splits'] = 0.0
+    return {'VCN.TO': values}
+
+
+def synthetic_histories(n_tickers, years, end='2022-01-07'):
+    """Builds random histories for a universe of tickers
+
+    Args:
+        n_tickers (int): the number of tickers
+        years (int): the number of years of business days per ticker
+        end (str): the last date in each history
+
+    Returns:
+        dict: maps between tickers and their histories indexed by date
+    """
+    return {'T{}.TO'.format(i): synthetic_history(years, seed=i, end=end)
+            for i in range(n_tickers)}
+
+
+class FixtureSource:
+    """Stands in for the yfinance module. Only Ticker().history and
+       download are provided.
+
+    Args:
+        histories (dict): maps between tickers and their histories indexed
+            by date
+    """
+
+    def __init__(self, histories):
+        self.histories = histories
+        self.requests = 0
+
+    def Ticker(self, ticker):
+        """Returns an object whose history method serves one ticker
+
+        Args:
+            ticker (str): the ticker to serve
+
+        Returns:
+            FixtureTicker: the stand-in for yf.Ticker
+        """
+        return FixtureTicker(self, ticker)
+
+    def history(self, ticker, start):
+        """Returns the history of one ticker from a date onwards
+
+        Args:
+            ticker (str): the ticker to serve
+            start (str): the first date to return
+
+        Returns:
+            df: the history. Empty if the ticker isn't known.
+        """
+        self.requests += 1
+        data = self.histories.get(ticker)
+        if data is None:
+            return pd.DataFrame()
+        return data.loc[data.index >= start].copy()
+
+    def download(self, tickers, start=None, **kwargs):
+        """Returns the history of several tickers grouped by ticker, the
+           same layout as yf.download(group_by='ticker')
+
+        Args:
+            tickers (list): the tickers to serve
+            start (str): the first date to return
+
+        Returns:
+            df: the histories with (ticker, column) columns
+        """
+        self.requests += 1
+        frames = {ticker: self.histories[ticker] for ticker in tickers
+                  if ticker in self.histories}
+        data = pd.concat(frames, axis=1)
+        return data.loc[data.index >= start]
+
+
+class FixtureTicker:
+    """Stands in for yf.Ticker
+
+    Args:
+        source (FixtureSource): the source serving the data
+        ticker (str): the ticker to serve
+    """
+
+    def __init__(self, source, ticker):
+        self.source = source
+        self.ticker = ticker
+
+    def history(self, start=None, **kwargs):
+        """Returns the ticker's history from start onwards
+
+        Args:
+            start (str): the first date to return
+
+        Returns:
+            df: the history indexed by date
+        """
+        return self.source.history(self.ticker, start)
+
+
+class CountingBackend(storage.SQLiteBackend):
+    """In memory SQLite backend which counts the work done against it
+    """
+
+    def __init__(self):
+        super().__init__(':memory:')
+        self.queries = 0
+        self.rows_written = 0
+
+    def query(self, sql, params=None):
+        """Runs the passed SQL, counting it. See SQLiteBackend.query.
+        """
+        self.queries += 1
+        return super().query(sql, params)
+
+    def write(self, data, table_name):
+        """Writes a dataframe, counting the rows. See SQLiteBackend.write.
+        """
+        self.rows_written += len(data)
+        super().write(data, table_name)
+
+    def load(self, data, table_name):
+        """Loads a dataframe, counting the rows. See SQLiteBackend.load.
+        """
+        self.rows_written += len(data)
+        super().load(data, table_name)
+
+
+class Outbox:
+    """Stands in for email_helpers.send_email, keeping what is sent
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send_email(self, email, limiter=None):
+        """Keeps a composed email rather than sending it
+
+        Args:
+            email (dict): the email in the format used by Mailjet's API
+            limiter (RateLimiter): not used
+        """
+        self.sent.append(email)
+
+
+class FakeMailjet:
+    """Serves Mailjet's send API on localhost in a background thread,
+       counting the calls and messages it receives. Point the Mailjet client
+       at it by setting MAILJET_API_URL to url.
+
+    Args:
+        latency (float): seconds each call takes to answer
+        fail_every (int): answer every nth call with a 429 so retries are
+            exercised. Zero never fails.
+    """
+
+    def __init__(self, latency=0.0, fail_every=0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.calls = 0
+        self.messages = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def handler(self):
+        """Builds the request handler class bound to this server
+
+        Returns:
+            class: the handler
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                messages = json.loads(self.rfile.read(length))['Messages']
+                time.sleep(fake.latency)
+                with fake.lock:
+                    fake.calls += 1
+                    failed = fake.fail_every and \
+                        fake.calls % fake.fail_every == 0
+                    if not failed:
+                        fake.messages += len(messages)
+                status = 429 if failed else 200
+                body = json.dumps({'ErrorMessage': 'Too many requests'}
+                                  if failed else
+                                  {'Messages': [{'Status': 'success'}
+                                                for _ in messages]})
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        """Stops the server
+        """
+        self.server.shutdown()
+        self.server.server_close()
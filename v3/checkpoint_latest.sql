@@ -0,0 +1,2 @@
+SELECT MAX(run_id) AS run_id
+FROM {};
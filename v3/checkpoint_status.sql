@@ -0,0 +1,11 @@
+SELECT cp.ticker, cp.shard, cp.pull_dt, cp.status, cp.attempt
+FROM {0} AS cp
+JOIN (
+  SELECT ticker, MAX(attempt) AS max_attempt
+  FROM {0}
+  WHERE run_id = @run_id
+  GROUP BY ticker
+) AS latest
+  ON latest.ticker = cp.ticker
+  AND latest.max_attempt = cp.attempt
+WHERE cp.run_id = @run_id;
@@ -0,0 +1,2 @@
+delete FROM {}
+where snap_date > '2000-01-01';
@@ -0,0 +1,156 @@
+"""Clients for BigQuery and Mailjet shared by the whole process.
+
+Each client holds an HTTP session which keeps its connections open, so using
+one client for every call saves opening a new connection and TLS handshake
+each time. Clients are created the first time they're needed and kept for the
+life of the process so warm starts of the Cloud Function reuse them too.
+
+Timeouts and retries are set by the following environment variables:
+    REQUEST_TIMEOUT: seconds to wait on each HTTP request. Defaults to 60.
+    REQUEST_RETRIES: times a call failing with a transient error is retried.
+        Defaults to 3.
+    REQUEST_BACKOFF: seconds to wait before the first retry. The wait doubles
+        with each retry. Defaults to 1.
+"""
+import os
+import time
+import random
+import logging
+import threading
+import run_stats
+
+
+# HTTP statuses which are worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def request_timeout():
+    """Returns the seconds to wait on each HTTP request
+
+    Returns:
+        float: the REQUEST_TIMEOUT setting
+    """
+    return float(os.environ.get('REQUEST_TIMEOUT', 60))
+
+
+def request_backoff():
+    """Returns the seconds to wait before the first retry
+
+    Returns:
+        float: the REQUEST_BACKOFF setting
+    """
+    return float(os.environ.get('REQUEST_BACKOFF', 1))
+
+
+def get_client(name, create):
+    """Returns the shared client with the passed name, creating it if needed
+
+    Args:
+        name (str): the name the client is kept under
+        create (function): takes no arguments and returns a new client
+
+    Returns:
+        the shared client
+    """
+    with _lock:
+        if name not in _clients:
+            _clients[name] = create()
+        return _clients[name]
+
+
+def bigquery_client():
+    """Returns the shared BQ client. The BQ libraries are imported the first
+       time it's needed so runs which don't use BigQuery don't pay for them.
+
+    Returns:
+        client: client to connect to BQ.
+    """
+    def create():
+        from google.cloud import bigquery
+        return bigquery.Client()
+    return get_client('bigquery', create)
+
+
+def bigquery_retry():
+    """Returns the retry policy used for BQ calls. BQ's own policy is used,
+       which knows which errors are safe to retry, with our backoff.
+
+    Returns:
+        Retry: the retry policy
+    """
+    from google.cloud import bigquery
+    return bigquery.DEFAULT_RETRY.with_delay(initial=request_backoff(),
+                                             multiplier=2)
+
+
+def mailjet_client():
+    """Returns the shared Mailjet client, using the api_key and api_secret
+       environment variables. MAILJET_API_URL points it at another server,
+       e.g. a local stand-in.
+
+    Returns:
+        Client: client to connect to Mailjet
+    """
+    def create():
+        from mailjet_rest import Client
+        return Client(auth=(os.environ['api_key'], os.environ['api_secret']),
+                      version='v3.1',
+                      api_url=os.environ.get('MAILJET_API_URL',
+                                             'https://api.mailjet.com/'))
+    return get_client('mailjet', create)
+
+
+def is_transient(error):
+    """Returns whether an error is likely to go away if the call is retried
+
+    Args:
+        error (Exception): the error raised by the call
+
+    Returns:
+        bool: True for connection errors, timeouts and RETRY_STATUS
+            responses, including when raised as the cause of another error
+    """
+    import requests
+    if isinstance(error, (ConnectionError, TimeoutError,
+                          requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout)):
+        return True
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code',
+                     getattr(error, 'status_code', getattr(error, 'code',
+                                                           None)))
+    if status in RETRY_STATUS:
+        return True
+    # client libraries may wrap the connection error they hit
+    return error.__cause__ is not None and is_transient(error.__cause__)
+
+
+def call_with_retry(func, *args, retry_if=is_transient, **kwargs):
+    """Calls a function, retrying transient errors with exponential backoff.
+       Each wait is jittered so clients retrying at once spread out.
+
+    Args:
+        func (function): the function to call
+        *args: positional arguments passed to func
+        retry_if (function): takes the error raised and returns whether to
+            retry. Defaults to is_transient.
+        **kwargs: keyword arguments passed to func
+
+    Returns:
+        the result of func
+    """
+    retries = int(os.environ.get('REQUEST_RETRIES', 3))
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as error:
+            if attempt == retries or not retry_if(error):
+                raise
+            wait = request_backoff() * 2 ** attempt * random.uniform(0.5, 1)
+            logging.warning('Retrying {} in {:.1f}s after: {}'.format(
+                func.__name__, wait, error))
+            run_stats.record(retries=1)
+            time.sleep(wait)
@@ -1,3 +1,3 @@
 select close
 FROM {}
-WHERE ticker = {} and snap_date = {};
+WHERE ticker = @ticker and snap_date = @snap_date;
@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS {0} (
+  run_id STRING,
+  shard INT64,
+  ticker STRING,
+  pull_dt DATETIME,
+  status STRING,
+  attempt INT64,
+  updated_at DATETIME
+);
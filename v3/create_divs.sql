@@ -0,0 +1,7 @@
+CREATE TABLE IF NOT EXISTS {0} (
+  ticker STRING,
+  snap_date DATETIME,
+  amount FLOAT64
+)
+PARTITION BY DATETIME_TRUNC(snap_date, MONTH)
+CLUSTER BY ticker;
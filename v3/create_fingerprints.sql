@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS {0} (
+  ticker STRING,
+  max_dt DATETIME,
+  content_hash STRING
+);
@@ -0,0 +1 @@
+CREATE TABLE IF NOT EXISTS {0} LIKE {1};
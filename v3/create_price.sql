@@ -0,0 +1,12 @@
+CREATE TABLE IF NOT EXISTS {0} (
+  ticker STRING,
+  snap_date DATETIME,
+  open FLOAT64,
+  high FLOAT64,
+  low FLOAT64,
+  close FLOAT64,
+  close_adj FLOAT64,
+  volume INT64
+)
+PARTITION BY DATETIME_TRUNC(snap_date, MONTH)
+CLUSTER BY ticker;
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS {0} (
+  ticker STRING,
+  snap_date DATETIME,
+  kind STRING,
+  value FLOAT64,
+  reason STRING,
+  found_at DATETIME
+);
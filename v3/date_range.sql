@@ -0,0 +1,2 @@
+SELECT MIN(snap_date) AS min_dt, MAX(snap_date) AS max_dt
+FROM {};
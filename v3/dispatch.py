@@ -0,0 +1,152 @@
+"""Code used to send the monthly report to every subscriber.
+
+Subscribers are listed in stocks.yaml, each with the portfolios they want:
+
+    subscribers:
+        - email: someone@example.com
+          name: Someone
+          portfolios: [couch_potato]
+        - email: other@example.com
+
+Subscribers without portfolios get every portfolio, while an empty list of
+portfolios is rejected. If no subscribers are listed the report goes to
+contact_email as before. Subscribers wanting the same portfolios share one
+rendered report. Messages are packed into Mailjet's Messages list, up to
+MAILJET_BATCH_SIZE per call, and the calls are made MAILJET_WORKERS at a
+time, limited to MAILJET_REQUESTS_PER_SECOND. Calls which Mailjet answers
+with a 429 or 5xx are retried by email_helpers.send_email.
+"""
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import yaml
+import email_helpers as eh
+import report
+import run_stats
+from throttle import RateLimiter
+
+
+# most messages Mailjet accepts in one call
+MAX_BATCH_MESSAGES = 50
+
+
+def read_subscribers(portfolio_names, file_name='stocks.yaml'):
+    """Reads who the report is sent to and which portfolios each gets
+
+    Args:
+        portfolio_names (list): the names of every portfolio
+        file_name (str): the YAML file listing the subscribers
+
+    Returns:
+        list: one dict per subscriber with their email, name and portfolios
+
+    Raises:
+        ValueError: if a subscriber lists no portfolios or unknown ones
+    """
+    with open(file_name) as yaml_file:
+        data = yaml.load(yaml_file, Loader=yaml.FullLoader)
+    subscribers = data.get('subscribers') or \
+        [{'email': os.environ['contact_email'],
+          'name': os.environ['contact_name']}]
+    subscribers = [{'email': subscriber['email'],
+                    'name': subscriber.get('name', subscriber['email']),
+                    'portfolios': list(subscriber.get('portfolios',
+                                                      portfolio_names))}
+                   for subscriber in subscribers]
+    for subscriber in subscribers:
+        if not subscriber['portfolios']:
+            raise ValueError('No portfolios for {}'.format(
+                subscriber['email']))
+        unknown = set(subscriber['portfolios']) - set(portfolio_names)
+        if unknown:
+            raise ValueError('Unknown portfolios for {}: {}'.format(
+                subscriber['email'], ', '.join(sorted(unknown))))
+    return subscribers
+
+
+def compose_messages(ranked, name_mapping, subscribers, sender_email,
+                     sender_name):
+    """Composes a message for each subscriber with their portfolios
+
+    Args:
+        ranked (df): the output of portfolios.rank_portfolios
+        name_mapping (dict): maps between stock tickers and their definitions
+        subscribers (list): the output of read_subscribers
+        sender_email (str): Email the messages are coming from.
+        sender_name (str): Name the messages are coming from.
+
+    Returns:
+        list: the messages in the MJ format
+    """
+    rendered = {}
+    messages = []
+    for subscriber in subscribers:
+        key = tuple(subscriber['portfolios'])
+        if key not in rendered:
+            rendered[key] = report.render_portfolios(
+                ranked[ranked.portfolio.isin(key)], name_mapping)
+        subject, body = rendered[key]
+        messages.append(eh.message_composition(
+            sender_email, sender_name, subscriber['email'],
+            subscriber['name'], subject, body))
+    return messages
+
+
+def batch_messages(messages, batch_size):
+    """Packs messages into emails of up to batch_size messages
+
+    Args:
+        messages (list): the messages in the MJ format
+        batch_size (int): the most messages per email. Capped at
+            MAX_BATCH_MESSAGES.
+
+    Returns:
+        list: the emails ready for MJ's API
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_MESSAGES))
+    return [{'Messages': messages[start:start+batch_size]}
+            for start in range(0, len(messages), batch_size)]
+
+
+def send_batch(email, limiter):
+    """Sends one email of batched messages, each attempt waiting until the
+       limiter allows it
+
+    Args:
+        email (dict): the batched messages ready for MJ's API
+        limiter (RateLimiter): limits how often we call Mailjet
+    """
+    eh.send_email(email, limiter)
+    run_stats.record(rows=len(email['Messages']))
+
+
+def dispatch(messages):
+    """Sends messages in batches, several batches at a time. A batch which
+       fails doesn't stop the others.
+
+    Args:
+        messages (list): the messages in the MJ format
+
+    Raises:
+        RuntimeError: if any batch failed, once every batch has been tried
+    """
+    batch_size = int(os.environ.get('MAILJET_BATCH_SIZE',
+                                    MAX_BATCH_MESSAGES))
+    max_workers = int(os.environ.get('MAILJET_WORKERS', 4))
+    limiter = RateLimiter(float(os.environ.get('MAILJET_REQUESTS_PER_SECOND',
+                                               5)))
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(send_batch, email, limiter): email
+                   for email in batch_messages(messages, batch_size)}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logging.exception('Failed to send batch')
+                failed += [to['Email'] for message in
+                           futures[future]['Messages']
+                           for to in message['To']]
+    if failed:
+        raise RuntimeError('Failed to send to {} subscribers: {}'.format(
+            len(failed), ', '.join(failed)))
@@ -1,3 +1,3 @@
 SELECT SUM(amount) AS TOT_AMT
 FROM {}
-WHERE ticker = {} AND snap_date > {} AND snap_date <= {};
+WHERE ticker = @ticker AND snap_date > @start_dt AND snap_date <= @end_dt;
@@ -1,14 +1,45 @@
 """Code used to compose emails for and send emails via the MailJet API.
 """
-from mailjet_rest import Client
-import os
 import logging
+import clients
 
 
 # set logging level
 logging.basicConfig(level=logging.INFO)
 
 
+def message_composition(sender_email, sender_name, contact_email,
+                        contact_name, subject, body):
+    """Composes a single message in the MJ format. Several can be sent in
+       one call by listing them under Messages.
+
+    Args:
+        sender_email (str): Email the message is coming from.
+        sender_name (str): Name the message is coming from.
+        contact_email (str): Email the message is going to.
+        contact_name (str): Name the message is going to.
+        subject (str): Subject line for the message
+        body (str): Body of the message. Should be properly formatted HTML.
+
+    Returns:
+        dict: data structure containing the composed message
+    """
+    return {
+        "From": {
+            "Email": sender_email,
+            "Name": sender_name
+        },
+        "To": [
+            {
+                "Email": contact_email,
+                "Name": contact_name
+            }
+        ],
+        "Subject": subject,
+        "HTMLPart": body,
+    }
+
+
 def email_composition(contact_email, contact_name, subject, body):
     """Composes an email in the MJ format. Returns the result
 
@@ -21,34 +52,68 @@ def email_composition(contact_email, contact_name, subject, body):
     Returns:
         dict: data structure containing the composed email ready for MJ's API
     """
-    data = {
-        'Messages': [
-            {
-                "From": {
-                    "Email": contact_email,
-                    "Name": contact_name
-                },
-                "To": [
-                    {
-                        "Email": contact_email,
-                        "Name": contact_name
-                    }
-                ],
-                "Subject": subject,
-                "HTMLPart": body,
-            }
-        ]
-    }
-    return data
+    return {'Messages': [message_composition(contact_email, contact_name,
+                                             contact_email, contact_name,
+                                             subject, body)]}
+
+
+def post_email(email, limiter=None):
+    """Posts a composed email to the mailjet api using the shared client
+
+    Args:
+        email (dict): dict containing all relevant fields needed by the mailjet API
+        limiter (RateLimiter): limits how often we call mailjet. Optional.
+
+    Returns:
+        Response: the response from mailjet
+    """
+    if limiter is not None:
+        limiter.wait()
+    result = clients.mailjet_client().send.create(
+        data=email, timeout=clients.request_timeout())
+    if result.status_code in clients.RETRY_STATUS:
+        # raised so the send is retried
+        result.raise_for_status()
+    return result
+
+
+def is_unsent(error):
+    """Returns whether mailjet answered that it didn't send the email, so it
+       can be retried without sending it twice. Timeouts and dropped
+       connections aren't, as the email may have been sent before the
+       answer was lost.
+
+    Args:
+        error (Exception): the error raised by post_email
+
+    Returns:
+        bool: True for errors carrying a clients.RETRY_STATUS response,
+            including when raised as the cause of another error
+    """
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) in clients.RETRY_STATUS:
+        return True
+    # the mailjet client wraps the HTTPError it hits
+    return error.__cause__ is not None and is_unsent(error.__cause__)
 
 
-def send_email(email):
-    """Takes in a composed email and sends it using the mailjet api
+def send_email(email, limiter=None):
+    """Takes in a composed email and sends it using the mailjet api.
+       Sends which mailjet answers with a 429 or 5xx are retried with
+       backoff, each attempt waiting on the limiter.
+
     Args:
         email (dict): dict containing all relevant fields needed by the mailjet API
+        limiter (RateLimiter): limits how often we call mailjet. Optional.
+
+    Returns:
+        Response: the response from mailjet
+
+    Raises:
+        HTTPError: if mailjet still rejects the email after any retries
     """
-    api_key = os.environ['api_key']
-    api_secret = os.environ['api_secret']
-    mailjet = Client(auth=(api_key, api_secret), version='v3.1')
-    result = mailjet.send.create(data=email)
+    result = clients.call_with_retry(post_email, email, limiter,
+                                     retry_if=is_unsent)
     logging.info(result)
+    result.raise_for_status()
+    return result
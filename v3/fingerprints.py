@@ -0,0 +1,162 @@
+"""Fingerprints of the data pulled from Yahoo, used to skip runs with nothing
+new to write.
+
+A ticker's fingerprint is the date of its last bar plus a hash of the price
+and dividend bars in the FINGERPRINT_DAYS before it. Anchoring the hash on
+the last bar rather than the date pulled from means a run pulling a week more
+than the last one still matches it. Fingerprints are kept in a table named
+`fingerprints_` followed by the price table name, one row per ticker, and
+only saved once a run has finished so a failed run is never skipped over.
+
+When a ticker's fingerprint matches the saved one its data is already in the
+base tables, so it isn't written or merged again. When no ticker has changed
+the derived tables and email are skipped as well, so runs on weekends and
+holidays only read the watermarks, pull from Yahoo and compare fingerprints.
+"""
+import os
+import logging
+import pandas as pd
+
+
+# days before the last bar included in the hash
+FINGERPRINT_DAYS = 7
+FINGERPRINT_COLUMNS = ['ticker', 'max_dt', 'content_hash']
+
+
+def fingerprint_table_name(price_table_name):
+    """Returns the name of the fingerprint table for a price table
+
+    Args:
+        price_table_name (str): the name of the price table
+
+    Returns:
+        str: the name of the fingerprint table
+    """
+    return 'fingerprints_'+price_table_name
+
+
+def hash_rows(data, starts):
+    """Sums a hash of each row per ticker, keeping rows on or after their
+       ticker's start date
+
+    Args:
+        data (df): price or dividend data with Ticker and Date columns
+        starts (Series): maps between tickers and the first date to hash
+
+    Returns:
+        Series: maps between tickers and the combined hash of their rows
+    """
+    recent = data[data.Date >= data.Ticker.map(starts)]
+    hashes = pd.util.hash_pandas_object(recent, index=False)
+    # sums of uint64 wrap around rather than overflowing
+    return hashes.groupby(recent.Ticker.to_numpy()).sum()
+
+
+def compute_fingerprints(hist_data, days=FINGERPRINT_DAYS):
+    """Calculates the fingerprint of every ticker in one pass
+
+    Args:
+        hist_data (dict): maps between tickers and their price and dividend
+            data
+        days (int): days before the last bar included in the hash
+
+    Returns:
+        df: one row per ticker with price data, with the FINGERPRINT_COLUMNS
+    """
+    if len(hist_data) == 0:
+        return pd.DataFrame(columns=FINGERPRINT_COLUMNS)
+    prices = pd.concat([price for price, _ in hist_data.values()],
+                       ignore_index=True)
+    divs = pd.concat([div for _, div in hist_data.values()],
+                     ignore_index=True)
+    max_dts = prices.groupby('Ticker').Date.max()
+    starts = max_dts - pd.Timedelta(days=days)
+    content_hash = hash_rows(prices, starts).reindex(max_dts.index) ^ \
+        hash_rows(divs, starts).reindex(max_dts.index, fill_value=0)
+    return pd.DataFrame({'ticker': max_dts.index, 'max_dt': max_dts.values,
+                         'content_hash': ['{:016x}'.format(value) for value
+                                          in content_hash.values]})
+
+
+class Fingerprints:
+    """Compares the data pulled in a run against the fingerprints saved by
+       the last one
+
+    Args:
+        backend (storage backend): open backend to read from and save to
+        price_table_name (str): the name of the price table
+    """
+
+    def __init__(self, backend, price_table_name):
+        self.backend = backend
+        self.table_name = fingerprint_table_name(price_table_name)
+        self.saved = backend.run('fingerprints.sql', [self.table_name])
+        self.changed = pd.DataFrame(columns=FINGERPRINT_COLUMNS)
+
+    def drop_unchanged(self, hist_data):
+        """Removes tickers whose data matches their saved fingerprint and
+           keeps the fingerprints of the rest to save at the end of the run
+
+        Args:
+            hist_data (dict): maps between tickers and their price and
+                dividend data. Updated in place.
+
+        Returns:
+            list: the tickers removed
+        """
+        current = compute_fingerprints(hist_data)
+        merged = current.merge(self.saved, on='ticker', how='left',
+                               suffixes=('', '_saved'))
+        same = (merged.max_dt == merged.max_dt_saved) & \
+            (merged.content_hash == merged.content_hash_saved)
+        unchanged = merged.ticker[same].tolist()
+        for ticker in unchanged:
+            del hist_data[ticker]
+        self.changed = pd.concat([self.changed, current[~same.to_numpy()]],
+                                 ignore_index=True)
+        logging.info('{} of {} tickers unchanged'.format(len(unchanged),
+                                                         len(current)))
+        return unchanged
+
+    def any_changed(self):
+        """Returns whether any ticker pulled so far has changed
+
+        Returns:
+            bool: True if any ticker's fingerprint differs from the saved one
+        """
+        return len(self.changed) > 0
+
+    def save(self):
+        """Saves the fingerprints of the tickers which changed. They're
+           staged in a load table and merged in by ticker, so workers saving
+           at once don't overwrite each other's fingerprints.
+        """
+        if not self.any_changed():
+            return
+        data = self.changed.copy()
+        data['max_dt'] = pd.to_datetime(data.max_dt)
+        load_table_name = self.backend.load_table_name(self.table_name)
+        _ = self.backend.run('create_load.sql',
+                             [load_table_name, self.table_name])
+        self.backend.load(data[FINGERPRINT_COLUMNS], load_table_name)
+        _ = self.backend.run('merge_fingerprints.sql',
+                             [self.table_name, load_table_name])
+
+
+def get_fingerprints(backend, price_table_name):
+    """Creates the fingerprints used by a run. Fingerprints are on unless the
+       FINGERPRINTS environment variable is false. They're only used with
+       bulk loads, as BULK_LOAD=false writes each ticker as soon as it's
+       pulled.
+
+    Args:
+        backend (storage backend): open backend to read from and save to
+        price_table_name (str): the name of the price table
+
+    Returns:
+        Fingerprints: the fingerprints. None if they're off.
+    """
+    if os.environ.get('FINGERPRINTS', 'true').lower() != 'true' or \
+            os.environ.get('BULK_LOAD', 'true').lower() != 'true':
+        return None
+    return Fingerprints(backend, price_table_name)
@@ -0,0 +1,2 @@
+SELECT ticker, max_dt, content_hash
+FROM {};
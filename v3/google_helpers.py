@@ -1,30 +1,139 @@
 """Code used to write to and query from google BigQuery.
+
+Calls use the timeout and retry policy set in clients.
 """
-def get_bq_data(sql, client):
+import tempfile
+import datetime as dt
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+import clients
+
+
+# maximum number of rows converted to Arrow at once when writing
+CHUNK_ROWS = 100000
+# maps between BQ column types and the Arrow types used to write them
+ARROW_TYPES = {
+    'STRING': pa.string(),
+    'DATETIME': pa.timestamp('us'),
+    'DATE': pa.date32(),
+    'FLOAT': pa.float64(),
+    'FLOAT64': pa.float64(),
+    'INTEGER': pa.int64(),
+    'INT64': pa.int64(),
+}
+
+
+def query_parameter(name, value):
+    """Builds a BQ query parameter from a python value. Dates are passed as
+       DATETIME to match the snap_date columns.
+
+    Args:
+        name (str): the name of the parameter, without the @
+        value: the value of the parameter
+
+    Returns:
+        ScalarQueryParameter: the query parameter
+    """
+    if isinstance(value, str):
+        return bigquery.ScalarQueryParameter(name, 'STRING', value)
+    if isinstance(value, dt.datetime):
+        return bigquery.ScalarQueryParameter(name, 'DATETIME', value)
+    if isinstance(value, dt.date):
+        value = dt.datetime.combine(value, dt.time())
+        return bigquery.ScalarQueryParameter(name, 'DATETIME', value)
+    if isinstance(value, bool):
+        return bigquery.ScalarQueryParameter(name, 'BOOL', value)
+    if isinstance(value, int):
+        return bigquery.ScalarQueryParameter(name, 'INT64', value)
+    return bigquery.ScalarQueryParameter(name, 'FLOAT64', value)
+
+
+def run_query(sql, client, params=None, dry_run=False):
+    """Runs the passed SQL query in BQ and waits for it to finish
+
+    Args:
+        sql (str): the query to be run.
+        client (client): client to connect to BQ.
+        params (dict): the values bound to the @ parameters in the SQL
+        dry_run (bool): if True, only plan the query. The job then holds the
+            bytes it would process.
+
+    Returns:
+        QueryJob: the finished job. Holds the statistics of the query, such
+            as the bytes billed.
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        query_parameter(name, value)
+        for name, value in (params or {}).items()], dry_run=dry_run,
+        use_query_cache=not dry_run)
+    retry = clients.bigquery_retry()
+    job = client.query(sql, job_config=job_config, retry=retry,
+                       timeout=clients.request_timeout())
+    if not dry_run:
+        job.result(retry=retry)
+    return job
+
+
+def get_bq_data(sql, client, params=None):
     """Queries BQ using the passed SQL query and returns the result
 
     Args:
         sql (str): the query to be run.
         client (client): client to connect to BQ.
+        params (dict): the values bound to the @ parameters in the SQL
 
     Returns:
         df: The result of the passed SQL query
     """
-    return client.query(sql).result().to_dataframe()
+    return run_query(sql, client, params).to_dataframe()
+
+
+def arrow_schema(table):
+    """Builds the Arrow schema matching a BQ table
+
+    Args:
+        table (Table): the BQ table
+
+    Returns:
+        Schema: the matching Arrow schema
+    """
+    return pa.schema([(field.name, ARROW_TYPES[field.field_type])
+                      for field in table.schema])
 
 
-def write_to_gbq(data, client, table):
-    """Takes in a dataframe and writes the values to BQ
+def write_to_gbq(data, client, table, replace=False, chunk_rows=CHUNK_ROWS):
+    """Takes in a dataframe and writes the values to BQ using a single
+       Parquet load job. The frame is converted to Arrow chunk_rows rows at a
+       time and spooled to a temporary file so memory use stays bounded.
 
     Args:
-        data (df): the dataframe to be written
+        data (df): the dataframe to be written. Columns are matched to the
+            table's columns by position.
         client (client): client to connect to BQ.
-        table (str): the table to be written to.
+        table (Table): the table to be written to.
+        replace (bool): if True, replace the contents of the table rather than
+            adding to it.
+        chunk_rows (int): the maximum number of rows converted at once.
     """
-    # convert to list of lists
-    rows_to_insert = data.values.tolist()
-    # write data
-    errors = client.insert_rows(table, rows_to_insert)
-    if errors != []:
-        print(errors)
-        assert errors == [], 'There were errors writing data see above.'
+    schema = arrow_schema(table)
+    data = data.set_axis(schema.names, axis=1)
+    if replace:
+        write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+    else:
+        write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+    job_config = bigquery.LoadJobConfig(
+        schema=table.schema,
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=write_disposition)
+    with tempfile.TemporaryFile() as parquet_file:
+        with pq.ParquetWriter(parquet_file, schema) as writer:
+            for start in range(0, len(data), chunk_rows):
+                chunk = data.iloc[start:start+chunk_rows]
+                writer.write_batch(pa.RecordBatch.from_pandas(
+                    chunk, schema=schema, preserve_index=False))
+        parquet_file.seek(0)
+        job = client.load_table_from_file(parquet_file, table,
+                                          job_config=job_config,
+                                          timeout=clients.request_timeout())
+        job.result(retry=clients.bigquery_retry())
@@ -0,0 +1,2 @@
+SELECT ticker, snap_date, amount
+FROM {};
@@ -4,201 +4,558 @@ import os
 import sys
 import traceback
 import datetime as dt
-import urllib.request as urllib2
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
-import yaml
-from google.cloud import bigquery
-from mailjet_rest import Client
-import yfinance as yf
 import logging
 import email_helpers as eh
-import google_helpers as gh
+import storage
+import tr_index
+import portfolios
+import report
+import dispatch
+import run_stats
+import validation
+from throttle import RateLimiter
+from price_cache import get_price_cache
+from fingerprints import get_fingerprints
 
 
 # set logging level
 logging.basicConfig(level=logging.INFO)
 
+# yfinance is slow to import so is only imported once it's needed. see yahoo
+yf = None
 
-def get_hist_data(start_dt, ticker):
-    start_dt = start_dt.strftime('%Y-%m-%d')
-    stock_data = yf.download(ticker, start=start_dt, actions=True)
+# columns pulled from Yahoo which make up the price data
+PRICE_FLOAT_COLS = ['Open', 'High', 'Low', 'Close', 'Adj Close']
+PRICE_COLS = PRICE_FLOAT_COLS + ['Volume']
+
+
+def yahoo():
+    """Returns the yfinance module, importing it the first time it's needed.
+       Keeps it out of the cold start of runs which don't call Yahoo.
+
+    Returns:
+        module: the yfinance module
+    """
+    global yf
+    if yf is None:
+        import yfinance
+        yf = yfinance
+    return yf
+
+
+def shape_hist_data(stock_data, ticker, start_dt):
+    """Splits the raw Yahoo data for a ticker into price and dividend data
+
+    Args:
+        stock_data (df): Yahoo data for the ticker indexed by date
+        ticker (str): the ticker the data is for
+        start_dt (str): the earliest date to keep
+
+    Returns:
+        tuple: the price data and the dividend data
+    """
+    if stock_data.index.tz is not None:
+        stock_data.index = stock_data.index.tz_localize(None)
     stock_data = stock_data.loc[stock_data.index >= start_dt]
-    stock_data.reset_index(inplace=True)
-    df_price_cols = ['Date', 'Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
-    df_price = stock_data[df_price_cols].copy()
+    # round all price columns at once. round returns a new frame so no copy
+    # is needed before adding columns
+    df_price = stock_data[PRICE_COLS].round(dict.fromkeys(PRICE_FLOAT_COLS, 2))
+    df_price.insert(0, 'Date', stock_data.index)
     df_price.insert(0, 'Ticker', ticker)
-    price_float_cols = df_price.columns.drop(['Ticker', 'Date', 'Volume'])
-    for col in price_float_cols:
-        df_price.loc[:, col] = df_price.loc[:, col].apply(lambda x: round(x, 2))
-    df_div_cols = ['Date', 'Dividends']
-    df_div = stock_data.loc[stock_data.Dividends > 0, df_div_cols].copy()
+    df_price.reset_index(drop=True, inplace=True)
+    df_div = stock_data.loc[stock_data.Dividends > 0, ['Dividends']].round(2)
+    df_div.insert(0, 'Date', df_div.index)
     df_div.insert(0, 'Ticker', ticker)
-    df_div.loc[:, 'Dividends'] = df_div.loc[:, 'Dividends'].apply(lambda x: round(x, 2))
+    df_div.reset_index(drop=True, inplace=True)
     return (df_price, df_div)
 
 
+def get_hist_data(start_dt, ticker, cache=None, limiter=None):
+    """Pulls price and dividend data for a ticker from Yahoo
+
+    Args:
+        start_dt (datetime): the date to pull data from
+        ticker (str): the ticker to pull data for
+        cache (PriceCache): cache to read from and add to. Optional.
+        limiter (RateLimiter): limits how often we call Yahoo. Optional.
+
+    Returns:
+        tuple: the price data and the dividend data
+    """
+    start_dt = pd.Timestamp(start_dt)
+    fetch_dt = start_dt
+    if cache is not None:
+        fetch_dt = cache.fetch_start(ticker, start_dt)
+        if fetch_dt is None:
+            return cache.get(ticker, start_dt)
+    if limiter is not None:
+        limiter.wait()
+    fetch_str = fetch_dt.strftime('%Y-%m-%d')
+    # Ticker.history is used over yf.download as it is safe to call from
+    # several threads at once
+    stock_data = yahoo().Ticker(ticker).history(start=fetch_str, actions=True,
+                                           auto_adjust=False)
+    hist_data = shape_hist_data(stock_data, ticker, fetch_str)
+    if cache is None:
+        return hist_data
+    cache.update(ticker, fetch_dt, *hist_data)
+    return cache.get(ticker, start_dt)
+
+
+def get_batch_hist_data(start_dts, batch_size, limiter, cache=None):
+    """Pulls data for many tickers using one Yahoo request per batch. Tickers
+       are batched with others whose start dates are close to their own.
+
+    Args:
+        start_dts (dict): maps between the tickers to pull data for and the
+            date to pull each from
+        batch_size (int): the maximum number of tickers per request
+        limiter (RateLimiter): limits how often we call Yahoo
+        cache (PriceCache): cache to read from and add to. Optional.
+
+    Returns:
+        dict: maps between tickers and their price and dividend data. Tickers
+            Yahoo returned no data for or whose batch request failed are
+            left out.
+    """
+    start_dts = {ticker: pd.Timestamp(start_dt)
+                 for ticker, start_dt in start_dts.items()}
+    hist_data = {}
+    fetch_dts = {}
+    for ticker, start_dt in start_dts.items():
+        fetch_dt = start_dt
+        if cache is not None:
+            fetch_dt = cache.fetch_start(ticker, start_dt)
+            if fetch_dt is None:
+                hist_data[ticker] = cache.get(ticker, start_dt)
+                continue
+        fetch_dts[ticker] = fetch_dt
+    to_fetch = sorted(fetch_dts, key=fetch_dts.get)
+    for i in range(0, len(to_fetch), batch_size):
+        batch = to_fetch[i:i+batch_size]
+        batch_dt = min(fetch_dts[ticker] for ticker in batch)
+        batch_str = batch_dt.strftime('%Y-%m-%d')
+        limiter.wait()
+        try:
+            stock_data = yahoo().download(batch, start=batch_str,
+                                          actions=True, auto_adjust=False,
+                                          group_by='ticker', progress=False)
+        except Exception:
+            # the batch's tickers are left out so they're pulled on their own
+            logging.exception('Batch starting {}'.format(batch[0]))
+            continue
+        for ticker in batch:
+            if isinstance(stock_data.columns, pd.MultiIndex):
+                if ticker not in stock_data.columns.get_level_values(0):
+                    continue
+                ticker_data = stock_data[ticker]
+            else:
+                ticker_data = stock_data
+            # rows only exist for this ticker if it traded that day
+            ticker_data = ticker_data.dropna(subset=['Close'])
+            if len(ticker_data) == 0:
+                continue
+            # missing rows for other tickers turn volume into floats
+            ticker_data = ticker_data.astype({'Volume': 'int64'})
+            if cache is None:
+                hist_data[ticker] = shape_hist_data(
+                    ticker_data, ticker,
+                    fetch_dts[ticker].strftime('%Y-%m-%d'))
+            else:
+                ticker_hist = shape_hist_data(ticker_data, ticker, batch_str)
+                cache.update(ticker, batch_dt, *ticker_hist)
+                hist_data[ticker] = cache.get(ticker, start_dts[ticker])
+    return hist_data
+
+
 def compose_summary_email(pct, name_mapping):
     """Composes an email whose subject lists the highest performing stock
-       and which includes a table showing all stock performance.
+       and which includes a table of the best and worst performers. See
+       report.render_summary.
 
     Args:
-        pct (dict): maps between stock tickers and 1-year total returns
+        pct (dict or Series): maps between stock tickers and total returns
         name_mapping (dict): maps between stock tickers and their definitions
 
     Returns:
-        dict: data structure containing the composed email ready for MJ's API
-    """
-    pct_nice_name = {}
-    for key in pct.keys():
-        pct_nice_name[key[:-3]] = pct[key]
-    highest_return_ticker = max(pct_nice_name, key=pct_nice_name.get)
-    highest_return = pct_nice_name[highest_return_ticker]
-    df_pct = pd.DataFrame(data=pct_nice_name, index=['YTD'])
-    df_pct = df_pct.round(2)
-    df_name = pd.DataFrame(data=name_mapping, index=['Desc'])
-    df_tot = df_pct.transpose().merge(right=df_name.transpose(),
-                                      left_index=True, right_index=True)
-    df_tot = df_tot.sort_values(by='YTD', ascending=False).transpose()
-    summary_table = df_tot.to_html()
-    subject = "{} has the highest returns".format(highest_return_ticker)
-    body = "<h3>Today's leader is {} at {}.</h3><br />Summary:<br />{}".format(highest_return_ticker, highest_return.round(2), summary_table)
-    return subject, body
-
-
-def ticker_return(new_max_dt, ticker, query_path, client, div_query_path):
-    """Takes in a ticker and calculates the 1 year return
+        tuple: the subject and body of the email
+    """
+    return report.render_summary(pct, name_mapping)
+
+
+def merge_data(data, backend, table_name, merge_sql_file, replace=False,
+               ticker=None):
+    """Writes data to a load table and merges it into its base table. Only
+       rows from the first date of data onwards are merged, so with
+       partitioned tables the merge only reads the partitions they fall in.
 
     Args:
-        nex_max_dt (datetime): the min max date in the database
-        ticker (str): the ticker to pull data from
-        query_path (str): the table path to pull stock data from
-        client (google big query client): open client to use for querying
-        div_query_path (str): the table path to pull dividend data from
+        data (df): the data to be merged
+        backend (storage backend): open backend to write to
+        table_name (str): the name of the base table
+        merge_sql_file (str): the name of the SQL file used to merge
+        replace (bool): if True, replace the contents of the load table using
+            one bulk load rather than adding rows to it
+        ticker (str): the ticker the data is for. Passed to merge SQL which
+            only merges one ticker's rows, so threads sharing the load table
+            don't merge each other's rows. Optional.
+    """
+    load_table_name = backend.load_table_name(table_name)
+    with run_stats.stage('insert'):
+        if replace:
+            backend.load(data, load_table_name)
+        else:
+            backend.write(data, load_table_name)
+    params = {'min_dt': data.Date.min()}
+    if ticker is not None:
+        params['ticker'] = ticker
+    with run_stats.stage('merge'):
+        _ = backend.run(merge_sql_file, [table_name, load_table_name], params)
 
-    Returns:
-        float: the 1 year total return
+
+def ingest_ticker(ticker, pull_dt, backend, price_table_name, div_table_name,
+                  limiter, cache=None, hist_data=None):
+    """Pulls data for a ticker from Yahoo and merges it into the base tables
+
+    Args:
+        ticker (str): the ticker to pull data for
+        pull_dt (datetime): the date to pull data from
+        backend (storage backend): open backend to write to
+        price_table_name (str): the name of the price table
+        div_table_name (str): the name of the dividend table
+        limiter (RateLimiter): limits how often we call Yahoo
+        cache (PriceCache): cache to read from and add to. Optional.
+        hist_data (tuple): price and dividend data which has already been
+            pulled. Pulled from Yahoo if not passed.
     """
+    logging.info('start')
     logging.info(ticker)
-    end_dt = new_max_dt.replace(day=1)
-    start_dt = end_dt.replace(year=end_dt.year-1)
-    with open('max_date_where.sql') as sql_file:
-        sql_base = sql_file.read()
-    sql = sql_base.format(query_path, "'"+end_dt.strftime('%Y-%m-%d')+"'",
-                          "'"+ticker+"'")
-    end_dt = gh.get_bq_data(sql, client)
-    end_dt = end_dt['max_dt'].iloc[0]
-    sql = sql_base.format(query_path, "'"+start_dt.strftime('%Y-%m-%d')+"'",
-                          "'"+ticker+"'")
-    start_dt = gh.get_bq_data(sql, client)
-    start_dt = start_dt['max_dt'].iloc[0]
-    # get the closing values on the start and end dates
-    with open('close_value.sql') as sql_file:
-        sql_base = sql_file.read()
-    sql = sql_base.format(query_path, "'"+ticker+"'",
-                          "'"+end_dt.strftime('%Y-%m-%d')+"'")
-    end_close = gh.get_bq_data(sql, client)
-    end_close = end_close['close'].iloc[0]
-    sql = sql_base.format(query_path, "'"+ticker+"'",
-                          "'"+start_dt.strftime('%Y-%m-%d')+"'")
-    start_close = gh.get_bq_data(sql, client)
-    start_close = start_close['close'].iloc[0]
-    # get total dividends paid out during the year
-    with open('divs.sql') as sql_file:
-        sql_base = sql_file .read()
-    sql = sql_base.format(div_query_path, "'"+ticker+"'",
-                          "'"+start_dt.strftime('%Y-%m-%d')+"'",
-                          "'"+end_dt.strftime('%Y-%m-%d')+"'")
-    divs = gh.get_bq_data(sql, client)
-    divs = divs['TOT_AMT'].iloc[0]
-    # calculate the return
-    total_return = (end_close / (start_close - divs) - 1) * 100
-    return total_return
+    if hist_data is None:
+        with run_stats.stage('fetch'):
+            hist_data = get_hist_data(pull_dt, ticker, cache, limiter)
+            run_stats.record(rows=len(hist_data[0]))
+    with run_stats.stage('validate'):
+        hist_data = validation.quarantine({ticker: hist_data}, backend,
+                                          price_table_name)[ticker]
+    (price_data, div_data) = hist_data
+    # if there is new data, write it to the load tables. Other tickers are
+    # written to the same load tables at the same time, so only this
+    # ticker's rows are merged.
+    if len(price_data) > 0:
+        merge_data(price_data, backend, price_table_name,
+                   'merge_price_ticker.sql', ticker=ticker)
+    if len(div_data) > 0:
+        merge_data(div_data, backend, div_table_name, 'merge_divs_ticker.sql',
+                   ticker=ticker)
 
 
-def main_kickoff():
-    """Function which orchestrates the rest of the code
+def fetch_missing_hist_data(pull_dts, hist_data, limiter, max_workers,
+                            cache=None):
+    """Pulls data one ticker at a time for tickers which aren't in hist_data
+
+    Args:
+        pull_dts (dict): maps between the tickers we want data for and the
+            date to pull each from
+        hist_data (dict): maps between tickers and their price and dividend
+            data. Updated in place.
+        limiter (RateLimiter): limits how often we call Yahoo
+        max_workers (int): the number of tickers to pull at once
+        cache (PriceCache): cache to read from and add to. Optional.
+
+    Returns:
+        list: the tickers which failed to pull
     """
-    with open('stocks.yaml') as yaml_file:
-        data = yaml.load(yaml_file, Loader=yaml.FullLoader)
-    # tickers for which we want reports
-    tickers = data['tickers']
-    # dictionary connecting tickers to readible names. Used in email.
-    name_mapping = data['mapping']
-    # set up GBQ variables
-    project_id = os.environ['PROJECT_ID']
-    dataset = os.environ['DATASET']
-    price_table_name = os.environ['PRICE_TABLENAME']
-    div_table_name = os.environ['DIVIDEND_TABLENAME']
-    # set up connection details
-    client = bigquery.Client()
-    dataset_ref = client.dataset(dataset)
-    price_query_path = '`'+project_id+'.'+dataset+'.'+price_table_name+'`'
-    div_query_path = '`'+project_id+'.'+dataset+'.'+div_table_name+'`'
-    # get the references for the load tables
-    load_price_table_name = 'load_'+price_table_name
-    load_price_table_ref = bigquery.TableReference(dataset_ref,
-                                                   load_price_table_name)
-    load_price_table = client.get_table(load_price_table_ref)
-    load_price_query_path = '`'+project_id+'.'+dataset+'.'+load_price_table_name+'`'
-    load_div_table_name = 'load_'+div_table_name
-    load_div_table_ref = bigquery.TableReference(dataset_ref,
-                                                 load_div_table_name)
-    load_div_table = client.get_table(load_div_table_ref)
-    load_div_query_path = '`'+project_id+'.'+dataset+'.'+load_div_table_name+'`'
-    # get max date in database
-    with open('min_max_date.sql') as sql_file:
-        min_max_sql = sql_file.read()
-    min_max_sql = min_max_sql.format(price_query_path)
-    max_dt = gh.get_bq_data(min_max_sql, client)
-    base_dt = max_dt['min_max_dt'].iloc[0]
+    missing = [ticker for ticker in pull_dts if ticker not in hist_data]
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_hist_data, pull_dts[ticker], ticker,
+                                   cache,
+                                   limiter): ticker
+                   for ticker in missing}
+        for future in as_completed(futures):
+            try:
+                hist_data[futures[future]] = future.result()
+            except Exception:
+                logging.exception(futures[future])
+                failed.append(futures[future])
+    return failed
+
+
+def bulk_merge(hist_data, backend, price_table_name, div_table_name):
+    """Writes the data for all tickers to the load tables in one load each
+       and merges each load table into its base table once.
+
+    Args:
+        hist_data (dict): maps between tickers and their price and dividend
+            data
+        backend (storage backend): open backend to write to
+        price_table_name (str): the name of the price table
+        div_table_name (str): the name of the dividend table
+    """
+    if len(hist_data) == 0:
+        return
+    price_data = pd.concat([price for price, _ in hist_data.values()],
+                           ignore_index=True)
+    div_data = pd.concat([div for _, div in hist_data.values()],
+                         ignore_index=True)
+    # if there is new data, write it to the load tables
+    if len(price_data) > 0:
+        merge_data(price_data, backend, price_table_name, 'merge_price.sql',
+                   replace=True)
+    if len(div_data) > 0:
+        merge_data(div_data, backend, div_table_name, 'merge_divs.sql',
+                   replace=True)
+
+
+def ingest_tickers(pull_dts, backend, price_table_name, div_table_name,
+                   fingerprints=None):
+    """Ingests several tickers at once. Data is first pulled from Yahoo in
+       batches of YF_BATCH_SIZE tickers per request. Tickers missing from a
+       batch, or whose batch request failed, are retried one at a time. The
+       number of tickers in flight is set by the MAX_WORKERS environment
+       variable and calls to Yahoo are limited by YF_REQUESTS_PER_SECOND. A
+       ticker which fails is logged and doesn't stop the others.
+
+       If PRICE_CACHE_DIR is set, data is read from and added to a local
+       cache so only dates which aren't cached are pulled from Yahoo.
+
+       By default all tickers are then written in one bulk load and merged
+       once per table. Tickers whose data matches their fingerprint from the
+       last run are left out, and rows failing validation's checks are
+       quarantined rather than merged. Setting BULK_LOAD to false instead
+       checks, writes and merges each ticker separately.
+
+    Args:
+        pull_dts (dict): maps between the tickers to pull data for and the
+            date to pull each from
+        backend (storage backend): open backend to write to
+        price_table_name (str): the name of the price table
+        div_table_name (str): the name of the dividend table
+        fingerprints (Fingerprints): fingerprints of the last run's data.
+            Only used for bulk loads. Optional.
+
+    Returns:
+        list: the tickers which failed to ingest
+    """
+    max_workers = int(os.environ.get('MAX_WORKERS', 4))
+    limiter = RateLimiter(float(os.environ.get('YF_REQUESTS_PER_SECOND', 2)))
+    batch_size = int(os.environ.get('YF_BATCH_SIZE', 100))
+    cache = get_price_cache()
+    hist_data = {}
+    if batch_size > 0:
+        with run_stats.stage('fetch'):
+            hist_data = get_batch_hist_data(pull_dts, batch_size, limiter,
+                                            cache)
+            run_stats.record(rows=sum(len(price)
+                                      for price, _ in hist_data.values()))
+            # tickers missing from their batch are pulled again on their own
+            run_stats.record(retries=len(set(pull_dts) - set(hist_data)))
+    if os.environ.get('BULK_LOAD', 'true').lower() == 'true':
+        with run_stats.stage('fetch'):
+            missing = set(pull_dts) - set(hist_data)
+            failed = fetch_missing_hist_data(pull_dts, hist_data, limiter,
+                                             max_workers, cache)
+            run_stats.record(rows=sum(len(hist_data[ticker][0])
+                                      for ticker in missing
+                                      if ticker in hist_data))
+        if fingerprints is not None:
+            with run_stats.stage('fingerprints'):
+                fingerprints.drop_unchanged(hist_data)
+        with run_stats.stage('validate'):
+            hist_data = validation.quarantine(hist_data, backend,
+                                              price_table_name)
+        bulk_merge(hist_data, backend, price_table_name, div_table_name)
+        log_cache_stats(cache)
+        return failed
+    # empty load tables
+    with run_stats.stage('clear_load'):
+        for table_name in [price_table_name, div_table_name]:
+            _ = backend.run('clear_load.sql',
+                            [backend.load_table_name(table_name)])
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(ingest_ticker, ticker, pull_dt, backend,
+                                   price_table_name, div_table_name, limiter,
+                                   cache, hist_data.get(ticker)): ticker
+                   for ticker, pull_dt in pull_dts.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logging.exception(futures[future])
+                failed.append(futures[future])
+    log_cache_stats(cache)
+    return failed
+
+
+def log_cache_stats(cache):
+    """Logs the number of cache hits and misses
+
+    Args:
+        cache (PriceCache): the cache used. Nothing is logged if None.
+    """
+    if cache is not None:
+        logging.info('Price cache hits: {}, misses: {}'.format(cache.hits,
+                                                               cache.misses))
+
+
+def get_watermarks(backend, price_table_name, tickers):
+    """Finds the most recent date we have price data for, for each ticker
+
+    Args:
+        backend (storage backend): open backend to use for querying
+        price_table_name (str): the table to pull stock data from
+        tickers (list): the tickers to return watermarks for
+
+    Returns:
+        Series: maps between tickers and their most recent date. NaT for
+            tickers with no data.
+    """
+    watermarks = backend.run('watermarks.sql', [price_table_name])
+    watermarks = watermarks.set_index('ticker')['max_dt']
+    return watermarks.reindex(tickers)
+
+
+def split_stale(watermarks, stale_days):
+    """Separates tickers which have fallen behind from the rest
+
+    Args:
+        watermarks (Series): maps between tickers and their most recent date
+        stale_days (int): how many days a ticker can be behind the most up to
+            date ticker before it is considered stale
+
+    Returns:
+        tuple: the oldest watermark among tickers which aren't stale and a
+            Series of the watermarks of the stale tickers
+    """
+    stale = watermarks < watermarks.max() - dt.timedelta(days=stale_days)
+    return watermarks[~stale].min(), watermarks[stale]
+
+
+def plan_pulls(watermarks, stale_days):
+    """Works out the date to pull each ticker from. Stale tickers are
+       reported but don't hold back the dates used for the rest.
+
+    Args:
+        watermarks (Series): maps between tickers and their most recent date
+        stale_days (int): how many days a ticker can be behind before it is
+            considered stale
+
+    Returns:
+        tuple: the oldest watermark among tickers which aren't stale and a
+            dict mapping between tickers and the date to pull each from
+    """
+    base_dt, stale = split_stale(watermarks, stale_days)
+    if len(stale) > 0:
+        logging.warning('Stale tickers: {}'.format(stale.to_dict()))
     # if only have a one date range, return is weird so look at min 7 day range
-    pull_dt = base_dt - dt.timedelta(days=7)
-    logging.info(pull_dt)
+    # tickers with no data yet are pulled from the oldest date
+    pull_dts = (watermarks.fillna(base_dt) - dt.timedelta(days=7)).to_dict()
+    logging.info(pull_dts)
     logging.info(base_dt)
+    return base_dt, pull_dts
 
-    # empty load tables
-    sql = "delete FROM "+load_price_query_path+" where snap_date > '2000-01-01'"
-    _ = gh.get_bq_data(sql, client)
-    sql = "delete FROM "+load_div_query_path+" where snap_date > '2000-01-01'"
-    _ = gh.get_bq_data(sql, client)
-    # pull data for each ticker from Yahoo
-    for ticker in tickers:
-        logging.info('start')
-        logging.info(ticker)
-        (price_data, div_data) = get_hist_data(pull_dt, ticker)
-        # if there is new data, write it to the load tables
-        if len(price_data) > 0:
-            gh.write_to_gbq(price_data, client, load_price_table)
-            with open('merge_price.sql') as sql_file:
-                sql = sql_file.read()
-            sql = sql.format(price_query_path, load_price_query_path)
-            _ = gh.get_bq_data(sql, client)
-        if len(div_data) > 0:
-            gh.write_to_gbq(div_data, client, load_div_table)
-            with open('merge_divs.sql') as sql_file:
-                sql = sql_file.read()
-            sql = sql.format(div_query_path, load_div_query_path)
-            _ = gh.get_bq_data(sql, client)
-    # get the new min max date
-    with open('min_max_date.sql') as sql_file:
-        min_max_sql = sql_file.read()
-    min_max_sql = min_max_sql.format(price_query_path)
-    max_dt2 = gh.get_bq_data(min_max_sql, client)
-    new_max_dt = max_dt2['min_max_dt'].iloc[0]
+
+def finish_run(backend, portfolio_defs, name_mapping, base_dt, since,
+               price_table_name, div_table_name, stale_days):
+    """Updates the derived tables once new data has been ingested and emails
+       the returns of every portfolio to its subscribers if we've moved into
+       a new month.
+
+    Args:
+        backend (storage backend): open backend to use for querying
+        portfolio_defs (dict): the portfolios to report on, as returned by
+            portfolios.read_portfolios
+        name_mapping (dict): maps between stock tickers and their definitions
+        base_dt (datetime): the oldest up to date watermark before ingesting
+        since (datetime): the earliest date pulled, from which the total
+            return index is rebuilt
+        price_table_name (str): the name of the price table
+        div_table_name (str): the name of the dividend table
+        stale_days (int): how many days a ticker can be behind before it is
+            considered stale
+    """
+    tickers = portfolios.all_tickers(portfolio_defs)
+    # get the new oldest date among tickers which are up to date
+    with run_stats.stage('watermarks'):
+        watermarks = get_watermarks(backend, price_table_name, tickers)
+    new_max_dt, _ = split_stale(watermarks, stale_days)
     logging.info(new_max_dt)
     logging.info('end')
 
-    # check if we're in a new month. if yes, calculate + email returns
+    # rebuild the total return index from the earliest date pulled, so
+    # bars and dividends merged behind the end of the index are included
+    with run_stats.stage('tr_index'):
+        tr_index.update_tr_index(backend, price_table_name, div_table_name,
+                                 since)
+
+    # check if we're in a new month. if yes, email returns
     if new_max_dt.month != base_dt.month:
-        pct = {}
-        for ticker in tickers:
-            pct[ticker] = ticker_return(new_max_dt, ticker, price_query_path,
-                                        client, div_query_path)
-        subject, body = compose_summary_email(pct, name_mapping)
-        email = eh.email_composition(os.environ['contact_email'],
-                                     os.environ['contact_name'],
-                                     subject, body)
-        eh.send_email(email)
+        # every lookback of every ticker is read at once then each portfolio
+        # is ranked from the shared returns
+        with run_stats.stage('returns'):
+            returns = tr_index.window_returns(
+                backend, price_table_name, new_max_dt,
+                portfolios.all_lookbacks(portfolio_defs), tickers)
+            ranked = portfolios.rank_portfolios(returns, portfolio_defs)
+        # each subscriber gets the portfolios they've asked for
+        with run_stats.stage('compose'):
+            subscribers = dispatch.read_subscribers(list(portfolio_defs))
+            messages = dispatch.compose_messages(
+                ranked, name_mapping, subscribers,
+                os.environ['contact_email'], os.environ['contact_name'])
+        with run_stats.stage('send'):
+            dispatch.dispatch(messages)
+
+
+def main_kickoff():
+    """Function which orchestrates the rest of the code. Each stage is timed
+       and logged by run_stats with a summary logged at the end. If nothing
+       pulled from Yahoo has changed since the last run, the derived tables
+       and email are skipped. Tickers which failed to ingest aren't counted
+       as unchanged, so a run with any failures is never skipped.
+
+    Raises:
+        RuntimeError: if every ticker failed to ingest
+    """
+    run_stats.reset()
+    # portfolios for which we want reports and a dictionary connecting
+    # tickers to readible names. Used in email. Data is pulled once for
+    # every ticker in any portfolio.
+    portfolio_defs, name_mapping = portfolios.read_portfolios()
+    tickers = portfolios.all_tickers(portfolio_defs)
+    # set up storage variables
+    price_table_name = os.environ['PRICE_TABLENAME']
+    div_table_name = os.environ['DIVIDEND_TABLENAME']
+    # set up connection details
+    backend = storage.get_backend(price_table_name, div_table_name)
+    # get the max date in database for each ticker
+    stale_days = int(os.environ.get('STALE_DAYS', 7))
+    with run_stats.stage('watermarks'):
+        watermarks = get_watermarks(backend, price_table_name, tickers)
+    base_dt, pull_dts = plan_pulls(watermarks, stale_days)
+    fingerprints = get_fingerprints(backend, price_table_name)
+    # pull data for each ticker from Yahoo
+    with run_stats.stage('ingest'):
+        failed = ingest_tickers(pull_dts, backend, price_table_name,
+                                div_table_name, fingerprints)
+    if failed:
+        logging.warning('Failed to ingest: {}'.format(', '.join(failed)))
+        if set(failed) >= set(pull_dts):
+            raise RuntimeError('Failed to ingest every ticker')
+    if not failed and fingerprints is not None and \
+            not fingerprints.any_changed():
+        # nothing was written so the derived tables are already up to date
+        logging.info('No new data since the last run')
+    else:
+        finish_run(backend, portfolio_defs, name_mapping, base_dt,
+                   min(pull_dts.values()), price_table_name, div_table_name,
+                   stale_days)
+        if fingerprints is not None:
+            fingerprints.save()
+    run_stats.log_summary(backend)
 
 
 def error_email_body():
@@ -214,6 +571,21 @@ def error_email_body():
     return body
 
 
+def send_error_email():
+    """Logs what was done before a failure and emails the exception being
+       handled. Must be called from an except block.
+    """
+    # log what was done before the failure
+    run_stats.log_summary()
+    # capture the exception and send out a summary email.
+    subject = "There was an error with the hot potatoes run V3"
+    body = error_email_body()
+    email = eh.email_composition(os.environ['contact_email'],
+                                 os.environ['contact_name'],
+                                 subject, body)
+    eh.send_email(email)
+
+
 def kickoff(request):
     """Function which orchestrates the rest of the code
 
@@ -225,13 +597,7 @@ def kickoff(request):
         # try to run the main body of code
         main_kickoff()
     except Exception:
-        # if it fails. capture the exception and send out a summary email.
-        subject = "There was an error with the hot potatoes run V3"
-        body = error_email_body()
-        email = eh.email_composition(os.environ['contact_email'],
-                                     os.environ['contact_name'],
-                                     subject, body)
-        eh.send_email(email)
+        send_error_email()
 
 
 if __name__ == '__main__':
@@ -1,3 +1,3 @@
 SELECT max(snap_date) as max_dt
 FROM {}
-WHERE snap_date < {} and ticker = {};
+WHERE snap_date < @snap_date and ticker = @ticker;
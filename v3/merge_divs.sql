@@ -1,7 +1,8 @@
-merge {} as base
-using {} as load
+merge {0} as base
+using (SELECT * FROM {1} WHERE snap_date >= @min_dt) as load
 ON load.ticker = base.ticker
   and load.snap_date = base.snap_date
+  and base.snap_date >= @min_dt
 WHEN NOT MATCHED THEN
   INSERT(ticker, snap_date, amount)
   VALUES(ticker, snap_date, amount);
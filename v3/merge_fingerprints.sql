@@ -0,0 +1,8 @@
+merge {0} as base
+using {1} as load
+ON load.ticker = base.ticker
+WHEN MATCHED THEN
+  UPDATE SET max_dt = load.max_dt, content_hash = load.content_hash
+WHEN NOT MATCHED THEN
+  INSERT(ticker, max_dt, content_hash)
+  VALUES(ticker, max_dt, content_hash);
@@ -0,0 +1,8 @@
+merge {0} as base
+using (SELECT * FROM {1} WHERE snap_date >= @min_dt AND ticker = @ticker) as load
+ON load.ticker = base.ticker
+  and load.snap_date = base.snap_date
+  and base.snap_date >= @min_dt
+WHEN NOT MATCHED THEN
+  INSERT(ticker, snap_date, open, high, low, close, close_adj, volume)
+  VALUES(ticker, snap_date, open, high, low, close, close_adj, volume);
@@ -0,0 +1 @@
+CREATE OR REPLACE TABLE {0} COPY {1};
@@ -0,0 +1,112 @@
+"""Code used to read the portfolios reported on and rank their tickers.
+
+stocks.yaml can list a single portfolio with top level `tickers`:
+
+    tickers: ['VCN.TO', 'VFV.TO']
+
+or several named portfolios, each with its own tickers and optionally its own
+lookbacks in months:
+
+    lookbacks: [3, 6, 12]
+    portfolios:
+        couch_potato:
+            tickers: ['VCN.TO', 'VLB.TO']
+        us_only:
+            tickers: ['VFV.TO']
+            lookbacks: [12]
+
+Lookbacks default to the top level `lookbacks` and then to 12 months. The
+`mapping` of readable names is shared by every portfolio. Data is pulled once
+for the union of every portfolio's tickers and returns are calculated once
+for every lookback, then every portfolio and lookback is ranked together.
+"""
+import yaml
+import pandas as pd
+
+
+DEFAULT_LOOKBACKS = [12]
+# name of the portfolio made from a top level tickers list
+DEFAULT_PORTFOLIO = 'default'
+RANKING_COLUMNS = ['portfolio', 'lookback', 'ticker', 'total_return', 'rank']
+
+
+def read_portfolios(file_name='stocks.yaml'):
+    """Reads the portfolios to report on and the readable names of tickers
+
+    Args:
+        file_name (str): the YAML file listing the portfolios
+
+    Returns:
+        tuple: a dict mapping between portfolio names and dicts of their
+            tickers and lookbacks, and the dict mapping between tickers and
+            their definitions
+    """
+    with open(file_name) as yaml_file:
+        data = yaml.load(yaml_file, Loader=yaml.FullLoader)
+    lookbacks = data.get('lookbacks', DEFAULT_LOOKBACKS)
+    portfolios = data.get('portfolios') or \
+        {DEFAULT_PORTFOLIO: {'tickers': data['tickers']}}
+    portfolios = {name: {'tickers': list(portfolio['tickers']),
+                         'lookbacks': list(portfolio.get('lookbacks',
+                                                         lookbacks))}
+                  for name, portfolio in portfolios.items()}
+    return portfolios, data['mapping']
+
+
+def all_tickers(portfolios):
+    """Returns every ticker in any portfolio
+
+    Args:
+        portfolios (dict): the output of read_portfolios
+
+    Returns:
+        list: the tickers in the order they're first listed, without repeats
+    """
+    return list(dict.fromkeys(ticker for portfolio in portfolios.values()
+                              for ticker in portfolio['tickers']))
+
+
+def all_lookbacks(portfolios):
+    """Returns every lookback used by any portfolio
+
+    Args:
+        portfolios (dict): the output of read_portfolios
+
+    Returns:
+        list: the lookbacks in ascending order, without repeats
+    """
+    return sorted({lookback for portfolio in portfolios.values()
+                   for lookback in portfolio['lookbacks']})
+
+
+def rank_portfolios(returns, portfolios):
+    """Ranks the tickers of every portfolio over each of its lookbacks in one
+       pass over returns calculated once for the union of tickers
+
+    Args:
+        returns (df): total returns in percent with one row per ticker and
+            one column per lookback
+        portfolios (dict): the output of read_portfolios
+
+    Returns:
+        df: one row per portfolio, lookback and ticker with the
+            RANKING_COLUMNS. Rank 1 is the highest return and tickers with no
+            return are ranked last. Sorted by portfolio in the order they're
+            listed, lookback and rank.
+    """
+    members = pd.DataFrame([(name, lookback, ticker)
+                            for name, portfolio in portfolios.items()
+                            for lookback in portfolio['lookbacks']
+                            for ticker in portfolio['tickers']],
+                           columns=['portfolio', 'lookback', 'ticker'])
+    stacked = returns.rename_axis('ticker').reset_index().melt(
+        id_vars='ticker', var_name='lookback', value_name='total_return')
+    ranked = members.merge(stacked, on=['lookback', 'ticker'], how='left')
+    ranked['rank'] = ranked.groupby(['portfolio', 'lookback']) \
+        .total_return.rank(method='first', ascending=False,
+                           na_option='bottom').astype(int)
+    ranked['portfolio'] = pd.Categorical(ranked.portfolio,
+                                         categories=list(portfolios))
+    ranked = ranked.sort_values(['portfolio', 'lookback', 'rank'])
+    ranked['portfolio'] = ranked.portfolio.astype(str)
+    return ranked[RANKING_COLUMNS].reset_index(drop=True)
@@ -0,0 +1,180 @@
+"""On-disk cache of the price and dividend data pulled from Yahoo.
+
+Each ticker is stored as two Parquet files (prices and dividends) plus a small
+JSON file recording the earliest date covered and when it was last fetched.
+Within the time to live, cached data is returned without calling Yahoo. Once
+it expires, only the most recent days are pulled again so new bars are added
+and recently revised bars are replaced.
+"""
+import os
+import json
+import threading
+import datetime as dt
+import pandas as pd
+
+
+class PriceCache:
+    """Caches price and dividend data per ticker. Safe to share between
+       threads as long as each ticker is only worked on by one at a time.
+
+    Args:
+        cache_dir (str): folder to hold the cache. Created if needed.
+        ttl (timedelta): how long cached data is trusted before checking
+            Yahoo for new or revised bars.
+        revision_days (int): number of days before the last cached bar
+            pulled again once the cache has expired.
+    """
+
+    def __init__(self, cache_dir, ttl=dt.timedelta(hours=12),
+                 revision_days=7):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.revision_days = revision_days
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def path(self, ticker, kind):
+        """Returns the path of a cache file
+
+        Args:
+            ticker (str): the ticker the file is for
+            kind (str): 'price', 'div' or 'meta'
+
+        Returns:
+            str: the path of the file
+        """
+        extension = 'json' if kind == 'meta' else 'parquet'
+        return os.path.join(self.cache_dir,
+                            '{}.{}.{}'.format(ticker, kind, extension))
+
+    def read_meta(self, ticker):
+        """Returns the cache metadata for a ticker
+
+        Args:
+            ticker (str): the ticker to look up
+
+        Returns:
+            dict: the earliest date covered and when it was fetched. None if
+                the ticker isn't cached.
+        """
+        try:
+            with open(self.path(ticker, 'meta')) as meta_file:
+                meta = json.load(meta_file)
+        except FileNotFoundError:
+            return None
+        return {'start': pd.Timestamp(meta['start']),
+                'fetched_at': pd.Timestamp(meta['fetched_at'])}
+
+    def count(self, hit):
+        """Records a cache hit or miss
+
+        Args:
+            hit (bool): True for a hit, False for a miss
+        """
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def fetch_start(self, ticker, start_dt):
+        """Works out what needs to be pulled from Yahoo for a ticker
+
+        Args:
+            ticker (str): the ticker we want data for
+            start_dt (datetime): the earliest date we want data for
+
+        Returns:
+            Timestamp: the date to pull data from. None if the cache already
+                holds everything needed.
+        """
+        start_dt = pd.Timestamp(start_dt)
+        meta = self.read_meta(ticker)
+        if meta is None or start_dt < meta['start']:
+            self.count(False)
+            return start_dt
+        if pd.Timestamp.now() - meta['fetched_at'] < self.ttl:
+            self.count(True)
+            return None
+        self.count(False)
+        price = pd.read_parquet(self.path(ticker, 'price'))
+        if len(price) == 0:
+            return meta['start']
+        last_dt = price['Date'].max() - dt.timedelta(days=self.revision_days)
+        return max(meta['start'], last_dt)
+
+    def get(self, ticker, start_dt):
+        """Returns the cached data for a ticker from start_dt onwards
+
+        Args:
+            ticker (str): the ticker we want data for
+            start_dt (datetime): the earliest date to return
+
+        Returns:
+            tuple: the price data and the dividend data
+        """
+        start_dt = pd.Timestamp(start_dt)
+        price = pd.read_parquet(self.path(ticker, 'price'))
+        div = pd.read_parquet(self.path(ticker, 'div'))
+        price = price.loc[price['Date'] >= start_dt].reset_index(drop=True)
+        div = div.loc[div['Date'] >= start_dt].reset_index(drop=True)
+        return (price, div)
+
+    def update(self, ticker, fetch_dt, price, div):
+        """Adds newly pulled data to the cache. Cached rows from fetch_dt
+           onwards are replaced by the new data.
+
+        Args:
+            ticker (str): the ticker the data is for
+            fetch_dt (datetime): the date the data was pulled from
+            price (df): the newly pulled price data
+            div (df): the newly pulled dividend data
+        """
+        fetch_dt = pd.Timestamp(fetch_dt)
+        meta = self.read_meta(ticker)
+        start = fetch_dt
+        if meta is not None:
+            start = min(meta['start'], fetch_dt)
+            cached_price, cached_div = self.get(ticker, start)
+            price = pd.concat([cached_price.loc[cached_price['Date'] < fetch_dt],
+                               price], ignore_index=True)
+            div = pd.concat([cached_div.loc[cached_div['Date'] < fetch_dt],
+                             div], ignore_index=True)
+        price.to_parquet(self.path(ticker, 'price'), index=False)
+        div.to_parquet(self.path(ticker, 'div'), index=False)
+        with open(self.path(ticker, 'meta'), 'w') as meta_file:
+            json.dump({'start': start.isoformat(),
+                       'fetched_at': pd.Timestamp.now().isoformat()},
+                      meta_file)
+
+    def evict(self, tickers=None):
+        """Removes tickers from the cache so they are pulled in full next time
+
+        Args:
+            tickers (list): the tickers to remove. Removes all if not passed.
+        """
+        if tickers is None:
+            tickers = set(file_name.rsplit('.', 2)[0]
+                          for file_name in os.listdir(self.cache_dir))
+        for ticker in tickers:
+            for kind in ['meta', 'price', 'div']:
+                try:
+                    os.remove(self.path(ticker, kind))
+                except FileNotFoundError:
+                    pass
+
+
+def get_price_cache():
+    """Creates the price cache configured by the PRICE_CACHE_DIR and
+       PRICE_CACHE_TTL_HOURS environment variables.
+
+    Returns:
+        PriceCache: the cache. None if PRICE_CACHE_DIR isn't set.
+    """
+    cache_dir = os.environ.get('PRICE_CACHE_DIR')
+    if not cache_dir:
+        return None
+    ttl_hours = float(os.environ.get('PRICE_CACHE_TTL_HOURS', 12))
+    return PriceCache(cache_dir, ttl=dt.timedelta(hours=ttl_hours))
@@ -0,0 +1,3 @@
+SELECT ticker, snap_date, kind, reason
+FROM {}
+WHERE snap_date >= @since;
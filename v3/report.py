@@ -0,0 +1,186 @@
+"""Code used to render the summary email of returns.
+
+Only the leader, the top REPORT_TOP_K and the bottom REPORT_TOP_K tickers are
+listed, so the email stays the same size however many tickers are tracked.
+They're found with a partial sort (numpy's argpartition), which only orders
+the tickers shown rather than the whole universe. The HTML is filled in from
+templates compiled once when this module is imported.
+"""
+import os
+import html
+import string
+import numpy as np
+
+
+BODY_TEMPLATE = string.Template(
+    "<h3>Today's leader is $leader at $leader_return.</h3><br />Summary:<br />"
+    '<table border="1">'
+    '<thead><tr><th>Rank</th><th>Ticker</th><th>Desc</th><th>Return (%)</th>'
+    '</tr></thead>'
+    '<tbody>$rows</tbody></table>$missing')
+ROW_TEMPLATE = string.Template(
+    '<tr><td>$rank</td><td>$ticker</td><td>$desc</td><td>$value</td></tr>')
+GAP_TEMPLATE = string.Template(
+    '<tr><td colspan="4">$count more not shown</td></tr>')
+MISSING_TEMPLATE = string.Template('<br />No returns for: $tickers')
+SECTION_TEMPLATE = string.Template(
+    '<h2>$portfolio: $lookback month returns</h2>$body<br />')
+
+
+def report_top_k():
+    """Returns the number of tickers listed at each end of the ranking
+
+    Returns:
+        int: the REPORT_TOP_K setting. Defaults to 10.
+
+    Raises:
+        ValueError: if the setting is less than 1
+    """
+    k = int(os.environ.get('REPORT_TOP_K', 10))
+    if k < 1:
+        raise ValueError('REPORT_TOP_K must be at least 1, not {}'.format(k))
+    return k
+
+
+def short_name(ticker):
+    """Removes the exchange suffix from a ticker, e.g. VCN.TO becomes VCN
+
+    Args:
+        ticker (str): the ticker
+
+    Returns:
+        str: the ticker up to its last dot. Unchanged if it has no dot.
+    """
+    return ticker.rsplit('.', 1)[0]
+
+
+def label(ticker, name_mapping):
+    """Returns the name a ticker is shown under and its definition. Tickers
+       listed in the mapping with their suffix keep it, so tickers which only
+       differ by their suffix can be told apart. Others are shown without it.
+
+    Args:
+        ticker (str): the ticker
+        name_mapping (dict): maps between stock tickers and their definitions
+
+    Returns:
+        tuple: the name and the definition. The definition is empty if the
+            ticker isn't in the mapping.
+    """
+    if ticker in name_mapping:
+        return ticker, name_mapping[ticker]
+    name = short_name(ticker)
+    return name, name_mapping.get(name, '')
+
+
+def rank_order(values, k):
+    """Finds the positions of the highest and lowest values without sorting
+       every value
+
+    Args:
+        values (array): the values to rank. NaNs are left out.
+        k (int): the number of values to find at each end. At least 1.
+
+    Returns:
+        tuple: the positions of the top k values and the bottom k values,
+            both from highest to lowest. If there are no more than 2k values
+            the top holds all of them and the bottom is empty.
+    """
+    valid = np.flatnonzero(~np.isnan(values))
+    if len(valid) <= 2 * k:
+        return valid[np.argsort(-values[valid], kind='stable')], valid[:0]
+    top = valid[np.argpartition(-values[valid], k - 1)[:k]]
+    # ties at the cut-off could otherwise put a position in both
+    rest = valid[~np.isin(valid, top)]
+    bottom = rest[np.argpartition(values[rest], k - 1)[:k]]
+    return top[np.argsort(-values[top])], bottom[np.argsort(-values[bottom])]
+
+
+def render_rows(tickers, values, positions, first_rank, name_mapping):
+    """Renders one table row per position
+
+    Args:
+        tickers (array): every ticker
+        values (array): the return of every ticker
+        positions (array): the positions of the tickers to render, in order
+        first_rank (int): the rank of the first ticker rendered
+        name_mapping (dict): maps between stock tickers and their definitions
+
+    Returns:
+        str: the rendered rows
+    """
+    rows = []
+    for rank, position in enumerate(positions, first_rank):
+        name, desc = label(tickers[position], name_mapping)
+        rows.append(ROW_TEMPLATE.substitute(
+            rank=rank, ticker=html.escape(name), desc=html.escape(desc),
+            value='{:.2f}'.format(values[position])))
+    return ''.join(rows)
+
+
+def render_summary(pct, name_mapping, k=None):
+    """Renders the subject and body of the summary email
+
+    Args:
+        pct (dict or Series): maps between stock tickers and total returns
+        name_mapping (dict): maps between stock tickers and their definitions
+        k (int): the number of tickers listed at each end of the ranking.
+            Defaults to REPORT_TOP_K.
+
+    Returns:
+        tuple: the subject and the HTML body
+    """
+    k = report_top_k() if k is None else k
+    tickers = np.asarray(list(pct.keys()), dtype=object)
+    values = np.asarray(list(pct.values()) if isinstance(pct, dict)
+                        else pct.to_numpy(), dtype=float)
+    top, bottom = rank_order(values, k)
+    if len(top) == 0:
+        raise ValueError('No returns to report')
+    leader, _ = label(tickers[top[0]], name_mapping)
+    valid = len(values) - np.isnan(values).sum()
+    rows = render_rows(tickers, values, top, 1, name_mapping)
+    if len(bottom) > 0:
+        rows += GAP_TEMPLATE.substitute(count=valid - 2 * k)
+        rows += render_rows(tickers, values, bottom, valid - k + 1,
+                            name_mapping)
+    missing = tickers[np.isnan(values)]
+    missing = MISSING_TEMPLATE.substitute(tickers=html.escape(', '.join(
+        label(ticker, name_mapping)[0] for ticker in missing))) \
+        if len(missing) > 0 else ''
+    subject = '{} has the highest returns'.format(leader)
+    body = BODY_TEMPLATE.substitute(
+        leader=html.escape(leader),
+        leader_return='{:.2f}'.format(values[top[0]]), rows=rows,
+        missing=missing)
+    return subject, body
+
+
+def render_portfolios(ranked, name_mapping, k=None):
+    """Renders an email with a summary table for each portfolio and
+       lookback. With a single portfolio and lookback it matches
+       render_summary.
+
+    Args:
+        ranked (df): the output of portfolios.rank_portfolios
+        name_mapping (dict): maps between stock tickers and their definitions
+        k (int): the number of tickers listed at each end of each ranking.
+            Defaults to REPORT_TOP_K.
+
+    Returns:
+        tuple: the subject and the HTML body
+    """
+    sections = []
+    for (name, lookback), group in ranked.groupby(['portfolio', 'lookback'],
+                                                  sort=False):
+        pct = group.set_index('ticker')['total_return']
+        subject, body = render_summary(pct, name_mapping, k)
+        sections.append((name, lookback, subject, body))
+    if len(sections) == 1:
+        return sections[0][2], sections[0][3]
+    name, lookback, subject, _ = sections[0]
+    subject = '{} ({}, {} months)'.format(subject, name, lookback)
+    body = ''.join(SECTION_TEMPLATE.substitute(
+        portfolio=html.escape(name), lookback=lookback, body=section)
+        for name, lookback, _, section in sections)
+    return subject, body
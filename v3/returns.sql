@@ -0,0 +1,24 @@
+WITH bounds AS (
+  SELECT ticker,
+    MAX(CASE WHEN snap_date < @start_dt THEN snap_date END) AS start_dt,
+    MAX(CASE WHEN snap_date < @end_dt THEN snap_date END) AS end_dt
+  FROM {0}
+  GROUP BY ticker
+), closes AS (
+  SELECT bounds.ticker, bounds.start_dt, bounds.end_dt,
+    MAX(CASE WHEN price.snap_date = bounds.start_dt THEN price.close END) AS start_close,
+    MAX(CASE WHEN price.snap_date = bounds.end_dt THEN price.close END) AS end_close
+  FROM bounds
+  JOIN {0} AS price
+    ON price.ticker = bounds.ticker
+    AND price.snap_date IN (bounds.start_dt, bounds.end_dt)
+  GROUP BY 1, 2, 3
+)
+SELECT closes.ticker, closes.start_dt, closes.end_dt, closes.start_close,
+  closes.end_close, COALESCE(SUM(divs.amount), 0) AS tot_amt
+FROM closes
+LEFT JOIN {1} AS divs
+  ON divs.ticker = closes.ticker
+  AND divs.snap_date > closes.start_dt
+  AND divs.snap_date <= closes.end_dt
+GROUP BY 1, 2, 3, 4, 5;
@@ -0,0 +1,166 @@
+"""Code used to time each stage of a run and count the work done in it.
+
+Stages are timed by wrapping them in `with run_stats.stage('fetch'):`. Work
+done while a stage is open (queries run, rows moved, bytes billed by BigQuery
+and retries) is added to it by calling record() from wherever the work
+happens. Stages can be nested and work is added to every open stage. Work
+done on worker threads is added to the stages open on the thread which
+started the run as well as any the worker opened itself.
+
+Each stage is logged as a single line of JSON when it ends so the logs can be
+filtered and charted. log_summary() logs a table totalling each stage and,
+if RUN_STATS_TABLE is set, writes it to that table.
+"""
+import os
+import sys
+import json
+import time
+import contextlib
+import logging
+import threading
+import pandas as pd
+
+
+STATS_COLUMNS = ['rows', 'queries', 'bytes_billed', 'retries']
+SUMMARY_COLUMNS = ['stage', 'calls', 'seconds'] + STATS_COLUMNS
+
+# stage lines are written as bare JSON so they are parsed as structured logs
+logger = logging.getLogger('hot_potatoes.run_stats')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(logging.Formatter('%(message)s'))
+logger.addHandler(_handler)
+
+_lock = threading.Lock()
+_local = threading.local()
+_run = {'thread': threading.get_ident(), 'stack': [], 'stages': []}
+
+
+class Stage:
+    """The measurements of one pass through a stage
+
+    Args:
+        name (str): the name of the stage
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.status = 'ok'
+        self.stats = dict.fromkeys(STATS_COLUMNS, 0)
+
+    def as_dict(self):
+        """Returns the measurements ready to be logged
+
+        Returns:
+            dict: the stage name, status, seconds and stats
+        """
+        return dict({'stage': self.name, 'status': self.status,
+                     'seconds': round(self.seconds, 4)}, **self.stats)
+
+
+def reset():
+    """Starts a new run. Stages opened on the calling thread are treated as
+       the parents of work done on worker threads.
+    """
+    with _lock:
+        _run['thread'] = threading.get_ident()
+        _run['stack'] = []
+        _run['stages'] = []
+
+
+def _stack():
+    """Returns the stages opened on the current thread
+
+    Returns:
+        list: the open stages, outermost first
+    """
+    if threading.get_ident() == _run['thread']:
+        return _run['stack']
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Times a stage and logs it when it ends
+
+    Args:
+        name (str): the name of the stage
+
+    Yields:
+        Stage: the measurements of the stage
+    """
+    current = Stage(name)
+    with _lock:
+        _stack().append(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        current.status = 'error'
+        raise
+    finally:
+        current.seconds = time.perf_counter() - start
+        with _lock:
+            _stack().remove(current)
+            _run['stages'].append(current)
+        logger.info(json.dumps(dict({'severity': 'INFO',
+                                     'message': 'stage '+name},
+                                    **current.as_dict())))
+
+
+def record(**stats):
+    """Adds work to every open stage
+
+    Args:
+        **stats: amounts to add, any of rows, queries, bytes_billed and
+            retries
+    """
+    with _lock:
+        open_stages = list(_stack())
+        if threading.get_ident() != _run['thread']:
+            open_stages += _run['stack']
+        for open_stage in open_stages:
+            for name, value in stats.items():
+                open_stage.stats[name] += value or 0
+
+
+def summary():
+    """Totals the stages run so far by name
+
+    Returns:
+        df: one row per stage in the order they first ended, with the
+            SUMMARY_COLUMNS. Stages run on several threads at once are
+            summed so their seconds can exceed the wall time.
+    """
+    with _lock:
+        rows = [dict(done.stats, stage=done.name, seconds=done.seconds,
+                     calls=1) for done in _run['stages']]
+    if not rows:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+    data = pd.DataFrame(rows)
+    data = data.groupby('stage', sort=False).sum().reset_index()
+    return data[SUMMARY_COLUMNS]
+
+
+def log_summary(backend=None):
+    """Logs the summary of the run. If RUN_STATS_TABLE is set and a backend
+       is passed, the summary is also written to that table.
+
+    Args:
+        backend (storage backend): open backend to write the summary to.
+            Optional.
+
+    Returns:
+        df: the summary
+    """
+    data = summary()
+    logging.info('Run summary:\n{}'.format(data.round(3).to_string(index=False)))
+    table_name = os.environ.get('RUN_STATS_TABLE')
+    if table_name and backend is not None and len(data) > 0:
+        data.insert(0, 'run_at', pd.Timestamp.now().floor('s'))
+        backend.write(data, table_name)
+    return data
@@ -0,0 +1,324 @@
+"""Code used to split a run into shards of tickers which can be spread across
+several workers and picked up again after a failure.
+
+A run is planned by worker 0, which works out the date to pull each ticker
+from and writes one pending checkpoint per ticker to a table named
+`checkpoints_` followed by the price table name. Tickers are grouped into
+shards of SHARD_SIZE and each of WORKER_COUNT workers ingests the shards
+whose number modulo WORKER_COUNT is its WORKER_INDEX. Once a shard is
+ingested its tickers are checkpointed as done, or failed so they're retried
+by the next worker to run, up to MAX_ATTEMPTS times.
+
+Checkpoints are only ever appended so workers never overwrite each other.
+The latest checkpoint of a ticker is the one with the highest attempt. A
+worker stops starting new shards once RUN_TIME_BUDGET seconds have passed.
+Anything left is picked up by the next invocation. Merges skip rows which are
+already in the base tables so a shard which was cut off part way through can
+safely be ingested again. When there are several workers, each stages its
+data in its own load tables (e.g. load_1_prices) so workers running at once
+don't empty each other's.
+
+Once no shards are left, worker 0 updates the total return index, sends
+the monthly email if due and checkpoints the run as finalized. Schedule
+every worker to run more often than once a day (e.g. hourly); invocations
+after the day's run has been finalized do nothing.
+"""
+import os
+import sys
+import time
+import logging
+import datetime as dt
+import pandas as pd
+import main
+import storage
+import run_stats
+import portfolios
+from fingerprints import get_fingerprints
+
+
+# statuses a ticker's checkpoint can have. the finalized checkpoint is written
+# once for the whole run with no ticker
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+FINALIZED = 'finalized'
+CHECKPOINT_COLUMNS = ['run_id', 'shard', 'ticker', 'pull_dt', 'status',
+                      'attempt', 'updated_at']
+
+
+def checkpoint_table_name(price_table_name):
+    """Returns the name of the checkpoint table for a price table
+
+    Args:
+        price_table_name (str): the name of the price table
+
+    Returns:
+        str: the name of the checkpoint table
+    """
+    return 'checkpoints_'+price_table_name
+
+
+def shard_tickers(tickers, shard_size):
+    """Splits tickers into shards
+
+    Args:
+        tickers (list): the tickers to split
+        shard_size (int): the maximum number of tickers per shard
+
+    Returns:
+        dict: maps between each ticker and its shard number
+    """
+    return {ticker: i // shard_size for i, ticker in enumerate(tickers)}
+
+
+def write_checkpoints(backend, table_name, run_id, checkpoints, status):
+    """Appends checkpoints for tickers
+
+    Args:
+        backend (storage backend): open backend to write to
+        table_name (str): the name of the checkpoint table
+        run_id (str): the run the checkpoints are for
+        checkpoints (df): the shard, ticker, pull_dt and attempt of each
+            checkpoint
+        status (str): the status of every checkpoint
+    """
+    data = checkpoints[['shard', 'ticker', 'pull_dt', 'attempt']].copy()
+    data.insert(0, 'run_id', run_id)
+    data.insert(4, 'status', status)
+    data['updated_at'] = pd.Timestamp.now().floor('s')
+    backend.write(data[CHECKPOINT_COLUMNS], table_name)
+
+
+def read_checkpoints(backend, table_name, run_id):
+    """Reads the latest checkpoint of each ticker in a run
+
+    Args:
+        backend (storage backend): open backend to use for querying
+        table_name (str): the name of the checkpoint table
+        run_id (str): the run to read
+
+    Returns:
+        df: one row per ticker with its shard, pull_dt, status and attempt.
+            The finalized checkpoint has an empty ticker.
+    """
+    return backend.run('checkpoint_status.sql', [table_name],
+                       {'run_id': run_id})
+
+
+def plan_run(backend, table_name, run_id, tickers, price_table_name,
+             stale_days, shard_size):
+    """Works out the date to pull each ticker from and checkpoints every
+       ticker as pending
+
+    Args:
+        backend (storage backend): open backend to use
+        table_name (str): the name of the checkpoint table
+        run_id (str): the run being planned
+        tickers (list): the tickers to ingest
+        price_table_name (str): the name of the price table
+        stale_days (int): how many days a ticker can be behind before it is
+            considered stale
+        shard_size (int): the maximum number of tickers per shard
+
+    Returns:
+        df: the pending checkpoints
+    """
+    with run_stats.stage('watermarks'):
+        watermarks = main.get_watermarks(backend, price_table_name, tickers)
+    _, pull_dts = main.plan_pulls(watermarks, stale_days)
+    shards = shard_tickers(tickers, shard_size)
+    checkpoints = pd.DataFrame({'ticker': tickers,
+                                'shard': [shards[t] for t in tickers],
+                                'pull_dt': [pull_dts[t] for t in tickers],
+                                'attempt': 0})
+    write_checkpoints(backend, table_name, run_id, checkpoints, PENDING)
+    logging.info('Planned run {} with {} shards'.format(
+        run_id, checkpoints.shard.nunique()))
+    return checkpoints.assign(status=PENDING)
+
+
+def current_run(backend, table_name, worker_index, tickers, price_table_name,
+                stale_days, shard_size):
+    """Finds the run to work on. The latest run is resumed if it hasn't been
+       finalized. Otherwise worker 0 plans a new one if today's hasn't been.
+
+    Args:
+        backend (storage backend): open backend to use
+        table_name (str): the name of the checkpoint table
+        worker_index (int): the number of this worker
+        tickers (list): the tickers to ingest
+        price_table_name (str): the name of the price table
+        stale_days (int): how many days a ticker can be behind before it is
+            considered stale
+        shard_size (int): the maximum number of tickers per shard
+
+    Returns:
+        tuple: the run id and its latest checkpoints. Both are None if
+            there is nothing to do.
+    """
+    latest = backend.run('checkpoint_latest.sql', [table_name])
+    run_id = latest.run_id.iloc[0] if len(latest) > 0 else None
+    if pd.notna(run_id):
+        checkpoints = read_checkpoints(backend, table_name, run_id)
+        if not (checkpoints.status == FINALIZED).any():
+            logging.info('Resuming run {}'.format(run_id))
+            return run_id, checkpoints
+    today = dt.date.today().isoformat()
+    if run_id == today or worker_index != 0:
+        return None, None
+    return today, plan_run(backend, table_name, today, tickers,
+                           price_table_name, stale_days, shard_size)
+
+
+def remaining(checkpoints, max_attempts):
+    """Returns the checkpoints of tickers which still need to be ingested
+
+    Args:
+        checkpoints (df): the latest checkpoint of each ticker
+        max_attempts (int): the number of times a ticker is tried
+
+    Returns:
+        df: the pending tickers and failed tickers with attempts left
+    """
+    retry = (checkpoints.status == FAILED) & \
+        (checkpoints.attempt < max_attempts)
+    return checkpoints[(checkpoints.status == PENDING) | retry]
+
+
+def run_shard(backend, table_name, run_id, shard, price_table_name,
+              div_table_name, fingerprints=None):
+    """Ingests a shard and checkpoints each of its tickers as done or failed.
+       Tickers unchanged since their last fingerprint aren't written again.
+
+    Args:
+        backend (storage backend): open backend to use
+        table_name (str): the name of the checkpoint table
+        run_id (str): the run the shard is part of
+        shard (df): the latest checkpoints of the tickers in the shard
+        price_table_name (str): the name of the price table
+        div_table_name (str): the name of the dividend table
+        fingerprints (Fingerprints): fingerprints of the last run's data.
+            Saved once the shard is ingested. Optional.
+
+    Returns:
+        list: the tickers which failed to ingest
+    """
+    pull_dts = dict(zip(shard.ticker, shard.pull_dt))
+    with run_stats.stage('ingest'):
+        failed = main.ingest_tickers(pull_dts, backend, price_table_name,
+                                     div_table_name, fingerprints)
+    if fingerprints is not None:
+        fingerprints.save()
+    shard = shard.assign(attempt=shard.attempt + 1)
+    is_failed = shard.ticker.isin(failed)
+    for status, rows in [(DONE, shard[~is_failed]),
+                         (FAILED, shard[is_failed])]:
+        if len(rows) > 0:
+            write_checkpoints(backend, table_name, run_id, rows, status)
+    return failed
+
+
+def finalize_run(backend, table_name, run_id, checkpoints, portfolio_defs,
+                 name_mapping, price_table_name, div_table_name, stale_days):
+    """Updates the derived tables, emails the returns if due and
+       checkpoints the run as finalized
+
+    Args:
+        backend (storage backend): open backend to use
+        table_name (str): the name of the checkpoint table
+        run_id (str): the run to finalize
+        checkpoints (df): the latest checkpoint of each ticker
+        portfolio_defs (dict): the portfolios to report on, as returned by
+            portfolios.read_portfolios
+        name_mapping (dict): maps between stock tickers and their definitions
+        price_table_name (str): the name of the price table
+        div_table_name (str): the name of the dividend table
+        stale_days (int): how many days a ticker can be behind before it is
+            considered stale
+    """
+    given_up = checkpoints.ticker[checkpoints.status == FAILED].tolist()
+    if given_up:
+        logging.warning('Failed to ingest: {}'.format(', '.join(given_up)))
+    # the watermarks before the run are the pull dates plus the week of overlap
+    watermarks = checkpoints.set_index('ticker').pull_dt + \
+        dt.timedelta(days=7)
+    base_dt, _ = main.split_stale(watermarks, stale_days)
+    main.finish_run(backend, portfolio_defs, name_mapping, base_dt,
+                    checkpoints.pull_dt.min(), price_table_name,
+                    div_table_name, stale_days)
+    final = pd.DataFrame({'shard': [-1], 'ticker': [''],
+                          'pull_dt': [base_dt], 'attempt': [0]})
+    write_checkpoints(backend, table_name, run_id, final, FINALIZED)
+    logging.info('Finalized run {}'.format(run_id))
+
+
+def run_worker(worker_index, worker_count):
+    """Ingests this worker's shards of the current run until none are left
+       or its time budget runs out. Worker 0 also plans and finalizes runs.
+
+    Args:
+        worker_index (int): the number of this worker, from 0
+        worker_count (int): the number of workers sharing the run
+    """
+    deadline = time.monotonic() + float(os.environ.get('RUN_TIME_BUDGET',
+                                                       480))
+    run_stats.reset()
+    portfolio_defs, name_mapping = portfolios.read_portfolios()
+    tickers = portfolios.all_tickers(portfolio_defs)
+    price_table_name = os.environ['PRICE_TABLENAME']
+    div_table_name = os.environ['DIVIDEND_TABLENAME']
+    table_name = checkpoint_table_name(price_table_name)
+    stale_days = int(os.environ.get('STALE_DAYS', 7))
+    shard_size = int(os.environ.get('SHARD_SIZE', 500))
+    max_attempts = int(os.environ.get('MAX_ATTEMPTS', 3))
+    backend = storage.get_backend(price_table_name, div_table_name)
+    if worker_count > 1:
+        # workers may run at once so each stages data in its own load tables
+        backend.use_load_tables('load_{}_'.format(worker_index),
+                                [price_table_name, div_table_name])
+    run_id, checkpoints = current_run(backend, table_name, worker_index,
+                                      tickers, price_table_name, stale_days,
+                                      shard_size)
+    if run_id is None:
+        logging.info('Nothing to do')
+        return
+    todo = remaining(checkpoints, max_attempts)
+    todo = todo[todo.shard % worker_count == worker_index]
+    fingerprints = get_fingerprints(backend, price_table_name)
+    for shard_number, shard in todo.groupby('shard'):
+        if time.monotonic() > deadline:
+            logging.info('Out of time before shard {}'.format(shard_number))
+            break
+        run_shard(backend, table_name, run_id, shard, price_table_name,
+                  div_table_name, fingerprints)
+    if worker_index == 0:
+        checkpoints = read_checkpoints(backend, table_name, run_id)
+        if len(remaining(checkpoints, max_attempts)) == 0:
+            finalize_run(backend, table_name, run_id, checkpoints,
+                         portfolio_defs, name_mapping, price_table_name,
+                         div_table_name, stale_days)
+    run_stats.log_summary(backend)
+
+
+def kickoff(request):
+    """Runs a worker as a Google Cloud Function. The worker is picked by the
+       worker and workers query string arguments, falling back to the
+       WORKER_INDEX and WORKER_COUNT environment variables.
+
+    Args:
+        request: passed as part of the Google Function orchestration service.
+    """
+    args = getattr(request, 'args', {})
+    worker_index = int(args.get('worker', os.environ.get('WORKER_INDEX', 0)))
+    worker_count = int(args.get('workers', os.environ.get('WORKER_COUNT', 1)))
+    try:
+        run_worker(worker_index, worker_count)
+    except Exception:
+        main.send_error_email()
+
+
+if __name__ == '__main__':
+    # e.g. python scheduler.py 1 4 runs the second of four workers
+    worker_index = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    worker_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    run_worker(worker_index, worker_count)
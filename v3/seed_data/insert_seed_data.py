@@ -1,83 +1,146 @@
 """Writes CSVs from YF to BQ table. Assumes manually downloaded files.
 2 per financial instrument. One using 'Historical Prices'. This gives
 no dividend data when manually downloaded. One using 'Dividends Only'.
+
+Files are parsed in parallel and written to the storage backend in chunks
+as they finish so large backfills don't need to fit in memory at once.
 """
 import os
+import sys
 import glob
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
-from google.cloud import bigquery
+# storage lives in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import storage
+
+
+# set logging level
+logging.basicConfig(level=logging.INFO)
+
+PRICE_COLUMNS = ['Date', 'Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
+PRICE_DTYPES = {'Open': 'float64', 'High': 'float64', 'Low': 'float64',
+                'Close': 'float64', 'Adj Close': 'float64',
+                'Volume': 'float64'}
+DIV_COLUMNS = ['Date', 'Dividends']
+DIV_DTYPES = {'Dividends': 'float64'}
+DIV_SUFFIX = '.DIV'
 
 
-def process_file(file_name, ticker_name):
+def process_file(file_name, ticker_name, is_div):
     """Takes in a csv and processes it for writing to GBQ
 
     Args:
         file_name (str): the name of the csv to be processed
         ticker_name (str): the name of the ticker the CSV contains info on
+        is_div (bool): True if the CSV holds dividends rather than prices
 
     Returns:
         df: properly formatted df for writing to GBQ
     """
-    df = pd.read_csv(file_name)
-    df['Date'] = pd.to_datetime(df.Date, infer_datetime_format=True)
+    columns = DIV_COLUMNS if is_div else PRICE_COLUMNS
+    dtypes = DIV_DTYPES if is_div else PRICE_DTYPES
+    df = pd.read_csv(file_name, header=0, names=columns, dtype=dtypes,
+                     parse_dates=['Date'], date_format='%Y-%m-%d')
+    if not is_div:
+        # Yahoo writes 'null' for days without prices
+        df = df.dropna(subset=['Close'])
+        df = df.astype({'Volume': 'int64'})
     df.insert(0, 'Ticker', ticker_name)
     return df
 
 
-def write_to_gbq(data, client, table):
-    """Takes in a dataframe and writes the values to GBQ
+def parse_file_name(file_name):
+    """Takes in a filename and extracts the ticker embedded in it and whether
+       it holds dividend data. e.g. VCN.TO.csv holds prices for VCN.TO and
+       VCN.TO.DIV.csv holds dividends for VCN.TO.
 
     Args:
-        data (df): the dataframe to be written
-        client (Client): GBQ client
-        table (GBQ Table): GBQ table reference
+        file_name (str): the name of the csv file to extract from
+
+    Returns:
+        tuple: the ticker name and True if the file holds dividend data
     """
-    rows_to_insert = data.values.tolist()
-    # write data
-    errors = client.insert_rows(table, rows_to_insert)
-    assert errors == []
+    ticker_name = os.path.basename(file_name)[:-len('.csv')]
+    is_div = ticker_name.upper().endswith(DIV_SUFFIX)
+    if is_div:
+        ticker_name = ticker_name[:-len(DIV_SUFFIX)]
+    return ticker_name, is_div
 
 
-def name_extractor(file_name):
-    """Takes in a filename and extracts the ticker embedded in it
+def write_chunk(frames, backend, table_name):
+    """Writes a list of dataframes to a table in one write
 
     Args:
-        file_name (str): the name of the csv file to extract from
+        frames (list): the dataframes to be written
+        backend (storage backend): open backend to write to
+        table_name (str): the name of the table to be written to
 
     Returns:
-        str: the ticker name for which the file holds data
+        int: the number of rows written
     """
-    splitter = '.'
-    locs = [pos for pos, char in enumerate(file_name) if char == splitter]
-    ticker_name = file_name[:locs[1]]
-    return ticker_name
+    if len(frames) == 0:
+        return 0
+    data = pd.concat(frames, ignore_index=True)
+    backend.write(data, table_name)
+    return len(data)
+
+
+def load_files(file_names, backend, price_tablename, dividend_tablename,
+               max_workers=None, chunk_rows=storage.CHUNK_ROWS):
+    """Parses csvs in a process pool and writes them to the backend in
+       chunks of about chunk_rows rows as they finish.
+
+    Args:
+        file_names (list): the csvs to be loaded
+        backend (storage backend): open backend to write to
+        price_tablename (str): the name of the price table
+        dividend_tablename (str): the name of the dividend table
+        max_workers (int): the number of processes used to parse files.
+            Defaults to the number of CPUs.
+        chunk_rows (int): the number of rows to collect before writing
+
+    Returns:
+        int: the number of rows written
+    """
+    table_names = {False: price_tablename, True: dividend_tablename}
+    pending = {False: [], True: []}
+    rows = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for file_name in file_names:
+            ticker_name, is_div = parse_file_name(file_name)
+            future = executor.submit(process_file, file_name, ticker_name,
+                                     is_div)
+            futures[future] = is_div
+        for future in as_completed(futures):
+            is_div = futures[future]
+            pending[is_div].append(future.result())
+            if sum(len(df) for df in pending[is_div]) >= chunk_rows:
+                rows += write_chunk(pending[is_div], backend,
+                                    table_names[is_div])
+                pending[is_div] = []
+    for is_div, frames in pending.items():
+        rows += write_chunk(frames, backend, table_names[is_div])
+    return rows
 
 
 if __name__ == '__main__':
-    # setup connection variables for GBQ
-    project = os.environ['PROJECT']
-    dataset = os.environ['DATASET']
+    # setup connection variables
     price_tablename = os.environ['PRICE_TABLENAME']
     dividend_tablename = os.environ['DIVIDEND_TABLENAME']
-    client = bigquery.Client()
-    dataset_ref = client.dataset(dataset)
-    price_table_ref = bigquery.TableReference(dataset_ref, price_tablename)
-    price_table = client.get_table(price_table_ref)
-    div_table_ref = bigquery.TableReference(dataset_ref, dividend_tablename)
-    div_table = client.get_table(div_table_ref)
-
-    # pull all csvs in local folder and process list
-    csvs = [f for f in glob.glob("*.csv")]
-    csvs = sorted(csvs, key=str.casefold)
-    tickers = set(name_extractor(name) for name in csvs)
-    ticker_map = {}
-    for ticker in tickers:
-        ticker_map[ticker] = [csv for csv in csvs if ticker in csv]
-
-    # process and upload data for each ticker
-    for key in ticker_map.keys():
-        price_data = process_file(ticker_map[key][0], key)
-        write_to_gbq(price_data, client, price_table)
-        if len(ticker_map[key]) == 2:
-            dividend_data = process_file(ticker_map[key][1], key)
-            write_to_gbq(dividend_data, client, div_table)
+    if os.environ.get('STORAGE_BACKEND', 'bigquery') == 'bigquery':
+        backend = storage.BigQueryBackend(os.environ['PROJECT'],
+                                          os.environ['DATASET'])
+    else:
+        backend = storage.get_backend(price_tablename, dividend_tablename)
+
+    # pull all csvs in local folder and load them
+    csvs = sorted(glob.glob("*.csv"), key=str.casefold)
+    start = time.monotonic()
+    rows = load_files(csvs, backend, price_tablename, dividend_tablename)
+    elapsed = time.monotonic() - start
+    logging.info('Loaded {} rows from {} files in {:.1f}s ({:.0f} rows/sec)'
+                 .format(rows, len(csvs), elapsed, rows / max(elapsed, 1e-9)))
@@ -0,0 +1 @@
+CREATE TABLE IF NOT EXISTS {0} AS SELECT * FROM {1} WHERE 0;
@@ -0,0 +1,7 @@
+INSERT INTO {0} (ticker, max_dt, content_hash)
+SELECT ticker, max_dt, content_hash
+FROM {1}
+WHERE true
+ON CONFLICT (ticker) DO UPDATE SET
+  max_dt = excluded.max_dt,
+  content_hash = excluded.content_hash;
@@ -0,0 +1,11 @@
+INSERT INTO {0} (ticker, snap_date, open, high, low, close, close_adj, volume)
+SELECT ticker, snap_date, open, high, low, close, close_adj, volume
+FROM {1} AS load
+WHERE load.snap_date >= @min_dt
+  AND load.ticker = @ticker
+  AND NOT EXISTS (
+    SELECT 1
+    FROM {0} AS base
+    WHERE load.ticker = base.ticker
+      AND load.snap_date = base.snap_date
+  );
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS {2} ON {0} (snap_date);
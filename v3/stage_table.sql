@@ -0,0 +1,4 @@
+CREATE TABLE {0}
+PARTITION BY DATETIME_TRUNC(snap_date, MONTH)
+CLUSTER BY ticker
+AS SELECT * FROM {1};
@@ -0,0 +1,552 @@
+"""Storage backends used to hold and query the price and dividend data.
+
+Both backends expose the same methods so the rest of the code does not need
+to know where the data lives:
+    table_path: returns the quoted path of a table for use in SQL
+    read_sql: returns the SQL template with the passed file name
+    run: runs a SQL template against tables with bound parameters
+    load_table_name: returns the name of the load table used to stage data
+        for a table
+    query: runs SQL with bound parameters and returns the result
+    write: writes a dataframe to a table
+    load: replaces the contents of a table with a dataframe in one bulk load
+
+SQL templates are read once when this module is imported. Table paths are
+filled in with str.format and values are always passed as bound parameters
+(@name in the SQL). Results of SELECT templates are cached for the life of the
+backend and the cache is cleared whenever data is written.
+
+BigQueryBackend wraps the helpers in google_helpers. The BigQuery libraries
+are only imported once a BigQueryBackend is created and the client is shared
+through clients so warm starts of the Cloud Function reuse it.
+SQLiteBackend keeps the same tables in a local SQLite file which is useful for
+testing, benchmarking and small universes which don't need a warehouse.
+"""
+import os
+import glob
+import sqlite3
+import threading
+import datetime as dt
+import pandas as pd
+import run_stats
+import clients
+
+
+# folder holding the SQL templates
+SQL_DIR = os.path.dirname(os.path.abspath(__file__))
+# folder holding SQL which has to differ from the BigQuery version
+SQLITE_SQL_DIR = os.path.join(SQL_DIR, 'sqlite')
+# maximum number of rows converted at once when writing to SQLite or
+# streaming seed data
+CHUNK_ROWS = 100000
+# SQLite steps between counts when measuring how much a query reads
+SCAN_STEPS = 100
+# columns returned by queries which hold dates
+DATE_COLUMNS = ['snap_date', 'max_dt', 'min_dt', 'start_dt', 'end_dt',
+                'pull_dt']
+PRICE_SCHEMA = ('ticker TEXT, snap_date TEXT, open REAL, high REAL, '
+                'low REAL, close REAL, close_adj REAL, volume INTEGER')
+DIV_SCHEMA = 'ticker TEXT, snap_date TEXT, amount REAL'
+TR_INDEX_SCHEMA = 'ticker TEXT, snap_date TEXT, tr_index REAL'
+RUN_STATS_SCHEMA = ('run_at TEXT, stage TEXT, calls INTEGER, seconds REAL, '
+                    'rows INTEGER, queries INTEGER, bytes_billed INTEGER, '
+                    'retries INTEGER')
+FINGERPRINT_SCHEMA = 'ticker TEXT, max_dt TEXT, content_hash TEXT'
+QUARANTINE_SCHEMA = ('ticker TEXT, snap_date TEXT, kind TEXT, value REAL, '
+                     'reason TEXT, found_at TEXT')
+CHECKPOINT_SCHEMA = ('run_id TEXT, shard INTEGER, ticker TEXT, pull_dt TEXT, '
+                     'status TEXT, attempt INTEGER, updated_at TEXT')
+
+
+def load_templates(sql_dir):
+    """Reads every SQL template in a folder
+
+    Args:
+        sql_dir (str): the folder to read from
+
+    Returns:
+        dict: maps between file names and SQL templates
+    """
+    templates = {}
+    for file_name in glob.glob(os.path.join(sql_dir, '*.sql')):
+        with open(file_name) as sql_file:
+            templates[os.path.basename(file_name)] = sql_file.read()
+    return templates
+
+
+# SQL templates, read once at import
+TEMPLATES = load_templates(SQL_DIR)
+SQLITE_TEMPLATES = dict(TEMPLATES, **load_templates(SQLITE_SQL_DIR))
+
+
+class Backend:
+    """Logic shared by all backends. Not used directly.
+    """
+    templates = TEMPLATES
+    # whether the partitioned layout is only stood in for, e.g. by an index,
+    # so scan_cost may show savings on queries BigQuery couldn't prune
+    emulates_layout = False
+
+    def __init__(self):
+        self.results = {}
+        # load tables are named this followed by their base table's name
+        self.load_prefix = 'load_'
+
+    def load_table_name(self, table_name):
+        """Returns the name of the load table used to stage data for a table
+
+        Args:
+            table_name (str): the name of the base table
+
+        Returns:
+            str: the name of the load table
+        """
+        return self.load_prefix+table_name
+
+    def use_load_tables(self, load_prefix, table_names):
+        """Stages data in load tables with a different prefix, creating them
+           like their base tables if they don't exist. Lets several
+           processes ingest at once without emptying each other's load
+           tables.
+
+        Args:
+            load_prefix (str): the prefix of the load tables
+            table_names (list): the names of the base tables
+        """
+        self.load_prefix = load_prefix
+        for table_name in table_names:
+            _ = self.run('create_load.sql',
+                         [self.load_table_name(table_name), table_name])
+
+    def read_sql(self, file_name):
+        """Returns the SQL template with the passed file name
+
+        Args:
+            file_name (str): the name of the SQL file
+
+        Returns:
+            str: the SQL template
+        """
+        return self.templates[file_name]
+
+    def render_sql(self, file_name, tables):
+        """Fills table paths into a SQL template
+
+        Args:
+            file_name (str): the name of the SQL file
+            tables (list): the names of the tables filled into the template
+
+        Returns:
+            str: the SQL ready to run
+        """
+        return self.read_sql(file_name).format(
+            *[self.table_path(table_name) for table_name in tables])
+
+    def run(self, file_name, tables, params=None):
+        """Runs a SQL template. Results of SELECT templates are cached until
+           data is next written.
+
+        Args:
+            file_name (str): the name of the SQL file
+            tables (list): the names of the tables filled into the template
+            params (dict): the values bound to the @ parameters in the SQL
+
+        Returns:
+            df: The result of the SQL
+        """
+        params = params or {}
+        sql = self.render_sql(file_name, tables)
+        if not is_read_only(sql):
+            return self.query(sql, params)
+        key = (file_name, tuple(tables), tuple(sorted(params.items())))
+        if key not in self.results:
+            self.results[key] = self.query(sql, params)
+        return self.results[key]
+
+
+class BigQueryBackend(Backend):
+    """Stores data in Google BigQuery.
+
+    Args:
+        project_id (str): Google Cloud project holding the dataset.
+        dataset (str): BigQuery dataset holding the tables.
+        client (client): client to connect to BQ. The shared client is used
+            if not passed.
+    """
+
+    def __init__(self, project_id, dataset, client=None):
+        super().__init__()
+        # imported here so the SQLite backend doesn't load the BQ libraries
+        import google_helpers
+        self.gh = google_helpers
+        self.project_id = project_id
+        self.dataset = dataset
+        self.client = client if client is not None else clients.bigquery_client()
+        self.dataset_ref = self.client.dataset(dataset)
+        self.tables = {}
+
+    def table_path(self, table_name):
+        """Returns the fully qualified path of a table for use in SQL
+
+        Args:
+            table_name (str): the name of the table
+
+        Returns:
+            str: the quoted table path
+        """
+        return '`'+self.project_id+'.'+self.dataset+'.'+table_name+'`'
+
+    def query(self, sql, params=None):
+        """Queries BQ using the passed SQL query and returns the result
+
+        Args:
+            sql (str): the query to be run.
+            params (dict): the values bound to the @ parameters in the SQL
+
+        Returns:
+            df: The result of the passed SQL query
+        """
+        if not is_read_only(sql):
+            self.results.clear()
+        job = self.gh.run_query(sql, self.client, params)
+        df = job.to_dataframe()
+        run_stats.record(queries=1, bytes_billed=job.total_bytes_billed,
+                         rows=job.num_dml_affected_rows or len(df))
+        return df
+
+    def scan_cost(self, file_name, tables, params=None):
+        """Finds the bytes a SQL template would process with a dry run, which
+           is free and doesn't run the query. The estimate reflects the
+           partitions pruned but not the blocks clustering skips, so it is
+           an upper bound for clustered tables.
+
+        Args:
+            file_name (str): the name of the SQL file
+            tables (list): the names of the tables filled into the template
+            params (dict): the values bound to the @ parameters in the SQL
+
+        Returns:
+            int: the bytes the query would process
+        """
+        job = self.gh.run_query(self.render_sql(file_name, tables),
+                                self.client, params, dry_run=True)
+        return job.total_bytes_processed
+
+    def create_tables(self, price_table_name, div_table_name):
+        """Creates the dataset, the price and dividend tables, their load
+           tables, the total return index table, the fingerprint table, the
+           quarantine table and the scheduler's checkpoint table if they
+           don't already exist. The base tables and the index are partitioned
+           by month of snap_date and clustered by ticker, so queries filtering
+           on them only read the data they need.
+
+        Args:
+            price_table_name (str): the name of the price table
+            div_table_name (str): the name of the dividend table
+        """
+        self.client.create_dataset(self.dataset, exists_ok=True)
+        for table_name, create_sql_file in [
+                (price_table_name, 'create_price.sql'),
+                (div_table_name, 'create_divs.sql')]:
+            _ = self.run(create_sql_file, [table_name])
+            _ = self.run('create_load.sql',
+                         [self.load_table_name(table_name), table_name])
+        for prefix, create_sql_file in [
+                ('tr_index_', 'create_tr_index.sql'),
+                ('fingerprints_', 'create_fingerprints.sql'),
+                ('quarantine_', 'create_quarantine.sql'),
+                ('checkpoints_', 'create_checkpoints.sql')]:
+            _ = self.run(create_sql_file, [prefix+price_table_name])
+
+    def write(self, data, table_name):
+        """Takes in a dataframe and writes the values to a table
+
+        Args:
+            data (df): the dataframe to be written
+            table_name (str): the name of the table to be written to.
+        """
+        self.results.clear()
+        self.gh.write_to_gbq(data, self.client, self.get_table(table_name))
+        run_stats.record(rows=len(data))
+
+    def load(self, data, table_name):
+        """Replaces the contents of a table with a dataframe in one load job
+
+        Args:
+            data (df): the dataframe to be written
+            table_name (str): the name of the table to be written to.
+        """
+        self.results.clear()
+        self.gh.write_to_gbq(data, self.client, self.get_table(table_name),
+                             replace=True)
+        run_stats.record(rows=len(data))
+
+    def get_table(self, table_name):
+        """Returns the BQ table with the passed name. Tables are looked up
+           once and then reused.
+
+        Args:
+            table_name (str): the name of the table
+
+        Returns:
+            Table: the BQ table
+        """
+        if table_name not in self.tables:
+            table_ref = self.dataset_ref.table(table_name)
+            self.tables[table_name] = self.client.get_table(table_ref)
+        return self.tables[table_name]
+
+
+class SQLiteBackend(Backend):
+    """Stores data in a local SQLite file. Safe to share between threads.
+
+    Args:
+        db_path (str): path to the SQLite file. ':memory:' keeps the data in
+            memory for the lifetime of the backend.
+    """
+
+    templates = SQLITE_TEMPLATES
+    emulates_layout = True
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def create_tables(self, price_table_name, div_table_name,
+                      run_stats_table_name=None):
+        """Creates the price and dividend tables, their load tables, the
+           total return index table, the fingerprint table, the quarantine
+           table and the scheduler's checkpoint table if they don't already
+           exist. The base tables and the index are indexed on ticker and
+           date so merges and per ticker lookups don't scan the whole table.
+           The price and dividend tables are also indexed on date, standing
+           in for BigQuery's partitions, and the fingerprint table is
+           uniquely indexed on ticker so saved fingerprints can be merged in.
+
+        Args:
+            price_table_name (str): the name of the price table
+            div_table_name (str): the name of the dividend table
+            run_stats_table_name (str): the name of the table run summaries
+                are written to. Not created if not passed.
+        """
+        for table_name, schema in [(price_table_name, PRICE_SCHEMA),
+                                   (div_table_name, DIV_SCHEMA)]:
+            for name in [table_name, 'load_'+table_name]:
+                self.query('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+                    self.table_path(name), schema))
+        self.query('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            self.table_path('tr_index_'+price_table_name), TR_INDEX_SCHEMA))
+        self.query('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            self.table_path('fingerprints_'+price_table_name),
+            FINGERPRINT_SCHEMA))
+        self.query('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            self.table_path('quarantine_'+price_table_name),
+            QUARANTINE_SCHEMA))
+        self.query('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            self.table_path('checkpoints_'+price_table_name),
+            CHECKPOINT_SCHEMA))
+        for table_name in [price_table_name, div_table_name,
+                           'tr_index_'+price_table_name]:
+            self.query('CREATE INDEX IF NOT EXISTS {} ON {} '
+                       '(ticker, snap_date)'.format(
+                           self.table_path('idx_'+table_name),
+                           self.table_path(table_name)))
+        self.query('CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} '
+                   '(ticker)'.format(
+                       self.table_path('idx_fingerprints_'+price_table_name),
+                       self.table_path('fingerprints_'+price_table_name)))
+        for table_name in [price_table_name, div_table_name]:
+            _ = self.run('partition_table.sql',
+                         [table_name, table_name, 'part_'+table_name])
+        if run_stats_table_name:
+            self.query('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+                self.table_path(run_stats_table_name), RUN_STATS_SCHEMA))
+
+    def table_path(self, table_name):
+        """Returns the quoted path of a table for use in SQL
+
+        Args:
+            table_name (str): the name of the table
+
+        Returns:
+            str: the quoted table path
+        """
+        return '`'+table_name+'`'
+
+    def query(self, sql, params=None):
+        """Runs the passed SQL and returns the result
+
+        Args:
+            sql (str): the query to be run.
+            params (dict): the values bound to the @ parameters in the SQL
+
+        Returns:
+            df: The result of the passed SQL query. Empty if the SQL doesn't
+                return rows.
+        """
+        if not is_read_only(sql):
+            self.results.clear()
+        params = {name: sqlite_value(value)
+                  for name, value in (params or {}).items()}
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            if cursor.description is None:
+                self.conn.commit()
+                run_stats.record(queries=1, rows=max(cursor.rowcount, 0))
+                return pd.DataFrame()
+            columns = [col[0] for col in cursor.description]
+            df = pd.DataFrame(cursor.fetchall(), columns=columns)
+        run_stats.record(queries=1, rows=len(df))
+        for col in df.columns.intersection(DATE_COLUMNS):
+            df[col] = pd.to_datetime(df[col])
+        return df
+
+    def scan_cost(self, file_name, tables, params=None):
+        """Runs a SQL template and counts the steps SQLite takes, a stand-in
+           for the bytes BigQuery would process. Fewer steps means fewer rows
+           were read, so pruning by the date index shows up offline.
+
+        Args:
+            file_name (str): the name of the SQL file
+            tables (list): the names of the tables filled into the template
+            params (dict): the values bound to the @ parameters in the SQL
+
+        Returns:
+            int: the steps taken, to the nearest SCAN_STEPS
+        """
+        params = {name: sqlite_value(value)
+                  for name, value in (params or {}).items()}
+        steps = [0]
+
+        def count():
+            steps[0] += SCAN_STEPS
+            return 0
+        with self.lock:
+            self.conn.set_progress_handler(count, SCAN_STEPS)
+            try:
+                self.conn.execute(self.render_sql(file_name, tables),
+                                  params).fetchall()
+            finally:
+                self.conn.set_progress_handler(None, 0)
+        return steps[0]
+
+    def write(self, data, table_name):
+        """Takes in a dataframe and writes the values to a table
+
+        Args:
+            data (df): the dataframe to be written
+            table_name (str): the name of the table to be written to.
+        """
+        self.results.clear()
+        sql = insert_statement(data, self.table_path(table_name))
+        with self.lock:
+            for rows in insert_rows(data):
+                self.conn.executemany(sql, rows)
+            self.conn.commit()
+        run_stats.record(rows=len(data))
+
+    def load(self, data, table_name):
+        """Replaces the contents of a table with a dataframe in one
+           transaction
+
+        Args:
+            data (df): the dataframe to be written
+            table_name (str): the name of the table to be written to.
+        """
+        self.results.clear()
+        table_path = self.table_path(table_name)
+        sql = insert_statement(data, table_path)
+        with self.lock:
+            self.conn.execute('DELETE FROM {}'.format(table_path))
+            for rows in insert_rows(data):
+                self.conn.executemany(sql, rows)
+            self.conn.commit()
+        run_stats.record(rows=len(data))
+
+
+def is_read_only(sql):
+    """Returns whether SQL only reads data
+
+    Args:
+        sql (str): the SQL to check
+
+    Returns:
+        bool: True if the SQL is a SELECT
+    """
+    return sql.lstrip().upper().startswith(('SELECT', 'WITH'))
+
+
+def sqlite_value(value):
+    """Converts a parameter to the form stored in SQLite. Dates are stored as
+       ISO strings.
+
+    Args:
+        value: the parameter value
+
+    Returns:
+        the value to bind
+    """
+    if isinstance(value, dt.date):
+        return value.strftime('%Y-%m-%d')
+    return value
+
+
+def insert_statement(data, table_path):
+    """Builds the SQLite statement used to insert a dataframe
+
+    Args:
+        data (df): the dataframe to be written
+        table_path (str): the quoted path of the table to be written to
+
+    Returns:
+        str: the insert statement
+    """
+    placeholders = ', '.join(['?'] * len(data.columns))
+    return 'INSERT INTO {} VALUES ({})'.format(table_path, placeholders)
+
+
+def insert_rows(data, chunk_rows=CHUNK_ROWS):
+    """Yields the rows of a dataframe in chunks ready for SQLite. SQLite
+       only takes rows, so chunking keeps the number of row objects alive at
+       once bounded.
+
+    Args:
+        data (df): the dataframe to be written
+        chunk_rows (int): the maximum number of rows per chunk
+
+    Yields:
+        list: the rows in the next chunk
+    """
+    date_cols = data.select_dtypes(include='datetime').columns
+    for start in range(0, len(data), chunk_rows):
+        chunk = data.iloc[start:start+chunk_rows].copy()
+        # dates are stored as ISO strings so they compare correctly
+        for col in date_cols:
+            chunk[col] = chunk[col].dt.strftime('%Y-%m-%d')
+        yield list(chunk.itertuples(index=False, name=None))
+
+
+def get_backend(price_table_name, div_table_name):
+    """Creates the storage backend selected by the STORAGE_BACKEND
+       environment variable. Defaults to BigQuery.
+
+    Args:
+        price_table_name (str): the name of the price table
+        div_table_name (str): the name of the dividend table
+
+    Returns:
+        BigQueryBackend or SQLiteBackend: the backend to store data in
+    """
+    backend_name = os.environ.get('STORAGE_BACKEND', 'bigquery')
+    if backend_name == 'sqlite':
+        backend = SQLiteBackend(os.environ.get('SQLITE_PATH',
+                                               'hot_potatoes.db'))
+        backend.create_tables(price_table_name, div_table_name,
+                              os.environ.get('RUN_STATS_TABLE'))
+        return backend
+    if backend_name == 'bigquery':
+        return BigQueryBackend(os.environ['PROJECT_ID'],
+                               os.environ['DATASET'])
+    raise ValueError('Unknown storage backend: {}'.format(backend_name))
@@ -0,0 +1,3 @@
+SELECT ticker, snap_date, close
+FROM {}
+WHERE snap_date >= @since;
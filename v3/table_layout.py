@@ -0,0 +1,180 @@
+"""Code used to move the price and dividend tables to a layout partitioned by
+month of snap_date and clustered by ticker, and to report how many bytes
+queries scan before and after.
+
+Partitioning lets BigQuery skip the months a query's snap_date filter rules
+out and clustering lets it skip the blocks of other tickers, so a query for
+one ticker on one date no longer scans the whole history. Partitions are
+monthly as BigQuery caps a table at 10,000 partitions and daily ones would
+run out after about 40 years of history.
+
+Tables are migrated by copying each into a backup table, named after it with
+UNPARTITIONED_SUFFIX, and building a copy in the new layout from the backup,
+named after it with STAGED_SUFFIX. The table is only replaced by the staged
+copy once the copy is known to hold every row, so a migration which fails
+part way leaves the table as it was. Pause the daily run while migrating: a
+run writing to the table after it was backed up makes the migration stop
+before replacing it. The backup is kept so the report can compare the two
+layouts; drop it once the migrated table has been checked.
+
+On BigQuery the report uses dry runs, which are free but only reflect
+partition pruning. They give the bytes read before clustering, so the
+savings reported for queries filtering on ticker are a lower bound; the
+bytes_billed of real runs (see run_stats) show the rest.
+
+The local SQLite backend stands in for the layout with an index on
+snap_date, and its backup has no indexes, so pruning can be checked without
+BigQuery. As the index would also speed up queries which BigQuery can't
+prune, only queries filtering on snap_date are measured against it. SQLite
+reports the steps it took rather than bytes, so compare the share saved
+rather than the values.
+
+Run with `python table_layout.py create`, `python table_layout.py migrate`
+or `python table_layout.py report`.
+"""
+import os
+import sys
+import logging
+import pandas as pd
+import storage
+
+
+# set logging level
+logging.basicConfig(level=logging.INFO)
+
+UNPARTITIONED_SUFFIX = '_unpartitioned'
+STAGED_SUFFIX = '_partitioned'
+# queries reported on, as the SQL file, the tables it reads ('price' or
+# 'div'), the parameters it takes and whether it filters on snap_date
+SCAN_QUERIES = [
+    ('close_value.sql', ['price'], ['ticker', 'snap_date'], True),
+    ('max_date_where.sql', ['price'], ['ticker', 'snap_date'], True),
+    ('divs.sql', ['div'], ['ticker', 'start_dt', 'end_dt'], True),
+    ('date_range.sql', ['price'], [], False),
+    ('watermarks.sql', ['price'], [], False),
+    ('returns.sql', ['price', 'div'], ['start_dt', 'end_dt'], False),
+]
+
+
+def check_rows(backend, table_name, copy_name):
+    """Checks a table and a copy of it hold the same number of rows
+
+    Args:
+        backend (storage backend): open backend holding the tables
+        table_name (str): the name of the table
+        copy_name (str): the name of the copy
+
+    Returns:
+        int: the number of rows in each
+
+    Raises:
+        RuntimeError: if the row counts differ
+    """
+    rows = [backend.run('row_count.sql', [name]).row_count.iloc[0]
+            for name in [table_name, copy_name]]
+    if rows[0] != rows[1]:
+        raise RuntimeError('{} holds {} rows but {} holds {}'.format(
+            table_name, rows[0], copy_name, rows[1]))
+    return rows[0]
+
+
+def migrate_table(backend, table_name):
+    """Copies a table into a backup and replaces it with a copy partitioned
+       by month of snap_date and clustered by ticker. The partitioned copy
+       is built under a staged name and only swapped in once it holds every
+       row of the table, so writes made to the table since the backup stop
+       the migration rather than being lost.
+
+    Args:
+        backend (storage backend): open backend holding the table
+        table_name (str): the name of the table to migrate
+
+    Raises:
+        RuntimeError: if the table was written to while being migrated, or
+            if the migrated table holds a different number of rows to the
+            backup
+    """
+    backup_table_name = table_name+UNPARTITIONED_SUFFIX
+    staged_table_name = table_name+STAGED_SUFFIX
+    _ = backend.run('backup_table.sql', [backup_table_name, table_name])
+    _ = backend.run('stage_table.sql', [staged_table_name, backup_table_name])
+    _ = check_rows(backend, table_name, staged_table_name)
+    _ = backend.run('partition_table.sql',
+                    [table_name, staged_table_name, 'part_'+table_name])
+    _ = backend.run('drop_table.sql', [staged_table_name])
+    rows = check_rows(backend, table_name, backup_table_name)
+    logging.info('Migrated {} ({} rows)'.format(table_name, rows))
+
+
+def report_params(backend, price_table_name):
+    """Picks the values the reported queries are run with: the ticker with
+       the most recent data, its last date and the year before it
+
+    Args:
+        backend (storage backend): open backend holding the price table
+        price_table_name (str): the name of the price table
+
+    Returns:
+        dict: the ticker, snap_date, start_dt and end_dt parameters
+    """
+    watermarks = backend.run('watermarks.sql', [price_table_name])
+    latest = watermarks.sort_values(['max_dt', 'ticker'],
+                                    ascending=[False, True]).iloc[0]
+    return {'ticker': latest.ticker, 'snap_date': latest.max_dt,
+            'start_dt': latest.max_dt - pd.DateOffset(years=1),
+            'end_dt': latest.max_dt}
+
+
+def scan_report(backend, price_table_name, div_table_name,
+                suffix=UNPARTITIONED_SUFFIX):
+    """Measures how much each of SCAN_QUERIES reads from the backup tables
+       and from the migrated tables. Where the backend only stands in for
+       the layout, queries which don't filter on snap_date can't be pruned
+       so are taken to read as much from both. BigQuery's figures leave
+       out clustering, see scan_cost.
+
+    Args:
+        backend (storage backend): open backend holding the tables
+        price_table_name (str): the name of the price table
+        div_table_name (str): the name of the dividend table
+        suffix (str): the suffix of the backup tables
+
+    Returns:
+        df: one row per query with the before and after scan costs and the
+            percentage saved. Bytes on BigQuery, steps on SQLite.
+    """
+    params = report_params(backend, price_table_name)
+    table_names = {'price': price_table_name, 'div': div_table_name}
+    rows = []
+    for file_name, tables, param_names, filters_dates in SCAN_QUERIES:
+        query_params = {name: params[name] for name in param_names}
+        table_suffixes = [suffix, '']
+        if backend.emulates_layout and not filters_dates:
+            table_suffixes = [suffix]
+        costs = [
+            backend.scan_cost(file_name,
+                              [table_names[table]+table_suffix
+                               for table in tables], query_params)
+            for table_suffix in table_suffixes]
+        before, after = costs[0], costs[-1]
+        rows.append({'query': file_name, 'before': before, 'after': after,
+                     'saved_pct': round(100 * (1 - after / before), 1)
+                     if before else 0.0})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    price_table_name = os.environ['PRICE_TABLENAME']
+    div_table_name = os.environ['DIVIDEND_TABLENAME']
+    backend = storage.get_backend(price_table_name, div_table_name)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'report'
+    if command == 'create':
+        backend.create_tables(price_table_name, div_table_name)
+    elif command == 'migrate':
+        for table_name in [price_table_name, div_table_name]:
+            migrate_table(backend, table_name)
+    elif command == 'report':
+        print(scan_report(backend, price_table_name, div_table_name)
+              .to_string(index=False))
+    else:
+        raise ValueError('Unknown command: {}'.format(command))
@@ -0,0 +1,32 @@
+"""Code used to limit how often we call out to external services.
+"""
+import threading
+import time
+
+
+class RateLimiter:
+    """Spaces out calls so no more than a set number happen per second.
+       Safe to share between threads.
+
+    Args:
+        requests_per_second (float): the maximum call rate. Zero or less
+            disables limiting.
+    """
+
+    def __init__(self, requests_per_second):
+        if requests_per_second > 0:
+            self.interval = 1 / requests_per_second
+        else:
+            self.interval = 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until the caller is allowed to make its next call.
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
@@ -0,0 +1,216 @@
+"""Code used to maintain the total return index.
+
+The index tracks the value of holding a ticker with every dividend reinvested
+at the close on its ex-date. It starts at BASE_INDEX on the first date we have
+a close for and each day moves by (close + dividend) / previous close. The
+return over any window is then the ratio of the index at its two ends, so
+N month returns come from two stored values rather than a recalculation over
+the daily data.
+
+Each run rebuilds the index from the earliest date it pulled, continuing
+each ticker from its last value before that date, so bars and dividends
+merged with dates before the end of the index are included. Merges only add
+rows, so a stored bar or dividend revised by Yahoo isn't changed.
+Run from the v3 folder to rebuild it from the full history:
+python tr_index.py
+"""
+import os
+import logging
+import pandas as pd
+import storage
+
+
+# value of the index on the first date we have a close for
+BASE_INDEX = 100.0
+TR_INDEX_COLUMNS = ['ticker', 'snap_date', 'tr_index']
+
+
+def tr_index_table_name(price_table_name):
+    """Returns the name of the total return index table
+
+    Args:
+        price_table_name (str): the name of the price table
+
+    Returns:
+        str: the name of the total return index table
+    """
+    return 'tr_index_'+price_table_name
+
+
+def clean_keys(data):
+    """Gives the ticker and snap_date columns the same types whichever
+       backend or file they came from so frames can be merged
+
+    Args:
+        data (df): data with ticker and snap_date columns
+
+    Returns:
+        df: a copy with object tickers and nanosecond dates
+    """
+    return data.astype({'ticker': object, 'snap_date': 'datetime64[ns]'})
+
+
+def build_index(prices, divs, seeds=None):
+    """Calculates the total return index for every ticker in one pass.
+       Dividends are reinvested on the first close on or after their date.
+
+    Args:
+        prices (df): price data with ticker, snap_date and close columns.
+            For seeded tickers it must start on the seed date.
+        divs (df): dividend data with ticker, snap_date and amount columns.
+            For seeded tickers only dividends after the seed date.
+        seeds (df): the last stored index value (ticker, snap_date,
+            tr_index) of tickers which already have an index. The index is
+            continued from these.
+
+    Returns:
+        df: one row per ticker per date with the TR_INDEX_COLUMNS. Seed rows
+            are not included.
+    """
+    prices = (clean_keys(prices[['ticker', 'snap_date', 'close']])
+              .drop_duplicates(['ticker', 'snap_date'], keep='last')
+              .sort_values('snap_date', kind='stable'))
+    divs = clean_keys(divs.loc[divs['amount'] > 0,
+                               ['ticker', 'snap_date', 'amount']])
+    divs = divs.sort_values('snap_date', kind='stable')
+    # move each dividend onto the first close on or after its date
+    divs = pd.merge_asof(divs.rename(columns={'snap_date': 'div_date'}),
+                         prices[['ticker', 'snap_date']],
+                         left_on='div_date', right_on='snap_date',
+                         by='ticker', direction='forward')
+    divs = divs.groupby(['ticker', 'snap_date'])['amount'].sum()
+    data = prices.sort_values(['ticker', 'snap_date'], kind='stable')
+    data = data.join(divs, on=['ticker', 'snap_date'])
+    data['amount'] = data['amount'].astype(float).fillna(0)
+    previous = data.groupby('ticker')['close'].shift(1)
+    # the first row of each ticker is its base (or seed) date
+    data['factor'] = ((data['close'] + data['amount']) / previous).fillna(1.0)
+    base = pd.Series(BASE_INDEX, index=data.index)
+    if seeds is not None and len(seeds) > 0:
+        seed_values = seeds.set_index('ticker')['tr_index']
+        base = data['ticker'].map(seed_values).fillna(BASE_INDEX)
+    data['tr_index'] = base * data.groupby('ticker')['factor'].cumprod()
+    if seeds is not None and len(seeds) > 0:
+        seed_dates = data['ticker'].map(seeds.set_index('ticker')['snap_date'])
+        data = data.loc[seed_dates.isna() | (data['snap_date'] > seed_dates)]
+    return data[TR_INDEX_COLUMNS].reset_index(drop=True)
+
+
+def update_tr_index(backend, price_table_name, div_table_name, since):
+    """Rebuilds the total return index of every ticker from a date up to the
+       latest price data. Each ticker is continued from its last index value
+       before the date. Tickers without an index before it are built from
+       their full history.
+
+    Args:
+        backend (storage backend): open backend to use for querying
+        price_table_name (str): the table to pull stock data from
+        div_table_name (str): the table to pull dividend data from
+        since (datetime): the earliest date which may have changed, e.g. the
+            earliest date pulled in this run
+
+    Returns:
+        int: the number of rows written
+    """
+    table_name = tr_index_table_name(price_table_name)
+    params = {'since': since}
+    seeds = backend.run('tr_index_latest.sql', [table_name], params)
+    prices = backend.run('tr_index_prices.sql', [table_name, price_table_name],
+                         params)
+    divs = backend.run('tr_index_divs.sql', [table_name, div_table_name],
+                       params)
+    rows = build_index(prices, divs, seeds)
+    _ = backend.run('tr_index_clear.sql', [table_name], params)
+    if len(rows) > 0:
+        backend.write(rows, table_name)
+    logging.info('Wrote {} rows to {}'.format(len(rows), table_name))
+    return len(rows)
+
+
+def rebuild_tr_index(backend, price_table_name, div_table_name):
+    """Replaces the total return index with one built from the full history.
+       Needed if history older than the start of the index is loaded.
+
+    Args:
+        backend (storage backend): open backend to use for querying
+        price_table_name (str): the table to pull stock data from
+        div_table_name (str): the table to pull dividend data from
+
+    Returns:
+        int: the number of rows written
+    """
+    prices = backend.run('history_prices.sql', [price_table_name])
+    divs = backend.run('history_divs.sql', [div_table_name])
+    rows = build_index(prices, divs)
+    backend.load(rows, tr_index_table_name(price_table_name))
+    return len(rows)
+
+
+def window_returns(backend, price_table_name, end_dt, lookbacks, tickers=None):
+    """Reads the total return of every ticker over several windows ending on
+       the same date with one query. Each window ends on the last date before
+       the month of end_dt, the same dates used by returns.sql.
+
+    Args:
+        backend (storage backend): open backend to use for querying
+        price_table_name (str): the name of the price table
+        end_dt (datetime): any date in the month after the windows
+        lookbacks (list): the lengths of the windows in months
+        tickers (list): the tickers to return results for. All if not passed.
+
+    Returns:
+        df: total returns in percent with one row per ticker and one column
+            per lookback
+    """
+    end_dt = pd.Timestamp(end_dt).replace(day=1)
+    start_dt = end_dt - pd.DateOffset(months=max(lookbacks)+1)
+    rows = backend.run('tr_index_month_ends.sql',
+                       [tr_index_table_name(price_table_name)],
+                       {'start_dt': start_dt, 'end_dt': end_dt})
+    if len(rows) == 0:
+        return pd.DataFrame(index=tickers, columns=lookbacks, dtype=float)
+    months = pd.period_range(start_dt, end_dt, freq='M')[:-1]
+    index_me = month_end_index(clean_keys(rows)).reindex(months).ffill()
+    # shifting the last row by each lookback picks every window start at once
+    pct = pd.DataFrame({lookback: (index_me.iloc[-1] /
+                                   index_me.iloc[-1-lookback] - 1) * 100
+                        for lookback in lookbacks})
+    if tickers is not None:
+        pct = pct.reindex(tickers)
+    return pct
+
+
+def month_end_index(index):
+    """Builds a months x tickers matrix of the index at each month end
+
+    Args:
+        index (df): index data with the TR_INDEX_COLUMNS
+
+    Returns:
+        df: the last index value on or before each month end
+    """
+    matrix = index.pivot_table(index='snap_date', columns='ticker',
+                               values='tr_index', aggfunc='last').ffill()
+    return matrix.groupby(matrix.index.to_period('M')).last()
+
+
+def trailing_index_returns(index_me, lookback=12):
+    """Calculates trailing total returns from month end index values
+
+    Args:
+        index_me (df): the output of month_end_index
+        lookback (int): the number of months to look back
+
+    Returns:
+        df: the trailing total returns in percent
+    """
+    return (index_me / index_me.shift(lookback) - 1) * 100
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    price_table_name = os.environ['PRICE_TABLENAME']
+    div_table_name = os.environ['DIVIDEND_TABLENAME']
+    backend = storage.get_backend(price_table_name, div_table_name)
+    rows = rebuild_tr_index(backend, price_table_name, div_table_name)
+    logging.info('Wrote {} rows'.format(rows))
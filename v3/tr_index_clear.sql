@@ -0,0 +1,2 @@
+DELETE FROM {}
+WHERE snap_date >= @since;
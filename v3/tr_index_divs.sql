@@ -0,0 +1,11 @@
+WITH latest AS (
+  SELECT ticker, MAX(snap_date) AS max_dt
+  FROM {0}
+  WHERE snap_date < @since
+  GROUP BY ticker
+)
+SELECT divs.ticker, divs.snap_date, divs.amount
+FROM {1} AS divs
+LEFT JOIN latest
+  ON latest.ticker = divs.ticker
+WHERE latest.max_dt IS NULL OR divs.snap_date > latest.max_dt;
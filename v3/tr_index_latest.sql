@@ -0,0 +1,10 @@
+SELECT tri.ticker, tri.snap_date, tri.tr_index
+FROM {0} AS tri
+JOIN (
+  SELECT ticker, MAX(snap_date) AS max_dt
+  FROM {0}
+  WHERE snap_date < @since
+  GROUP BY ticker
+) AS latest
+  ON latest.ticker = tri.ticker
+  AND latest.max_dt = tri.snap_date;
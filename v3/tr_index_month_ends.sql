@@ -0,0 +1,11 @@
+SELECT tri.ticker, tri.snap_date, tri.tr_index
+FROM {0} AS tri
+JOIN (
+  SELECT ticker, MAX(snap_date) AS max_dt
+  FROM {0}
+  WHERE snap_date >= @start_dt
+    AND snap_date < @end_dt
+  GROUP BY ticker, DATETIME_TRUNC(snap_date, MONTH)
+) AS month_ends
+  ON month_ends.ticker = tri.ticker
+  AND month_ends.max_dt = tri.snap_date;
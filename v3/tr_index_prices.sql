@@ -0,0 +1,11 @@
+WITH latest AS (
+  SELECT ticker, MAX(snap_date) AS max_dt
+  FROM {0}
+  WHERE snap_date < @since
+  GROUP BY ticker
+)
+SELECT price.ticker, price.snap_date, price.close
+FROM {1} AS price
+LEFT JOIN latest
+  ON latest.ticker = price.ticker
+WHERE latest.max_dt IS NULL OR price.snap_date >= latest.max_dt;
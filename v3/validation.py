@@ -0,0 +1,350 @@
+"""Checks on the data pulled from Yahoo before it's merged into the base
+tables.
+
+Every check runs column-wise over the data of all tickers at once:
+    duplicate: a second bar or dividend for the same ticker and date
+    non_positive: an open, high, low or close (or dividend) which is zero or
+        less, or a missing close
+    spike: a close which moves more than MAX_DAILY_MOVE from the previous one
+        and straight back the next day, e.g. a bad print
+    level_shift: a close which moves more than MAX_DAILY_MOVE and stays
+        there, e.g. an unadjusted split. It and every later bar of the ticker
+        are held back, since they'd be on a different basis to the history.
+    revised: a bar pulled again whose close is more than MAX_DAILY_MOVE away
+        from the stored one, e.g. after Yahoo adjusted the history for a
+        split. It and every later bar of the ticker are held back until the
+        stored history is reloaded to match.
+    gap: a trading day inside the pulled range with no bar. The trading
+        calendar is the set of weekdays on which at least CALENDAR_SHARE of
+        the tickers on the same exchange (the ticker's suffix) have a bar.
+
+Moves into the first bar pulled are measured from the last close already
+stored. A level shift is accepted as a genuine move once the new level has
+held for ACCEPT_AFTER_DAYS bars, or straight away if it's listed in
+ACCEPTED_MOVES. Held back bars are pulled again by the next run, as the
+ticker's watermark doesn't move past them.
+
+Rows failing a check are left out of the merge and written, along with the
+gaps found, to a table named `quarantine_` followed by the price table name
+so they can be looked into. Gaps can't be left out so are only reported.
+Issues already in the table aren't written again.
+"""
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+
+PRICE_CHECK_COLUMNS = ['Open', 'High', 'Low', 'Close']
+QUARANTINE_COLUMNS = ['ticker', 'snap_date', 'kind', 'value', 'reason',
+                      'found_at']
+# days before the first bar pulled searched for the last stored close
+ANCHOR_DAYS = 14
+
+
+def quarantine_table_name(price_table_name):
+    """Returns the name of the quarantine table for a price table
+
+    Args:
+        price_table_name (str): the name of the price table
+
+    Returns:
+        str: the name of the quarantine table
+    """
+    return 'quarantine_'+price_table_name
+
+
+def stack(frames):
+    """Concatenates the frames of every ticker. Empty frames, e.g. the
+       dividends of tickers which paid none, are left out as pandas is slow
+       to combine them.
+
+    Args:
+        frames (list): price or dividend data of each ticker
+
+    Returns:
+        df: the data of every ticker
+    """
+    return pd.concat([frame for frame in frames if len(frame) > 0] or
+                     frames[:1], ignore_index=True)
+
+
+def exchange_suffixes(tickers):
+    """Finds the exchange suffix of each ticker, e.g. .TO for VCN.TO
+
+    Args:
+        tickers (Series): the ticker of each row
+
+    Returns:
+        Series: the suffix of each row. Empty for tickers without a dot.
+    """
+    unique = tickers.unique()
+    suffixes = pd.Series([ticker[ticker.rfind('.'):] if '.' in ticker else ''
+                          for ticker in unique], index=unique)
+    return tickers.map(suffixes)
+
+
+def issues_frame(data, mask, kind, value_col, reason):
+    """Lists the rows of data picked out by a mask as issues
+
+    Args:
+        data (df): price or dividend data with Ticker and Date columns
+        mask (Series): True for the rows with the issue
+        kind (str): 'price' or 'div'
+        value_col (str): the column reported as the value
+        reason (str): the name of the check failed
+
+    Returns:
+        df: one row per issue with ticker, snap_date, kind, value and reason
+    """
+    rows = data.loc[mask]
+    return pd.DataFrame({'ticker': rows.Ticker.to_numpy(),
+                         'snap_date': rows.Date.to_numpy(), 'kind': kind,
+                         'value': rows[value_col].to_numpy(dtype=float),
+                         'reason': reason})
+
+
+def accepted_moves(text):
+    """Parses the moves listed as genuine, e.g.
+       'VCN.TO:2024-03-01,XIC.TO:2024-05-02'
+
+    Args:
+        text (str): comma separated ticker:date pairs
+
+    Returns:
+        set: (ticker, Timestamp) pairs of the accepted moves
+    """
+    pairs = [item.strip().rsplit(':', 1) for item in text.split(',')
+             if item.strip()]
+    return {(ticker, pd.Timestamp(date)) for ticker, date in pairs}
+
+
+def stored_closes(stored):
+    """Shapes the closes read from the price table like the data pulled
+
+    Args:
+        stored (df): the output of stored_closes.sql
+
+    Returns:
+        df: the closes with Ticker, Date and Close columns
+    """
+    return pd.DataFrame({'Ticker': stored.ticker.to_numpy(dtype=object),
+                         'Date': pd.to_datetime(stored.snap_date).to_numpy(),
+                         'Close': stored.close.to_numpy(dtype=float)})
+
+
+def check_prices(prices, max_move, stored=None, accepted=(),
+                 accept_after=3):
+    """Finds the price bars which fail a check
+
+    Args:
+        prices (df): price data for every ticker
+        max_move (float): the largest believable daily move of the close,
+            as a fraction
+        stored (df): closes already in the price table from before the first
+            bar pulled onwards, with Ticker, Date and Close columns. Optional.
+        accepted (set): (ticker, date) pairs of moves known to be genuine
+        accept_after (int): bars a new level must hold for before a level
+            shift is accepted as genuine
+
+    Returns:
+        Series: the reason each bar failed, indexed like prices. None for bars
+            which passed.
+    """
+    reason = pd.Series(None, index=prices.index, dtype=object)
+    duplicate = prices.duplicated(['Ticker', 'Date'])
+    non_positive = (prices[PRICE_CHECK_COLUMNS] <= 0).any(axis=1) | \
+        prices.Close.isna()
+    reason[non_positive] = 'non_positive'
+    reason[duplicate] = 'duplicate'
+    # moves are measured between the bars which passed the checks above,
+    # starting from the last stored close. stored closes have a row of -1
+    pulled = prices.loc[reason.isna(), ['Ticker', 'Date', 'Close']]
+    bars = pulled.assign(row=pulled.index)
+    revised = pd.Series(False, index=prices.index)
+    if stored is not None and len(stored) > 0:
+        first_dts = pulled.groupby('Ticker').Date.min()
+        before = stored[stored.Date < stored.Ticker.map(first_dts)]
+        anchors = before.sort_values('Date').groupby('Ticker').tail(1)
+        bars = pd.concat([anchors.assign(row=-1), bars], ignore_index=True)
+        # bars pulled again which no longer match the stored close, e.g.
+        # after Yahoo adjusted the history for a split
+        both = bars[bars.row >= 0].merge(stored, on=['Ticker', 'Date'],
+                                          suffixes=('', '_stored'))
+        changed = both.row[(both.Close / both.Close_stored - 1).abs() >
+                           max_move]
+        revised[changed] = True
+    bars = bars.sort_values(['Ticker', 'Date'], kind='stable') \
+        .reset_index(drop=True)
+    closes = bars.groupby('Ticker').Close
+    move_in = bars.Close / closes.shift(1) - 1
+    move_out = closes.shift(-1) / bars.Close - 1
+    jump = move_in.abs() > max_move
+    if accepted:
+        jump &= ~pd.MultiIndex.from_frame(bars[['Ticker', 'Date']]) \
+            .isin(list(accepted))
+    spike = jump & (move_out.abs() > max_move) & \
+        (np.sign(move_in) != np.sign(move_out))
+    # the day after a spike moves straight back so isn't a jump of its own
+    after_spike = spike.groupby(bars.Ticker).shift(1, fill_value=False) \
+        .astype(bool)
+    shift_start = jump & ~spike & ~after_spike
+    # bars from each level shift up to the next one, which all sit at the
+    # new level
+    segment = shift_start.groupby(bars.Ticker).cumsum()
+    held = bars.groupby([bars.Ticker, segment]).Date.transform('size')
+    genuine = shift_start & (held >= accept_after)
+    if genuine.any():
+        logging.info('Accepted moves: {}'.format(', '.join(
+            '{} on {:%Y-%m-%d}'.format(ticker, date) for ticker, date in
+            bars.loc[genuine, ['Ticker', 'Date']].itertuples(index=False))))
+    shifted = (shift_start & ~genuine).groupby(bars.Ticker).cummax()
+    # bars from the first revised one onwards are on the revised basis
+    revised_bars = bars.row.map(revised).eq(True)
+    revised_bars = revised_bars.groupby(bars.Ticker).cummax()
+    pulled_rows = bars.row >= 0
+    reason[bars.row[spike & pulled_rows]] = 'spike'
+    reason[bars.row[shifted & pulled_rows]] = 'level_shift'
+    reason[bars.row[revised_bars & pulled_rows]] = 'revised'
+    return reason
+
+
+def find_gaps(prices, share):
+    """Finds trading days with no bar inside each ticker's pulled range
+
+    Args:
+        prices (df): price data for every ticker
+        share (float): the share of an exchange's tickers which must have a
+            bar on a weekday for it to count as a trading day
+
+    Returns:
+        df: one row per missing day with Ticker and Date columns
+    """
+    present = prices[['Ticker', 'Date']].drop_duplicates()
+    present['suffix'] = exchange_suffixes(present.Ticker)
+    counts = present.groupby(['suffix', 'Date']).size().rename('n') \
+        .reset_index()
+    n_tickers = present.groupby('suffix').Ticker.nunique()
+    calendar = counts[(counts.n >= share * counts.suffix.map(n_tickers)) &
+                      (counts.Date.dt.dayofweek < 5)]
+    ranges = present.groupby('Ticker').agg(suffix=('suffix', 'first'),
+                                           start=('Date', 'min'),
+                                           end=('Date', 'max')).reset_index()
+    expected = ranges.merge(calendar[['suffix', 'Date']], on='suffix')
+    expected = expected[(expected.Date > expected.start) &
+                        (expected.Date < expected.end)]
+    missing = expected[['Ticker', 'Date']].merge(present[['Ticker', 'Date']],
+                                                 how='left', indicator=True)
+    return missing.loc[missing._merge == 'left_only', ['Ticker', 'Date']]
+
+
+def validate(hist_data, max_move, share, stored=None, accepted=(),
+             accept_after=3):
+    """Checks the data pulled for every ticker at once and removes the rows
+       which fail
+
+    Args:
+        hist_data (dict): maps between tickers and their price and dividend
+            data
+        max_move (float): the largest believable daily move of the close,
+            as a fraction
+        share (float): the share of an exchange's tickers which must have a
+            bar on a weekday for it to count as a trading day
+        stored (df): closes already in the price table from before the first
+            bar pulled onwards, with Ticker, Date and Close columns. Optional.
+        accepted (set): (ticker, date) pairs of moves known to be genuine
+        accept_after (int): bars a new level must hold for before a level
+            shift is accepted as genuine
+
+    Returns:
+        tuple: hist_data without the failing rows, and a df of the issues
+            found with ticker, snap_date, kind, value and reason columns
+    """
+    if len(hist_data) == 0:
+        return hist_data, pd.DataFrame(columns=QUARANTINE_COLUMNS[:-1])
+    prices = stack([price for price, _ in hist_data.values()])
+    divs = stack([div for _, div in hist_data.values()])
+    price_reason = check_prices(prices, max_move, stored, accepted,
+                                accept_after)
+    div_reason = pd.Series(None, index=divs.index, dtype=object)
+    div_reason[divs.Dividends <= 0] = 'non_positive'
+    div_reason[divs.duplicated(['Ticker', 'Date'])] = 'duplicate'
+    gaps = find_gaps(prices, share)
+    issues = [issues_frame(prices, price_reason == reason, 'price', 'Close',
+                           reason)
+              for reason in price_reason.dropna().unique()]
+    issues += [issues_frame(divs, div_reason == reason, 'div', 'Dividends',
+                            reason)
+               for reason in div_reason.dropna().unique()]
+    issues.append(issues_frame(gaps.assign(Close=np.nan), gaps.index, 'price',
+                               'Close', 'gap'))
+    issues = pd.concat(issues, ignore_index=True)
+    if not (price_reason.notna().any() or div_reason.notna().any()):
+        return hist_data, issues
+    prices = prices[price_reason.isna()]
+    divs = divs[div_reason.isna()]
+    price_groups = dict(tuple(prices.groupby('Ticker', sort=False)))
+    div_groups = dict(tuple(divs.groupby('Ticker', sort=False)))
+    clean = {ticker: (price_groups.get(ticker, price.iloc[:0]),
+                      div_groups.get(ticker, div.iloc[:0]))
+             for ticker, (price, div) in hist_data.items()}
+    return clean, issues
+
+
+def unseen_issues(issues, seen):
+    """Removes the issues which are already in the quarantine table
+
+    Args:
+        issues (df): the issues found by validate
+        seen (df): the output of quarantined.sql
+
+    Returns:
+        df: the issues which haven't been recorded before
+    """
+    keys = ['ticker', 'snap_date', 'kind', 'reason']
+    merged = issues.merge(seen[keys].drop_duplicates(), on=keys, how='left',
+                          indicator=True)
+    return issues[(merged._merge == 'left_only').to_numpy()]
+
+
+def quarantine(hist_data, backend, price_table_name):
+    """Removes rows failing a check from the data pulled and writes them, and
+       any gaps found, to the quarantine table. Does nothing if the VALIDATE
+       environment variable is false.
+
+    Args:
+        hist_data (dict): maps between tickers and their price and dividend
+            data
+        backend (storage backend): open backend to read from and write to
+        price_table_name (str): the name of the price table
+
+    Returns:
+        dict: hist_data without the failing rows
+    """
+    if os.environ.get('VALIDATE', 'true').lower() != 'true':
+        return hist_data
+    first_dts = pd.Series({ticker: price.Date.min() for ticker, (price, _)
+                           in hist_data.items() if len(price) > 0},
+                          dtype='datetime64[ns]')
+    if len(first_dts) == 0:
+        return hist_data
+    since = first_dts.min() - pd.Timedelta(days=ANCHOR_DAYS)
+    stored = stored_closes(backend.run('stored_closes.sql',
+                                       [price_table_name], {'since': since}))
+    clean, issues = validate(
+        hist_data, float(os.environ.get('MAX_DAILY_MOVE', 0.3)),
+        float(os.environ.get('CALENDAR_SHARE', 0.5)),
+        stored,
+        accepted_moves(os.environ.get('ACCEPTED_MOVES', '')),
+        int(os.environ.get('ACCEPT_AFTER_DAYS', 3)))
+    if len(issues) > 0:
+        logging.warning('Quarantined data: {}'.format(
+            issues.reason.value_counts().to_dict()))
+        table_name = quarantine_table_name(price_table_name)
+        issues = unseen_issues(issues, backend.run('quarantined.sql',
+                                                   [table_name],
+                                                   {'since': since}))
+    if len(issues) > 0:
+        issues = issues.assign(found_at=pd.Timestamp.now().floor('s'))
+        backend.write(issues[QUARANTINE_COLUMNS], table_name)
+    return clean
@@ -0,0 +1,3 @@
+SELECT ticker, MAX(snap_date) AS max_dt
+FROM {}
+GROUP BY ticker;